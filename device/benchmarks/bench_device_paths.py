@@ -0,0 +1,219 @@
+# Device hot-path benchmark: key derivation, digests, refresh, provisioning and the
+# discovery -> key response round trip between two devices over a fake MQTT client
+#
+#   python benchmarks/bench_device_paths.py [scale]
+#
+# scale multiplies the repeat counts and data sizes (default 1; use <1 for quick runs)
+
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.device_context import DeviceContext
+from lib.discovery_filter import DiscoveryFilter
+from lib.evkms_core import EVKMSDevice
+from lib.log_handler import flush_logs
+from lib.mqtt_handler import broadcast_discovery, handle_discovery, handle_key_response
+from lib.utils import generate_nonce, compute_discovery_digest
+
+
+SUBSET = "BENCH"
+
+
+def timed(fn, repeats, setup=None):
+    """Run fn repeats times (after setup, untimed) and summarize the per-call times in us"""
+    samples = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return {
+        "runs": repeats,
+        "min_us": min(samples),
+        "median_us": statistics.median(samples),
+        "mean_us": statistics.fmean(samples),
+    }
+
+
+def secret_vector(size, salt=""):
+    return [f"{salt}{i:060x}" for i in range(size)]
+
+
+def provisioning_payload(vector_size, local_index):
+    vc = secret_vector(vector_size, "c")
+    return {
+        "secret_i": vc[local_index],
+        "Vectore_p": secret_vector(vector_size, "p"),
+        "Vectore_c": vc,
+        "Vectore_n": secret_vector(vector_size, "n"),
+        "alpha": 5,
+    }
+
+
+def provisioned_device(index, vector_size=16):
+    device = EVKMSDevice(f"{SUBSET}_device@{index:02d}", SUBSET)
+    device.load_evkms_payload(provisioning_payload(vector_size, index - 1))
+    return device
+
+
+def bench_compute_pairwise_key(repeats):
+    device = provisioned_device(1)
+    peer_secret = device.evkms_state["vector_Vc"][1]
+    return timed(lambda: device.compute_pairwise_key(f"{SUBSET}_device@02", peer_secret, generate_nonce()), repeats)
+
+
+def bench_compute_discovery_digest(repeats):
+    nonce = generate_nonce()
+    return timed(lambda: compute_discovery_digest("c" + "0" * 60, f"{SUBSET}_device@02", nonce), repeats)
+
+
+def bench_verify_discovery_digest(repeats):
+    device = provisioned_device(1)
+    nonce = generate_nonce()
+    digest = compute_discovery_digest(device.evkms_state["vector_Vc"][1], f"{SUBSET}_device@02", nonce)
+    return timed(lambda: device.verify_discovery_digest(f"{SUBSET}_device@02", "02", nonce, digest), repeats)
+
+
+def bench_refresh_all(repeats, peers):
+    device = provisioned_device(1)
+    for i in range(peers):
+        device.evkms_state["pairwise_keys"].put(f"{SUBSET}_device@{i + 2:05d}", os.urandom(32), generate_nonce())
+    result = timed(lambda: device.refresh_all_pairwise_keys(generate_nonce()), repeats)
+    result["peers"] = peers
+    return result
+
+
+def bench_load_evkms_payload(repeats, vector_size):
+    device = EVKMSDevice(f"{SUBSET}_device@01", SUBSET)
+    payload = provisioning_payload(vector_size, 0)
+    result = timed(lambda: device.load_evkms_payload(payload), repeats)
+    result["vector_size"] = vector_size
+    return result
+
+
+def bench_advance_epoch(repeats, key_count, vector_size):
+    """Epoch switch with key_count keys to migrate, after the background precompute"""
+    device = EVKMSDevice(f"{SUBSET}_device@01", SUBSET)
+    payload = provisioning_payload(vector_size, 0)
+    keys = [(f"{SUBSET}_device@{i:05d}", os.urandom(32).hex()) for i in range(key_count)]
+
+    def setup():
+        device.load_evkms_payload(dict(payload, Vectore_c=list(payload["Vectore_c"]),
+                                       Vectore_n=list(payload["Vectore_n"])))
+        for peer_guid, key in keys:
+            device.evkms_state["pairwise_keys"].put(peer_guid, key, "NONCE")
+        wait_until(lambda: device._next_epoch is not None)
+
+    result = timed(lambda: device.advance_epoch(1), repeats, setup=setup)
+    result.update(keys=key_count, vector_size=vector_size)
+    return result
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload if isinstance(payload, bytes) else payload.encode()
+
+
+class FakeClient:
+    """Records publishes instead of sending them; wait_for() blocks until one arrives"""
+
+    def __init__(self):
+        self.published = []
+        self._cond = threading.Condition()
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self._cond:
+            self.published.append(FakeMessage(topic, payload))
+            self._cond.notify_all()
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+    def wait_for(self, fragment, timeout=30):
+        """Pop the first published message whose topic contains fragment"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                for msg in self.published:
+                    if fragment in msg.topic:
+                        self.published.remove(msg)
+                        return msg
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No publish on *{fragment}* within {timeout}s")
+                self._cond.wait(remaining)
+
+
+def wait_until(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Round trip did not complete")
+        time.sleep(0.0005)
+
+
+def bench_round_trip(repeats):
+    """A broadcasts discovery, B derives and answers, A derives and verifies: two PBKDF2 runs"""
+    payload_a, payload_b = provisioning_payload(16, 0), provisioning_payload(16, 1)
+    payload_b["secret_i"] = payload_a["Vectore_c"][1]
+    a = DeviceContext(f"{SUBSET}_device@01", SUBSET, snapshot_path="")
+    b = DeviceContext(f"{SUBSET}_device@02", SUBSET, snapshot_path="")
+    a.device.load_evkms_payload(payload_a)
+    b.device.load_evkms_payload(payload_b)
+    # Every repeat is a fresh handshake with the same peer: no per-peer budget
+    b.discovery_filter = DiscoveryFilter(rate=0)
+    client_a, client_b = FakeClient(), FakeClient()
+
+    def reset():
+        for ctx, peer in ((a, b), (b, a)):
+            ctx.device.remove_pairwise_key(peer.device_guid)
+            ctx.reported_key_establishment.pop(peer.device_guid, None)
+
+    def round_trip():
+        broadcast_discovery(client_a, a)
+        handle_discovery(client_b, b, client_a.wait_for("/discovery"))
+        handle_key_response(client_a, a, client_b.wait_for("/key_response"))
+        wait_until(lambda: b.device_guid in a.device.evkms_state["pairwise_keys"])
+
+    return timed(round_trip, repeats, setup=reset)
+
+
+def run(scale=1.0):
+    def n(count):
+        return max(1, int(count * scale))
+
+    return {
+        "compute_pairwise_key": bench_compute_pairwise_key(n(20)),
+        "compute_discovery_digest": bench_compute_discovery_digest(n(20_000)),
+        "verify_discovery_digest": bench_verify_discovery_digest(n(20_000)),
+        "refresh_all_pairwise_keys": bench_refresh_all(n(20), n(10_000)),
+        "load_evkms_payload": bench_load_evkms_payload(n(10), n(50_000)),
+        "advance_epoch": bench_advance_epoch(n(10), n(10_000), n(1_000)),
+        "discovery_round_trip": bench_round_trip(n(10)),
+    }
+
+
+def run_quietly(scale=1.0):
+    """run() with the device logs (which print per operation) swallowed"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run(scale)
+        flush_logs()
+    return results
+
+
+if __name__ == "__main__":
+    scale = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    for name, r in run_quietly(scale).items():
+        extra = "  ".join(f"{k}={v}" for k, v in r.items() if not k.endswith("_us") and k != "runs")
+        print(f"{name:28s} median {r['median_us']:12.2f} us   min {r['min_us']:12.2f} us   "
+              f"({r['runs']} runs) {extra}")
@@ -0,0 +1,68 @@
+# Memory benchmark: PairwiseKeyStore vs the previous dict-of-dicts key table
+#
+#   python benchmarks/bench_key_store_memory.py [peer counts...]
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.pairwise_key_store import PairwiseKeyStore
+from lib.utils import generate_nonce
+
+
+def sample_entries(peers):
+    """(peer_guid, key_hex, nonce) triples like the handshake produces"""
+    return [(f"LR01_device@{i:05d}", os.urandom(32).hex(), generate_nonce()) for i in range(peers)]
+
+
+def build_dict_table(entries):
+    table = {}
+    for guid, key_hex, nonce in entries:
+        # Fresh strings, as they arrive from json.loads / hexdigest()
+        table["".join(guid)] = {"key": "".join(key_hex), "nonce": "".join(nonce), "timestamp": time.time()}
+    return table
+
+
+def build_store(entries):
+    store = PairwiseKeyStore()
+    for guid, key_hex, nonce in entries:
+        store.put("".join(guid), key_hex, "".join(nonce))
+    return store
+
+
+def measure(builder, entries):
+    gc.collect()
+    tracemalloc.start()
+    table = builder(entries)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del table
+    return current
+
+
+def run(peer_counts=(1_000, 10_000, 100_000)):
+    results = {}
+    for peers in peer_counts:
+        entries = sample_entries(peers)
+        dict_bytes = measure(build_dict_table, entries)
+        store_bytes = measure(build_store, entries)
+        results[peers] = {
+            "dict_of_dicts_bytes": dict_bytes,
+            "key_store_bytes": store_bytes,
+            "dict_bytes_per_peer": dict_bytes / peers,
+            "store_bytes_per_peer": store_bytes / peers,
+        }
+    return results
+
+
+if __name__ == "__main__":
+    counts = [int(a) for a in sys.argv[1:]] or [1_000, 10_000, 100_000]
+    print(f"{'peers':>8} {'dict-of-dicts':>15} {'PairwiseKeyStore':>18} {'ratio':>7}")
+    for peers, r in run(counts).items():
+        print(f"{peers:>8} {r['dict_of_dicts_bytes'] / 1024:>12.1f} KiB {r['key_store_bytes'] / 1024:>15.1f} KiB "
+              f"{r['key_store_bytes'] / r['dict_of_dicts_bytes']:>6.0%}   "
+              f"({r['dict_bytes_per_peer']:.0f} -> {r['store_bytes_per_peer']:.0f} B/peer)")
@@ -0,0 +1,80 @@
+# Wire codec benchmark: binary vs JSON for discovery and key-response messages
+#
+#   python benchmarks/bench_wire_codec.py [iterations]
+
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.kdf import DEFAULT_KDF
+from lib.utils import generate_nonce, compute_discovery_digest, compute_pairwise_digest
+from lib.wire_codec import encode_discovery, decode_discovery, encode_key_response, decode_key_response, WIRE_VERSION
+
+
+def sample_messages():
+    nonce = generate_nonce()
+    discovery = {
+        "guid": "LR01_device@07",
+        "subset": "LR01",
+        "nonce": nonce,
+        "digest": compute_discovery_digest("secret-7", "LR01_device@07", nonce),
+        "kdf": DEFAULT_KDF,
+    }
+    key_response = {
+        "source_guid": "LR01_device@12",
+        "target_guid": "LR01_device@07",
+        "original_nonce": nonce,
+        "digest": compute_pairwise_digest("a" * 64, f"LR01_device@07LR01_device@12{nonce}"),
+        "timestamp": time.time(),
+        "kdf": DEFAULT_KDF,
+    }
+    return discovery, key_response
+
+
+def per_op_us(fn, iterations):
+    return timeit.timeit(fn, number=iterations) / iterations * 1e6
+
+
+def run(iterations=50_000):
+    discovery, key_response = sample_messages()
+    results = {}
+
+    cases = {
+        "discovery": (
+            discovery,
+            lambda m: json.dumps(dict(m, wire=WIRE_VERSION)).encode(), json.loads,
+            encode_discovery, decode_discovery,
+        ),
+        "key_response": (
+            key_response,
+            lambda m: json.dumps(dict(m, wire=WIRE_VERSION)).encode(), json.loads,
+            lambda m: encode_key_response(m, "LR01"), decode_key_response,
+        ),
+    }
+
+    for name, (msg, json_enc, json_dec, bin_enc, bin_dec) in cases.items():
+        json_payload = json_enc(msg)
+        bin_payload = bin_enc(msg)
+        results[name] = {
+            "json_bytes": len(json_payload),
+            "binary_bytes": len(bin_payload),
+            "json_encode_us": per_op_us(lambda: json_enc(msg), iterations),
+            "json_decode_us": per_op_us(lambda: json_dec(json_payload), iterations),
+            "binary_encode_us": per_op_us(lambda: bin_enc(msg), iterations),
+            "binary_decode_us": per_op_us(lambda: bin_dec(bin_payload), iterations),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    for name, r in run(iterations).items():
+        print(f"{name}:")
+        print(f"  size    json {r['json_bytes']:4d} B   binary {r['binary_bytes']:4d} B "
+              f"({r['binary_bytes'] / r['json_bytes']:.0%})")
+        print(f"  encode  json {r['json_encode_us']:6.2f} us   binary {r['binary_encode_us']:6.2f} us")
+        print(f"  decode  json {r['json_decode_us']:6.2f} us   binary {r['binary_decode_us']:6.2f} us")
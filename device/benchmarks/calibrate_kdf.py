@@ -0,0 +1,123 @@
+# Measures pairwise key derivation on this host and recommends KDF parameters that fit a
+# per-handshake latency target; put the recommended spec in the subset's provisioning "kdf"
+#
+#   python benchmarks/calibrate_kdf.py [--target-ms 200] [--peers N] [--workers N] [--json]
+#
+# A handshake runs two derivations back to back (responder, then initiator), so each
+# derivation gets half the target. With --peers it also estimates how long a full-mesh
+# burst (one derivation per peer, spread over --workers pool threads) takes.
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.kdf import DEFAULT_KDF, get_kdf
+
+
+MATERIAL = b"calibration" * 16
+SALT = b"NONCE_0011223344556677"
+
+
+def derive_seconds(spec, min_time=0.2, max_runs=50):
+    """Median seconds per derivation, running for at least min_time"""
+    kdf = get_kdf(spec)
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < max_runs and (len(samples) < 3 or time.perf_counter() - started < min_time):
+        t = time.perf_counter()
+        kdf.derive(MATERIAL, SALT)
+        samples.append(time.perf_counter() - t)
+    return statistics.median(samples)
+
+
+def calibrate_pbkdf2(budget):
+    # Cost is linear in iterations: time a known count and scale, leaving 10% for noise
+    probe = 20_000
+    per_iteration = derive_seconds(f"pbkdf2-sha256:{probe}") / probe
+    iterations = int(budget * 0.9 / per_iteration) // 1000 * 1000
+    if iterations < 1000:
+        return None
+    spec = f"pbkdf2-sha256:{iterations}"
+    return {"spec": spec, "derive_ms": derive_seconds(spec) * 1000}
+
+
+def calibrate_scrypt(budget, r=8, p=1):
+    # Double n while the next size still fits; scrypt's cost is roughly linear in n
+    best = None
+    n = 1024
+    while n <= 2 ** 20:
+        spec = f"scrypt:{n}:{r}:{p}"
+        seconds = derive_seconds(spec, min_time=0.05, max_runs=5)
+        if seconds > budget:
+            break
+        best = {"spec": spec, "derive_ms": seconds * 1000, "memory_mib": 128 * r * n / 2 ** 20}
+        if seconds * 2.2 > budget:
+            break
+        n *= 2
+    return best
+
+
+def calibrate(target_ms, workers=1, peers=0):
+    budget = target_ms / 1000 / 2
+    default_ms = derive_seconds(DEFAULT_KDF) * 1000
+    results = {
+        "target_handshake_ms": target_ms,
+        "budget_per_derivation_ms": budget * 1000,
+        "current_default": {"spec": DEFAULT_KDF, "derive_ms": default_ms,
+                            "handshake_ms": default_ms * 2, "meets_target": default_ms * 2 <= target_ms},
+        "candidates": {
+            "pbkdf2": calibrate_pbkdf2(budget),
+            "scrypt": calibrate_scrypt(budget),
+            "hkdf": {"spec": "hkdf-sha256", "derive_ms": derive_seconds("hkdf-sha256") * 1000},
+        },
+    }
+    for candidate in results["candidates"].values():
+        if candidate:
+            candidate["handshake_ms"] = candidate["derive_ms"] * 2
+            if peers:
+                # Everyone discovering at once: one derivation per peer over the pool
+                candidate["full_mesh_burst_s"] = candidate["derive_ms"] / 1000 * peers / max(1, workers)
+
+    # Prefer a memory-hard KDF, then stretching, and only fall back to plain HKDF
+    for name in ("scrypt", "pbkdf2", "hkdf"):
+        if results["candidates"][name]:
+            results["recommended"] = results["candidates"][name]["spec"]
+            break
+    return results
+
+
+def print_report(results):
+    print(f"Target {results['target_handshake_ms']:.0f} ms per handshake "
+          f"({results['budget_per_derivation_ms']:.1f} ms per derivation)")
+    current = results["current_default"]
+    print(f"  current  {current['spec']:28s} {current['handshake_ms']:10.1f} ms/handshake  "
+          f"{'ok' if current['meets_target'] else 'OVER TARGET'}")
+    for name, candidate in results["candidates"].items():
+        if not candidate:
+            print(f"  {name:8s} {'(cannot meet target)':28s}")
+            continue
+        extra = f"  burst {candidate['full_mesh_burst_s']:.1f} s" if "full_mesh_burst_s" in candidate else ""
+        memory = f"  {candidate['memory_mib']:.0f} MiB" if "memory_mib" in candidate else ""
+        print(f"  {name:8s} {candidate['spec']:28s} {candidate['handshake_ms']:10.1f} ms/handshake{memory}{extra}")
+    print(f"Recommended provisioning \"kdf\": {results['recommended']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recommend KDF parameters for a handshake latency target")
+    parser.add_argument("--target-ms", type=float, default=200.0, help="per-handshake derivation budget (ms)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("KDF_WORKERS", "2")),
+                        help="KDF pool size, for the burst estimate")
+    parser.add_argument("--peers", type=int, default=0, help="subset size, to estimate a full-mesh burst")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = calibrate(args.target_ms, args.workers, args.peers)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
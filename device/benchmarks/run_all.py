@@ -0,0 +1,113 @@
+# Runs every device benchmark and writes one JSON document, so results can be kept per
+# commit and compared
+#
+#   python benchmarks/run_all.py [--scale S] [--output results.json]
+#   python benchmarks/run_all.py --compare baseline.json current.json [--threshold 0.10]
+#
+# --compare exits non-zero if any timing got slower than the threshold (default 10%)
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_device_paths
+import bench_key_store_memory
+import bench_wire_codec
+from lib.log_handler import flush_logs
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_all(scale=1.0):
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = {
+            "device_paths": bench_device_paths.run(scale),
+            "wire_codec": bench_wire_codec.run(max(1, int(50_000 * scale))),
+            "key_store_memory": {
+                str(peers): r for peers, r in bench_key_store_memory.run((max(1, int(10_000 * scale)),)).items()
+            },
+        }
+        flush_logs()
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "timestamp": time.time(),
+            "scale": scale,
+        },
+        "results": results,
+    }
+
+
+def flatten(results, prefix=""):
+    """{"a": {"b_us": 1}} -> {"a.b_us": 1}, numeric leaves only"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def is_cost(metric):
+    """Metrics where bigger is worse: timings and sizes. The suite's median is the one compared."""
+    leaf = metric.rsplit(".", 1)[-1]
+    if leaf in ("min_us", "mean_us"):
+        return False
+    return leaf.endswith("_us") or leaf.endswith("_bytes") or leaf.endswith("_per_peer")
+
+
+def compare(baseline, current, threshold):
+    old, new = flatten(baseline["results"]), flatten(current["results"])
+    regressions = 0
+    print(f"{'metric':60s} {'baseline':>12s} {'current':>12s} {'change':>8s}")
+    for metric in sorted(old.keys() & new.keys()):
+        if not is_cost(metric) or old[metric] == 0:
+            continue
+        change = new[metric] / old[metric] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{metric:60s} {old[metric]:12.2f} {new[metric]:12.2f} {change:+8.1%}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Device benchmark suite")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for repeat counts and sizes")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="compare two result files")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown before flagging")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.threshold) else 0)
+
+    document = json.dumps(run_all(args.scale), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(document + "\n")
+    else:
+        print(document)
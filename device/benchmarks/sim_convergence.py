@@ -0,0 +1,230 @@
+# Subset convergence simulation: N devices running the real handlers against the
+# in-process loopback broker, timed until every pair holds a key
+#
+#   python benchmarks/sim_convergence.py [devices ...] [--latency S] [--jitter S] [--loss P]
+#                                        [--kdf-iterations N] [--kdf SPEC] [--interval MIN MAX]
+#                                        [--settle S] [--speculative] [--json]
+#
+# e.g. python benchmarks/sim_convergence.py 10 100 1000 --loss 0.01 --latency 0.005
+#
+# 1000 devices is ~1M key responses: about 15 minutes on one core with --kdf hkdf-sha256
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time a subset to full pairwise key mesh, no network")
+    parser.add_argument("devices", nargs="*", type=int, default=[10, 100])
+    parser.add_argument("--latency", type=float, default=0.0, help="broker delivery latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra uniform random latency (s)")
+    parser.add_argument("--loss", type=float, default=0.0, help="per-delivery loss probability")
+    parser.add_argument("--kdf-iterations", type=int, default=1000,
+                        help="PBKDF2 iterations (production uses 100000)")
+    parser.add_argument("--kdf", default=None,
+                        help="KDF spec to provision, e.g. hkdf-sha256 (default: PBKDF2 with --kdf-iterations)")
+    parser.add_argument("--interval", type=float, nargs=2, default=(5.0, 10.0), metavar=("MIN", "MAX"),
+                        help="discovery broadcast interval range (s)")
+    parser.add_argument("--settle", type=float, default=0.0,
+                        help="keep running this long after full mesh, counting the discoveries still sent")
+    parser.add_argument("--speculative", action="store_true",
+                        help="derive keys for our nonces before the responses arrive (SPECULATIVE_KDF=1)")
+    parser.add_argument("--timeout", type=float, default=600.0, help="give up after this many seconds")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    return parser.parse_args()
+
+
+def apply_settings(kdf_iterations=1000, interval=(5.0, 10.0), speculative=False):
+    """Config is read when lib is first imported, so the simulation knobs go into the
+    environment before simulate() loads it; settings already in the environment win"""
+    os.environ.setdefault("KDF_ITERATIONS", str(kdf_iterations))
+    os.environ.setdefault("DISCOVERY_INTERVAL_MIN", str(interval[0]))
+    os.environ.setdefault("DISCOVERY_INTERVAL_MAX", str(interval[1]))
+    os.environ.setdefault("METRICS_ENABLED", "1")  # for the handshake latency histogram
+    if speculative:
+        os.environ["SPECULATIVE_KDF"] = "1"
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+SUBSET = "SIM"
+GATEWAY = "gw-sim"
+
+
+def topic_class(topic):
+    """Last topic level, with per-device status and config topics folded together"""
+    return topic.rsplit("/", 1)[-1]
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def simulate(devices, latency=0.0, jitter=0.0, loss=0.0, timeout=600.0, seed=None, settle=0.0, kdf=None):
+    from lib.device_context import DeviceContext
+    from lib.evkms_core import kdf_admission
+    from lib.loopback_broker import LoopbackBroker, LoopbackClient
+    from lib.metrics import histogram_quantile, merge_histograms
+    from lib.mqtt_handler import setup_mqtt
+
+    broker = LoopbackBroker(latency=latency, jitter=jitter, loss=loss, seed=seed)
+
+    messages = {}
+    publish = broker.publish
+
+    def counting_publish(topic, payload, qos=0, retain=False):
+        kind = topic_class(topic)
+        messages[kind] = messages.get(kind, 0) + 1
+        return publish(topic, payload, qos, retain)
+
+    broker.publish = counting_publish
+
+    # Gateway stand-in: provisions every device and collects their status events
+    status_events = {}
+
+    def on_status(client, userdata, msg):
+        event = json.loads(msg.payload)
+        for e in event.get("events", [event]):
+            status_events[e["status_type"]] = status_events.get(e["status_type"], 0) + 1
+
+    gateway = LoopbackClient(broker, GATEWAY)
+    gateway.on_message = on_status
+    gateway.connect()
+    gateway.subscribe("iot_network/+/devices/+/status", qos=1)
+
+    secrets = [os.urandom(16).hex() for _ in range(devices)]
+    width = max(2, len(str(devices)))
+    contexts = []
+    clients = []
+    for i in range(devices):
+        ctx = DeviceContext(f"{SUBSET}_device@{i + 1:0{width}d}", SUBSET, snapshot_path="")
+        client = setup_mqtt(ctx, LoopbackClient(broker, ctx.device_guid), run_forever=False)
+        contexts.append(ctx)
+        clients.append(client)
+
+    # Devices subscribe from on_connect; provisioning sent before that would be lost
+    deadline = time.perf_counter() + timeout
+    while not all(client.subscriptions for client in clients) and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+
+    for i, ctx in enumerate(contexts):
+        gateway.publish(f"iot_network/{GATEWAY}/devices/{ctx.device_guid}/config", json.dumps({
+            "secret_i": secrets[i],
+            "Vectore_p": [],
+            "Vectore_c": secrets,
+            "Vectore_n": [],
+            "alpha": 5,
+            "kdf": kdf,
+            "taskId": f"sim-{i}",
+        }), qos=1)
+
+    expected = devices * (devices - 1)
+    keys = 0
+    converged = None
+    while time.perf_counter() - started < timeout:
+        keys = sum(len(ctx.device.evkms_state["pairwise_keys"]) for ctx in contexts)
+        if keys >= expected:
+            converged = time.perf_counter() - started
+            break
+        time.sleep(0.02)
+
+    cpu = time.process_time() - cpu_started
+
+    # Steady state: with the mesh complete, discovery should go quiet
+    discoveries_at_mesh = messages.get("discovery", 0)
+    if converged is not None and settle > 0:
+        time.sleep(settle)
+
+    # Devices the provisioning never reached can't key with anyone; counted apart so they
+    # aren't mistaken for handshake failures
+    provisioned = sum(1 for ctx in contexts if ctx.device.evkms_state["secret_i"])
+
+    # Keys the peer has shown it holds too; discovery only goes quiet once all of them are
+    confirmed = sum(1 for ctx in contexts for _, record in ctx.device.evkms_state["pairwise_keys"].items()
+                    if record.confirmed)
+
+    for ctx, client in zip(contexts, clients):
+        ctx.scheduler.cancel_all()
+        client.disconnect()
+    gateway.disconnect()
+
+    handshake = merge_histograms(ctx.metrics.handshake_seconds for ctx in contexts if ctx.metrics.enabled)
+    puback = merge_histograms(ctx.metrics.puback_seconds for ctx in contexts if ctx.metrics.enabled)
+    speculative = {
+        name: sum(getattr(ctx.metrics, f"speculative_{name}").value for ctx in contexts if ctx.metrics.enabled)
+        for name in ("started", "hits", "requeued", "misses")
+    }
+
+    outbound = {
+        name: sum(ctx.outbound.stats()[name] for ctx in contexts)
+        for name in ("sent", "acked", "coalesced", "dropped", "ack_timeouts")
+    }
+
+    return {
+        "devices": devices,
+        "converged": converged is not None,
+        "provisioned": provisioned,
+        "time_to_full_mesh_s": converged,
+        "keys": keys,
+        "confirmed_keys": confirmed,
+        "expected_keys": expected,
+        "cpu_s": cpu,
+        "messages": messages,
+        "discoveries_after_mesh": messages.get("discovery", 0) - discoveries_at_mesh,
+        "status_events": status_events,
+        "handshake_p50_ms": _ms(histogram_quantile(handshake, 0.5)),
+        "handshake_p95_ms": _ms(histogram_quantile(handshake, 0.95)),
+        "puback_p95_ms": _ms(histogram_quantile(puback, 0.95)),
+        "speculative": speculative,
+        "outbound": outbound,
+        "broker": broker.stats(),
+        "kdf_admission": kdf_admission.stats(),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    apply_settings(args.kdf_iterations, args.interval, args.speculative)
+    from lib.log_handler import flush_logs
+
+    results = []
+    for devices in args.devices:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            result = simulate(devices, args.latency, args.jitter, args.loss, args.timeout, args.seed, args.settle,
+                              args.kdf)
+            flush_logs()
+        results.append(result)
+        if not args.json:
+            mesh = (f"{result['time_to_full_mesh_s']:.2f} s" if result["converged"]
+                    else f"not reached ({result['keys']}/{result['expected_keys']} keys, "
+                         f"{devices - result['provisioned']} unprovisioned)")
+            print(f"{devices:5d} devices  full mesh {mesh:>12}  cpu {result['cpu_s']:8.2f} s  "
+                  f"published {result['broker']['published']:8d}  delivered {result['broker']['delivered']:9d}  "
+                  f"confirmed {result['confirmed_keys']:7d}  {result['messages']}"
+                  + (f"  handshake p50 {result['handshake_p50_ms']:.1f} ms p95 {result['handshake_p95_ms']:.1f} ms"
+                     if result["handshake_p50_ms"] is not None else "")
+                  + (f"  discoveries after mesh {result['discoveries_after_mesh']}" if args.settle else ""))
+
+    if args.json:
+        print(json.dumps({
+            "params": {
+                "latency": args.latency,
+                "jitter": args.jitter,
+                "loss": args.loss,
+                "kdf_iterations": int(os.environ["KDF_ITERATIONS"]),
+                "kdf": args.kdf,
+                "interval": list(args.interval),
+                "settle": args.settle,
+                "speculative": args.speculative,
+            },
+            "results": results,
+        }, indent=2))
@@ -0,0 +1,43 @@
+import argparse
+import json
+import os
+import sys
+
+from lib.config import FARM_REPORT_INTERVAL, FARM_WORKERS, MQTT_BROKER
+from lib.farm import run_farm
+from lib.fleet import load_roster
+
+
+# Run a roster across worker processes, one shard of whole subsets each:
+#   python farm_main.py roster.csv [--workers N] [--duration S] [--report farm_report.json]
+#   python farm_main.py roster.csv --loopback --kdf-iterations 1000    (no broker or gateway)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated device farm across worker processes")
+    parser.add_argument("roster", nargs="?", default=os.getenv("FLEET_ROSTER", "roster.csv"))
+    parser.add_argument("--workers", type=int, default=FARM_WORKERS, help="worker processes (0 = one per CPU)")
+    parser.add_argument("--duration", type=float, default=0, help="stop after this many seconds (0 = Ctrl+C)")
+    parser.add_argument("--interval", type=float, default=FARM_REPORT_INTERVAL, help="progress/report interval (s)")
+    parser.add_argument("--broker", default=MQTT_BROKER)
+    parser.add_argument("--loopback", action="store_true",
+                        help="in-process broker per worker, subsets provisioned locally instead of by the gateway")
+    parser.add_argument("--latency", type=float, default=0.0, help="loopback delivery latency (s)")
+    parser.add_argument("--kdf", default=None, help="KDF spec to provision in loopback mode")
+    parser.add_argument("--kdf-iterations", type=int, default=None, help="default PBKDF2 iterations in loopback mode")
+    parser.add_argument("--report", help="write the aggregated JSON report here")
+    args = parser.parse_args()
+
+    roster = load_roster(args.roster)
+    print(f"Starting device farm from {args.roster} ({len(roster)} devices)")
+    report = run_farm(roster, args.workers, args.duration, args.interval, args.broker,
+                      args.loopback, args.latency, args.kdf, args.kdf_iterations)
+    if report is None:
+        print("No worker reported any stats", file=sys.stderr)
+        sys.exit(1)
+
+    document = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(document + "\n")
+        print(f"Report written to {args.report}")
+    else:
+        print(document)
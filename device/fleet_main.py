@@ -0,0 +1,17 @@
+import asyncio
+import os
+import sys
+
+from lib.config import MQTT_BROKER
+from lib.fleet import run_fleet
+
+
+# Run many simulated devices in one process:
+#   python fleet_main.py roster.csv
+if __name__ == "__main__":
+    roster_path = sys.argv[1] if len(sys.argv) > 1 else os.getenv("FLEET_ROSTER", "roster.csv")
+    print(f"Starting device fleet from {roster_path}")
+    try:
+        asyncio.run(run_fleet(roster_path, MQTT_BROKER))
+    except KeyboardInterrupt:
+        pass
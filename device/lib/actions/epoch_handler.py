@@ -0,0 +1,45 @@
+import time
+
+from lib.actions.provisioning_handler import apply_pending_provisioning_delta, request_provisioning_resync
+
+
+def handle_epoch_advance(client, ctx, data):
+    """Subset-wide epoch switch from the gateway: rotate the vectors and migrate every
+    pairwise key in place. A device that can't follow (missed an epoch or never got Vn)
+    asks for its full provisioning instead, and rediscovers from there. The broadcast
+    carries no secrets: the epoch after this one arrives as a delta on our config topic."""
+    device = ctx.device
+    if device.is_this_device_revoked():
+        return
+
+    epoch = data.get("epoch")
+    if not isinstance(epoch, int):
+        ctx.log.error("Received epoch advance without an epoch")
+        return
+
+    reason = device.advance_epoch(epoch, version=data.get("version"))
+    if reason == "stale":
+        return  # redelivery
+    if reason:
+        ctx.log.warning(f"Cannot advance to epoch {epoch} ({reason}), at epoch {device.evkms_state['epoch']}")
+        request_provisioning_resync(client, ctx, f"epoch_{reason}")
+        return
+
+    # The next vector may have overtaken this broadcast
+    apply_pending_provisioning_delta(client, ctx)
+
+    # Keys carried over, so there is only someone new to discover if the subset grew
+    covered, expected = ctx.discovery.coverage()
+    if covered < expected:
+        ctx.discovery.wake("epoch")
+
+    if ctx.discovered_gateway_guid:
+        ctx.status_reporter.report(client, {
+            "deviceGuid": ctx.device_guid,
+            "status_type": "epoch_advanced",
+            "epoch": epoch,
+            "taskId": data.get("taskId"),
+            "keysMigrated": len(device.evkms_state["pairwise_keys"]),
+            "switchDurationMs": round(device.last_epoch_switch_ms, 3),
+            "timestamp": time.time(),
+        })
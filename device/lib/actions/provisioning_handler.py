@@ -0,0 +1,124 @@
+import time
+
+from lib.config import *
+from lib.provisioning import ChunkAssembler
+
+
+def handle_provisioning_message(client, ctx, payload):
+    """Apply one config-topic message: a full provisioning payload, one chunk of a
+    chunked transfer, or a delta against the version we hold.
+
+    Returns the payload that completed new provisioning (so the caller can ack its taskId),
+    or None if nothing was applied yet.
+    """
+    kind = payload.get("type")
+    if kind == "EVKMS_CHUNK":
+        return _handle_chunk(client, ctx, payload)
+
+    if kind == "EVKMS_DELTA":
+        return _handle_delta(client, ctx, payload)
+
+    reason = ctx.device.load_evkms_payload(payload, ctx.discovered_gateway_guid)
+    if reason == "checksum":
+        request_provisioning_resync(client, ctx, reason)
+    return None if reason else payload
+
+
+def _handle_delta(client, ctx, delta):
+    current = ctx.device.evkms_state["provisioning_version"]
+    reason = ctx.device.apply_provisioning_delta(delta, ctx.discovered_gateway_guid)
+    if reason == "gap" and delta.get("version", 0) <= current:
+        return None  # redelivery of a delta we already applied
+    if reason == "gap" and delta.get("baseVersion", 0) > current and ctx.device.evkms_state["secret_i"]:
+        # Ahead of us: most likely the next epoch's vector overtaking the epoch switch it
+        # builds on. Hold it until then; if the switch never comes, resync
+        ctx.pending_provisioning_delta = delta
+        ctx.scheduler.call_later(PROVISIONING_CHUNK_TIMEOUT, lambda: _pending_delta_timed_out(client, ctx, delta),
+                                 key="provisioning_delta")
+        return None
+    if reason:
+        request_provisioning_resync(client, ctx, reason)
+        return None
+
+    if set(delta.get("changes") or {}) <= {"Vn"} and not delta.keys() & {"secret_i", "alpha", "taskId"}:
+        # The next epoch's vector: nothing to ack and no new peers to discover
+        ctx.log.info(f"Received the next epoch's vector (provisioning v{delta['version']})")
+        return None
+    return delta
+
+
+def apply_pending_provisioning_delta(client, ctx):
+    """Retry a delta held by _handle_delta, now that we may have caught up with its base"""
+    delta, ctx.pending_provisioning_delta = ctx.pending_provisioning_delta, None
+    ctx.scheduler.cancel("provisioning_delta")
+    if delta is not None:
+        _handle_delta(client, ctx, delta)
+
+
+def _pending_delta_timed_out(client, ctx, delta):
+    if ctx.pending_provisioning_delta is not delta:
+        return
+    ctx.pending_provisioning_delta = None
+    request_provisioning_resync(client, ctx, "gap")
+
+
+def _handle_chunk(client, ctx, chunk):
+    transfer = ctx.provisioning_transfer
+    if transfer is None or transfer.transfer != chunk.get("transfer"):
+        if chunk.get("version", 0) <= ctx.device.evkms_state["provisioning_version"]:
+            return None  # a late chunk of something we already hold
+        # A new transfer supersedes whatever was in progress
+        transfer = ctx.provisioning_transfer = ChunkAssembler(
+            chunk["transfer"], chunk["version"], chunk["total"], chunk.get("lengths") or {})
+
+    try:
+        transfer.add(chunk)
+    except (KeyError, TypeError, ValueError) as e:
+        ctx.log.warning(f"Dropping provisioning transfer {transfer.transfer}: {e}")
+        _drop_transfer(ctx)
+        request_provisioning_resync(client, ctx, "invalid")
+        return None
+
+    if not transfer.complete():
+        # Restarted by every chunk, so only a transfer that stops making progress times out
+        ctx.scheduler.call_later(PROVISIONING_CHUNK_TIMEOUT,
+                                 lambda: _transfer_timed_out(client, ctx, transfer),
+                                 key="provisioning_transfer")
+        return None
+
+    _drop_transfer(ctx)
+    payload = transfer.payload()
+    ctx.log.info(f"Reassembled provisioning v{transfer.version} from {transfer.total} chunks")
+    reason = ctx.device.load_evkms_payload(payload, ctx.discovered_gateway_guid)
+    if reason == "checksum":
+        request_provisioning_resync(client, ctx, reason)
+    return None if reason else payload
+
+
+def _drop_transfer(ctx):
+    ctx.provisioning_transfer = None
+    ctx.scheduler.cancel("provisioning_transfer")
+
+
+def _transfer_timed_out(client, ctx, transfer):
+    if ctx.provisioning_transfer is not transfer:
+        return
+    ctx.log.warning(f"Provisioning transfer {transfer.transfer} stalled at "
+                    f"{transfer.received}/{transfer.total} chunks")
+    ctx.provisioning_transfer = None
+    request_provisioning_resync(client, ctx, "timeout")
+
+
+def request_provisioning_resync(client, ctx, reason):
+    """Ask the gateway to resend our full provisioning"""
+    if not ctx.discovered_gateway_guid:
+        return
+    ctx.status_reporter.report(client, {
+        "deviceGuid": ctx.device_guid,
+        "subsetGuid": ctx.subset_guid,
+        "status_type": "provisioning_resync",
+        "currentVersion": ctx.device.evkms_state["provisioning_version"],
+        "reason": reason,
+        "timestamp": time.time(),
+    }, flush=True)
+    ctx.log.info(f"Requested provisioning resync ({reason})")
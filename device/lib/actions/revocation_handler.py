@@ -1,53 +1,98 @@
 import json
+import time
 
-from lib.shared_state import reported_key_establishment , device 
-from lib.config import *
-from lib.log_handler import log_revocation, log_error
 
+def handle_revocation_alert(client, ctx, msg_payload):
+    device = ctx.device
+    reported_key_establishment = ctx.reported_key_establishment
 
-def handle_revocation_alert(client, msg_payload):
     try:
         alert_data = json.loads(msg_payload.decode('utf-8'))
-        
-        if alert_data.get("type") == "REVOCATION_ALERT":
+
+        # The gateway sends single revocations as REVOCATION_ALERT for older firmware,
+        # with the list version fields on top
+        if alert_data.get("type") == "REVOCATION_ALERT" and "version" in alert_data:
+            handle_revocation_list(client, ctx, alert_data)
+
+        elif alert_data.get("type") == "REVOCATION_ALERT":
             revoked_guid = alert_data.get("revokedGuid")
             issuer_guid = alert_data.get("issuer")
 
             if not revoked_guid:
-                log_error("Received incomplete revocation alert")
+                ctx.log.error("Received incomplete revocation alert")
                 return
             
             # Immediately blacklist this GUID
             device.add_to_revoked_list(revoked_guid)
+            ctx.metrics.revocations.inc()
+            ctx.discovery.wake("revocation")
             
-            log_revocation(f"Device {revoked_guid} has been revoked by {issuer_guid}")
+            ctx.log.revocation(f"Device {revoked_guid} has been revoked by {issuer_guid}")
 
             # Check if we are the revoked device
-            if revoked_guid == DEVICE_GUID:
+            if revoked_guid == ctx.device_guid:
                 device.set_device_revoked(True)
-                log_revocation(f"⚠️  THIS DEVICE has been revoked by {issuer_guid}")
+                ctx.log.revocation(f"⚠️  THIS DEVICE has been revoked by {issuer_guid}")
                 return
 
             # Delete pairwise key with revoked device
-            if revoked_guid in device.evkms_state["pairwise_keys"]:
-                del device.evkms_state["pairwise_keys"][revoked_guid]
-                log_revocation(f"Deleted pairwise key with revoked device {revoked_guid}")
+            if device.remove_pairwise_key(revoked_guid):
+                ctx.log.revocation(f"Deleted pairwise key with revoked device {revoked_guid}")
 
                 # Clear reporting status
                 if revoked_guid in reported_key_establishment:
                     del reported_key_establishment[revoked_guid]
-                    log_revocation(f"Cleared reporting status for {revoked_guid}")
+                    ctx.log.revocation(f"Cleared reporting status for {revoked_guid}")
 
 
             else:
-                log_revocation(f"No pairwise key found for {revoked_guid} (already cleaned)")
+                ctx.log.revocation(f"No pairwise key found for {revoked_guid} (already cleaned)")
                 
+        elif alert_data.get("type") == "REVOCATION_LIST":
+            handle_revocation_list(client, ctx, alert_data)
+
         else:
-            log_error(f"Received unknown alert type: {alert_data.get('type')}")
+            ctx.log.error(f"Received unknown alert type: {alert_data.get('type')}")
 
     except json.JSONDecodeError:
-        log_error("Received non-JSON message on revocation alert topic")
+        ctx.log.error("Received non-JSON message on revocation alert topic")
     except Exception as e:
-        log_error(f"Error processing revocation alert: {e}")
+        ctx.log.error(f"Error processing revocation alert: {e}")
         import traceback
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
+
+
+def handle_revocation_list(client, ctx, alert_data):
+    """Versioned bulk revocation: a full list ("snapshot") or what changed since
+    baseVersion ("delta"). A delta we can't apply asks the gateway for a snapshot."""
+    device = ctx.device
+    mode = alert_data.get("mode", "delta")
+    version = alert_data.get("version")
+    base_version = alert_data.get("baseVersion", 0)
+    revoked = alert_data.get("revoked") or []
+    # Versions are persisted as unsigned 64-bit in the snapshot
+    if mode not in ("snapshot", "delta") or not all(
+            isinstance(v, int) and not isinstance(v, bool) and 0 <= v < 2 ** 64 for v in (version, base_version)):
+        ctx.log.error("Received malformed revocation list")
+        return
+
+    removed = device.apply_revocation_list(mode, version, base_version, revoked)
+    if removed is None:
+        if ctx.discovered_gateway_guid:
+            ctx.status_reporter.report(client, {
+                "deviceGuid": ctx.device_guid,
+                "subsetGuid": ctx.subset_guid,
+                "status_type": "revocation_resync",
+                "currentVersion": device.evkms_state["known_revoked_peers"].version,
+                "timestamp": time.time(),
+            }, flush=True)
+            ctx.log.revocation("Requested a full revocation list from the gateway")
+        return
+
+    ctx.metrics.revocations.inc(len(revoked))
+    ctx.discovery.wake("revocation")
+    for peer_guid in removed:
+        ctx.reported_key_establishment.pop(peer_guid, None)
+
+    if device.is_this_device_revoked():
+        ctx.log.revocation(f"⚠️  THIS DEVICE is on revocation list v{version}")
@@ -7,6 +7,103 @@ DEVICE_GUID = os.getenv("DEVICE_GUID", "subset1_device@1")
 SUBSET_GUID = os.getenv("SUBSET_IDENTIFIER", "LR01")
 MQTT_BROKER = os.getenv("MQTT_BROKER_URL", "mqtt-broker")
 
+# Logging: level, output format ("color", "plain" or "json") and optional per-category
+# caps in records per second, e.g. "discovery=20,key_mgmt=50"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "color")
+LOG_RATE_LIMITS = os.getenv("LOG_RATE_LIMITS", "")
+
+# Worker threads for PBKDF2 pairwise key derivation (kept off the MQTT network thread)
+KDF_WORKERS = int(os.getenv("KDF_WORKERS", "2"))
+
+# PBKDF2 iterations for pairwise keys when provisioning doesn't pick a KDF (see lib/kdf.py).
+# Every device in a subset must use the same value; lowering it is only meant for
+# simulations (see benchmarks/sim_convergence.py)
+KDF_ITERATIONS = int(os.getenv("KDF_ITERATIONS", "100000"))
+
+# KDF admission: how many derivations may wait for the pool (beyond that the lowest
+# priority is shed), and a process-wide budget in derivations per second (0 = no cap)
+KDF_QUEUE_MAX = int(os.getenv("KDF_QUEUE_MAX", "256"))
+KDF_RATE = float(os.getenv("KDF_RATE", "0"))
+KDF_BURST = int(os.getenv("KDF_BURST", "0"))
+
+# Shed derivations are retried after KDF_RETRY_BASE * 2^attempt seconds (jittered),
+# up to KDF_RETRY_MAX times; a shed discovery is also retried by the peer's next broadcast
+KDF_RETRY_BASE = float(os.getenv("KDF_RETRY_BASE", "2"))
+KDF_RETRY_MAX = int(os.getenv("KDF_RETRY_MAX", "3"))
+
+# Seconds a discovery nonce stays valid, and how many may be outstanding at once
+DISCOVERY_NONCE_TTL = int(os.getenv("DISCOVERY_NONCE_TTL", "60"))
+DISCOVERY_NONCE_CAPACITY = int(os.getenv("DISCOVERY_NONCE_CAPACITY", "256"))
+
+# Inbound discovery filter, checked after the digest and before any derivation: a
+# (source, nonce) seen in the last DISCOVERY_REPLAY_TTL seconds is dropped as a replay,
+# and each peer may trigger at most PEER_KDF_RATE derivations per second (bursts of
+# PEER_KDF_BURST), so one chatty or hostile peer can't monopolize the KDF
+DISCOVERY_REPLAY_TTL = float(os.getenv("DISCOVERY_REPLAY_TTL", "300"))
+DISCOVERY_REPLAY_CAPACITY = int(os.getenv("DISCOVERY_REPLAY_CAPACITY", "4096"))
+PEER_KDF_RATE = float(os.getenv("PEER_KDF_RATE", "0.1"))
+PEER_KDF_BURST = int(os.getenv("PEER_KDF_BURST", "3"))
+
+# Speculative derivation (SPECULATIVE_KDF=1): when we broadcast a discovery nonce, start
+# deriving keys for up to SPECULATIVE_KDF_MAX expected peers we hold no key with, at the
+# lowest KDF priority, so their key responses find the key ready. Spends KDF budget on
+# peers that may never answer; off by default.
+SPECULATIVE_KDF = os.getenv("SPECULATIVE_KDF", "0") == "1"
+SPECULATIVE_KDF_MAX = int(os.getenv("SPECULATIVE_KDF_MAX", "16"))
+
+# Outbound publishes: at most OUTBOUND_INFLIGHT per connection are handed to the MQTT
+# client before their PUBACK (0 = publish directly, unbounded); the rest wait in a queue of
+# at most OUTBOUND_QUEUE_MAX, which sheds metrics, then discovery, then status first when
+# full, and drains key responses first on reconnect. A PUBACK missing for
+# OUTBOUND_ACK_TIMEOUT seconds gives its window slot back
+OUTBOUND_INFLIGHT = int(os.getenv("OUTBOUND_INFLIGHT", "20"))
+OUTBOUND_QUEUE_MAX = int(os.getenv("OUTBOUND_QUEUE_MAX", "1000"))
+OUTBOUND_ACK_TIMEOUT = float(os.getenv("OUTBOUND_ACK_TIMEOUT", "60"))
+
+# Each device picks its discovery broadcast interval uniformly from this range (seconds)
+DISCOVERY_INTERVAL_MIN = float(os.getenv("DISCOVERY_INTERVAL_MIN", "60"))
+DISCOVERY_INTERVAL_MAX = float(os.getenv("DISCOVERY_INTERVAL_MAX", "120"))
+
+# While some expected peers are still un-keyed but no new key was made since the last
+# broadcast, the interval is multiplied by DISCOVERY_BACKOFF_FACTOR per broadcast, up to
+# DISCOVERY_BACKOFF_MAX seconds. With every peer in Vc keyed, discovery stops entirely.
+DISCOVERY_BACKOFF_FACTOR = float(os.getenv("DISCOVERY_BACKOFF_FACTOR", "2"))
+DISCOVERY_BACKOFF_MAX = float(os.getenv("DISCOVERY_BACKOFF_MAX", "3600"))
+
+# A chunked provisioning transfer that stalls this long (seconds) is dropped and a
+# full resync requested from the gateway
+PROVISIONING_CHUNK_TIMEOUT = float(os.getenv("PROVISIONING_CHUNK_TIMEOUT", "30"))
+
+# Discovery/key-response encoding: "auto" negotiates the binary format per peer and
+# falls back to JSON, "json" never sends binary, "binary" always does
+WIRE_FORMAT = os.getenv("WIRE_FORMAT", "auto")
+
+# Status batching: coalesce gateway status events for up to this many seconds
+# (0 = send each event on its own) or until STATUS_BATCH_MAX events are pending
+STATUS_BATCH_WINDOW = float(os.getenv("STATUS_BATCH_WINDOW", "0"))
+STATUS_BATCH_MAX = int(os.getenv("STATUS_BATCH_MAX", "50"))
+
+# Fleet mode: how many simulated devices share one MQTT connection
+FLEET_DEVICES_PER_CONNECTION = int(os.getenv("FLEET_DEVICES_PER_CONNECTION", "250"))
+
+# Farm mode (farm_main.py): worker processes to shard subsets across (0 = one per CPU),
+# and how often each worker reports its stats to the coordinator (seconds)
+FARM_WORKERS = int(os.getenv("FARM_WORKERS", "0"))
+FARM_REPORT_INTERVAL = float(os.getenv("FARM_REPORT_INTERVAL", "5"))
+
+# Metrics: Prometheus text at http://<device>:METRICS_HTTP_PORT/metrics (0 = off) and/or a
+# JSON publish on the metrics topic every METRICS_PUBLISH_INTERVAL seconds (0 = off).
+# Collection is on whenever an exporter is, or with METRICS_ENABLED=1; otherwise it is a no-op
+METRICS_HTTP_PORT = int(os.getenv("METRICS_HTTP_PORT", "0"))
+METRICS_PUBLISH_INTERVAL = float(os.getenv("METRICS_PUBLISH_INTERVAL", "0"))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1" if METRICS_HTTP_PORT or METRICS_PUBLISH_INTERVAL else "0") == "1"
+
+# Warm restarts: append-only snapshot of provisioning and pairwise keys ("" = disabled).
+# "{device_guid}" in the path is replaced per device, which fleet mode needs. The file holds
+# secrets in plaintext and is created readable by the device's user only (0600).
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")
+
 
 
 # MQTT Topics
@@ -24,7 +121,13 @@ DISCOVERY_TOPIC = "iot_network/subsets/{subset_guid}/discovery"
  
 SUBSET_ALERT_TOPIC="iot_network/subsets/{subset_guid}/broadcast_alerts"
 
+# Subset-wide scheduled key refresh from the gateway
+KEY_REFRESH_TOPIC = "iot_network/subsets/{subset_guid}/key_refresh"
+
+
 
+# Per-device metrics snapshots (see lib.metrics)
+METRICS_TOPIC_TEMPLATE = "iot_network/{gateway_guid}/devices/{device_guid}/metrics"
 
 # Targeted response topic for key acknowledgment
 KEY_RESPONSE_TOPIC = "iot_network/devices/{target_guid}/key_response"
\ No newline at end of file
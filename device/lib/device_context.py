@@ -0,0 +1,87 @@
+# Per-device runtime state: one context per device, so many devices can share a process
+
+from lib.config import DISCOVERY_NONCE_TTL, DISCOVERY_NONCE_CAPACITY, SNAPSHOT_PATH, SPECULATIVE_KDF
+from lib.discovery_filter import DiscoveryFilter
+from lib.discovery_pacer import DiscoveryPacer
+from lib.evkms_core import EVKMSDevice
+from lib.expiring_map import ExpiringMap
+from lib.log_handler import DeviceLog
+from lib.metrics import metrics_for
+from lib.outbound import OutboundPublisher
+from lib.scheduler import Scheduler
+from lib.speculative_keys import SpeculativeKeys
+from lib.status_reporter import StatusReporter
+from lib.topic_router import TopicRouter
+
+
+class DeviceContext:
+    def __init__(self, device_guid, subset_guid, timer_backend=None, router=None, snapshot_path=SNAPSHOT_PATH,
+                 outbound=None):
+        self.device_guid = device_guid
+        self.subset_guid = subset_guid
+
+        self.device = EVKMSDevice(device_guid, subset_guid)
+        self.log = DeviceLog(device_guid)
+
+        # Peers whose key establishment was already reported to the gateway
+        self.reported_key_establishment = {}
+
+        # Gateway GUID learned from the config topic, used for status reports
+        self.discovered_gateway_guid = None
+
+        # Our own sent nonces: { 'nonce_value': timestamp } to track active discoveries
+        self.active_discovery_nonces = ExpiringMap(DISCOVERY_NONCE_TTL, DISCOVERY_NONCE_CAPACITY)
+
+        # Chunked provisioning being reassembled (a provisioning.ChunkAssembler), if any
+        self.provisioning_transfer = None
+
+        # A provisioning delta that arrived ahead of the epoch switch it builds on, if any
+        self.pending_provisioning_delta = None
+
+        # Keys derived ahead of the responses to our nonces (SPECULATIVE_KDF), else None
+        self.speculative_keys = SpeculativeKeys(self) if SPECULATIVE_KDF else None
+
+        # Replay and per-peer budget checks in front of discovery-triggered derivations
+        self.discovery_filter = DiscoveryFilter()
+
+        # Wire format version each expected peer has been seen speaking in an authenticated
+        # message (0 = JSON only)
+        self.peer_wire_versions = {}
+
+        # Peers (discovery) or (peer, nonce) pairs (key response) with a KDF job in flight
+        self.pending_key_derivations = set()
+
+        # Topic routes feeding this device; fleet mode shares one router per connection
+        self.router = router or TopicRouter()
+
+        # Bounded, prioritized publish queue; like the router, shared per connection in fleet mode
+        self.outbound = outbound or OutboundPublisher()
+
+        # Discovery ticks and retries; timer_backend is an asyncio loop in
+        # fleet mode, otherwise the process-wide timer thread
+        self.scheduler = Scheduler(timer_backend)
+
+        # When to broadcast discovery next, from how much of the expected mesh is keyed
+        self.discovery = DiscoveryPacer(self)
+
+        # Status events to the gateway, coalesced into status_batch messages when enabled
+        self.status_reporter = StatusReporter(self)
+
+        # Counters/histograms/gauges in the process registry, or no-ops when metrics are off
+        self.metrics = metrics_for(self)
+        self.device.metrics = self.metrics
+
+        if snapshot_path:
+            self.restore_snapshot(snapshot_path.replace("{device_guid}", device_guid))
+
+    def restore_snapshot(self, path):
+        """Warm restart: reload provisioning and keys persisted by an earlier run"""
+        state = self.device.enable_snapshot(path)
+        if state is None:
+            return False
+
+        self.discovered_gateway_guid = state["gateway"]
+        # The gateway already heard about these keys before the restart
+        for peer_guid in state["keys"]:
+            self.reported_key_establishment[peer_guid] = True
+        return True
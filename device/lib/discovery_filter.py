@@ -0,0 +1,66 @@
+# Inbound discovery filter: replayed (source, nonce) pairs and per-peer derivation budgets
+
+import threading
+import time
+
+from lib.config import DISCOVERY_REPLAY_TTL, DISCOVERY_REPLAY_CAPACITY, PEER_KDF_RATE, PEER_KDF_BURST
+from lib.expiring_map import ExpiringMap
+
+
+class DiscoveryFilter:
+    """Decides whether a verified discovery may cost us a key derivation.
+
+    seen(): a (source, nonce) pair already handled within the replay TTL is a QoS-1
+    redelivery or a replay, and never derives twice.
+
+    allow(): each source has a token bucket of PEER_KDF_BURST derivations refilled at
+    PEER_KDF_RATE per second. Only verified discoveries get here, so buckets exist only
+    for genuine Vc peers, and spoofed messages can't drain a real peer's budget.
+    """
+
+    def __init__(self, ttl=DISCOVERY_REPLAY_TTL, capacity=DISCOVERY_REPLAY_CAPACITY,
+                 rate=PEER_KDF_RATE, burst=PEER_KDF_BURST, clock=time.monotonic):
+        self._seen = ExpiringMap(ttl, capacity, clock=clock)
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._clock = clock
+        self._buckets = {}      # source -> [tokens, last refill]
+        self._lock = threading.Lock()
+
+        self.replays = 0
+        self.rate_limited = 0
+
+    def seen(self, source_guid, nonce):
+        """True if this (source, nonce) was already handled; otherwise remembers it"""
+        key = (source_guid, nonce)
+        with self._lock:
+            if key in self._seen:
+                self.replays += 1
+                return True
+            self._seen.add(key)
+            return False
+
+    def allow(self, source_guid):
+        """Take one derivation from the source's budget; False if it is spent (rate 0 = no cap)"""
+        if self.rate <= 0:
+            return True
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(source_guid)
+            if bucket is None:
+                bucket = self._buckets[source_guid] = [float(self.burst), now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+        self.rate_limited += 1
+        return False
+
+    def stats(self):
+        return {
+            "seen": len(self._seen),
+            "replays": self.replays,
+            "rate_limited": self.rate_limited,
+            "peers": len(self._buckets),
+        }
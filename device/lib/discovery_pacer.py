@@ -0,0 +1,136 @@
+# Adaptive discovery schedule: broadcast while peers from Vc are still unconfirmed, back off
+# while nothing changes, and stop once the mesh is complete
+
+import random
+import threading
+
+from lib.config import DISCOVERY_INTERVAL_MIN, DISCOVERY_INTERVAL_MAX, DISCOVERY_BACKOFF_FACTOR, DISCOVERY_BACKOFF_MAX
+from lib.wire_codec import KEY_CONFIRM_WIRE
+
+
+class DiscoveryPacer:
+    """Owns the device's "discovery" scheduler job.
+
+    The expected peer set is every slot of the provisioned Vc except our own, with GUIDs
+    built the way the gateway names a subset's devices (our GUID with the local id
+    swapped). A peer counts as covered once it is revoked or we hold a confirmed key with
+    it: one the peer proved it holds too, by a verified key response to our discovery or
+    a key confirmation after we answered its own. A tentative key (we answered, nothing
+    came back) doesn't count, since the peer may never have received our answer and is
+    waiting on us. Peers not (yet) seen speaking a wire version with key confirmations
+    never send one, so for them any key counts, as before; that includes every peer right
+    after a restart, when keys restored from a snapshot start out unconfirmed.
+
+    Each tick the pacer decides the next interval: the base 60-120 s while coverage is
+    growing, multiplied by DISCOVERY_BACKOFF_FACTOR for every tick without progress
+    (capped at DISCOVERY_BACKOFF_MAX), and no next tick at all at 100% coverage. wake()
+    brings a quiet or backed-off device back to the base schedule.
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.interval = None            # current interval; None while quiet or not started
+        self._broadcast = None
+        self._backoff = 0               # ticks in a row without new coverage
+        self._last_covered = -1
+        self._expected = ([], frozenset(), None)   # (peer GUIDs, as a set, the Vc list they were built from)
+        self._lock = threading.Lock()
+
+    # -------------------- coverage --------------------
+
+    def _roster(self):
+        vector_vc = self.ctx.device.evkms_state["vector_Vc"]
+        expected = self._expected
+        if expected[2] is not vector_vc:
+            prefix, _, own_id = self.ctx.device_guid.rpartition("@")
+            width = len(own_id)
+            peers = [f"{prefix}@{number:0{width}d}" for number in range(1, len(vector_vc) + 1)]
+            peers = [guid for guid in peers if guid != self.ctx.device_guid]
+            expected = self._expected = (peers, frozenset(peers), vector_vc)
+        return expected
+
+    def expected_peers(self):
+        return self._roster()[0]
+
+    def is_expected(self, guid):
+        """Whether guid is one of the expected peers, by the exact GUID spelling"""
+        return guid in self._roster()[1]
+
+    def coverage(self):
+        """(covered, expected) peer counts"""
+        device = self.ctx.device
+        keys = device.evkms_state["pairwise_keys"]
+        wire_versions = self.ctx.peer_wire_versions
+        peers = self.expected_peers()
+        covered = 0
+        for guid in peers:
+            record = keys.get(guid)
+            if record is not None and (record.confirmed or wire_versions.get(guid, 0) < KEY_CONFIRM_WIRE):
+                covered += 1
+            elif device.is_peer_revoked(guid):
+                covered += 1
+        return covered, len(peers)
+
+    # -------------------- schedule --------------------
+
+    def start(self, broadcast, first_delay=None):
+        """(Re)start with broadcast() as the tick action; replaces any earlier schedule"""
+        with self._lock:
+            self._broadcast = broadcast
+            self._backoff, self._last_covered = 0, -1
+            self.interval = random.uniform(DISCOVERY_INTERVAL_MIN, DISCOVERY_INTERVAL_MAX)
+        self.ctx.scheduler.call_later(self.interval if first_delay is None else first_delay, self._tick,
+                                      key="discovery")
+        return self.interval
+
+    def wake(self, reason, delay=None):
+        """Back to the base schedule if discovery went quiet or backed off. Returns True if rescheduled."""
+        with self._lock:
+            if self._broadcast is None:
+                return False  # not connected yet; on_connect starts the schedule
+            if self.interval is not None and self._backoff == 0 and delay is None:
+                return False  # already on the base schedule
+            self._backoff, self._last_covered = 0, -1
+            self.interval = random.uniform(DISCOVERY_INTERVAL_MIN, DISCOVERY_INTERVAL_MAX)
+        self.ctx.scheduler.call_later(random.uniform(1, 5) if delay is None else delay, self._tick,
+                                      key="discovery")
+        self.ctx.log.discovery("Discovery re-activated (%s)", reason)
+        return True
+
+    def _next_interval(self):
+        device = self.ctx.device
+        if device.is_this_device_revoked():
+            return None
+        covered, expected = self.coverage()
+        if not expected:
+            return self.interval  # not provisioned yet: keep the base schedule
+        if covered >= expected:
+            return None
+        if covered > self._last_covered:
+            self._backoff = 0
+        elif self.interval is None or self.interval < DISCOVERY_BACKOFF_MAX:
+            # Not past the cap yet; counting on would only overflow the power below
+            self._backoff += 1
+        self._last_covered = covered
+        base = random.uniform(DISCOVERY_INTERVAL_MIN, DISCOVERY_INTERVAL_MAX)
+        return min(base * DISCOVERY_BACKOFF_FACTOR ** self._backoff, max(DISCOVERY_BACKOFF_MAX, base))
+
+    def _tick(self):
+        with self._lock:
+            broadcast = self._broadcast
+            try:
+                self.interval = self._next_interval()
+            except Exception as e:
+                # Whatever went wrong, a tick that doesn't re-arm ends discovery for good
+                self.ctx.log.error(f"Discovery interval failed ({e}), retrying at the backoff cap")
+                self.interval = DISCOVERY_BACKOFF_MAX
+            interval, backoff = self.interval, self._backoff
+        if interval is None:
+            covered, expected = self.coverage()
+            self.ctx.log.discovery("All %d/%d expected peers confirmed or revoked, discovery quiet", covered, expected)
+            return
+        # Re-arm before broadcasting so a failing broadcast doesn't end the schedule
+        self.ctx.scheduler.call_later(interval, self._tick, key="discovery")
+        if backoff:
+            self.ctx.log.discovery("No new peers confirmed, next discovery in %.0fs (backoff x%d)", interval, backoff)
+        broadcast()
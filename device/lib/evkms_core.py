@@ -2,10 +2,59 @@
 
 import json
 import hashlib
+import hmac
 import time
+from concurrent.futures import ThreadPoolExecutor
+from lib.config import KDF_WORKERS, KDF_QUEUE_MAX, KDF_RATE, KDF_BURST
 from lib.utils import generate_nonce, compute_pairwise_digest, hash_key , get_sorted_guids
 
-from lib.log_handler import log_info, log_key_mgmt, log_warning, log_error
+from lib.kdf import get_kdf
+from lib.kdf_admission import KDFAdmission, PRIORITY_DISCOVERY
+from lib.key_snapshot import KeySnapshot, SnapshotError
+from lib.log_handler import DeviceLog
+from lib.metrics import NULL_METRICS
+from lib.pairwise_key_store import PairwiseKeyStore
+from lib.provisioning import VECTORS, add_entry, format_checksum, provisioning_checksum
+from lib.revocation_list import RevocationList
+from lib.scheduler import _default_timers
+
+
+# Bounded pool shared by every device in the process. hashlib releases the GIL while
+# stretching, so PBKDF2/scrypt run here in parallel with paho's network loop.
+kdf_executor = ThreadPoolExecutor(max_workers=KDF_WORKERS, thread_name_prefix="evkms-kdf")
+
+# Every derivation goes through here: handshake storms queue (responses to our own
+# nonces first) instead of piling onto the pool, within the KDF_RATE budget
+kdf_admission = KDFAdmission(kdf_executor, max_inflight=KDF_WORKERS, max_queue=KDF_QUEUE_MAX,
+                             rate=KDF_RATE, burst=KDF_BURST, timers=_default_timers)
+
+
+def _build_local_id_index(count):
+    # Local ids appear both padded and unpadded in GUIDs ("@05" and "@5")
+    width = len(str(count))
+    index = {}
+    for i in range(count):
+        number = i + 1
+        index[str(number)] = i
+        index[f"{number:02d}"] = i
+        index[f"{number:0{width}d}"] = i
+    return index
+
+
+def _build_epoch(epoch, decoded_vn, own_index):
+    """Verifier state for the epoch in which decoded_vn becomes Vc, plus the nonce that
+    migrates pairwise keys into it: a hash over the new Vc, so only subset members that
+    received it can follow the migration"""
+    nonce = hashlib.sha256(f"evkms-epoch:{epoch}:".encode() + b"".join(decoded_vn)).hexdigest()
+    own = decoded_vn[own_index] if own_index is not None and 0 <= own_index < len(decoded_vn) else None
+    return {
+        "epoch": epoch,
+        "decoded_vc": decoded_vn,
+        "local_id_index": _build_local_id_index(len(decoded_vn)),
+        "own_index": own_index if own is not None else None,
+        "own_proto": hmac.new(own, digestmod=hashlib.sha256) if own is not None else None,
+        "nonce": nonce,
+    }
 
 
 class EVKMSDevice:
@@ -21,27 +70,350 @@ class EVKMSDevice:
             "vector_Vn": [],  # Next subset secrets
             "alpha": 5,       # Security parameter α
             "local_id": None,  # Local identifier in subset
-            "pairwise_keys": {} ,   # {neighbor_guid: {"key": ..., "nonce": ...}}
-            # Track GUIDs revoked by this device or received via alerts
-            "known_revoked_peers": set(),
+            "provisioning_version": 0,  # Gateway's version of our provisioning (0 = unversioned)
+            "epoch": 0,       # Advanced by advance_epoch: Vc -> Vp, Vn -> Vc
+            "pairwise_keys": PairwiseKeyStore(),   # {neighbor_guid: PairwiseKey(key, nonce, timestamp)}
+            # Track GUIDs revoked by this device or received via alerts / revocation lists
+            "known_revoked_peers": RevocationList(),
             
         }
         self.is_revoked = False
+
+        # Pairwise key derivation, set from the provisioning payload's "kdf" (lib/kdf.py)
+        self.kdf = get_kdf()
+
+        # Duration of the last refresh_all_pairwise_keys pass, reported to the gateway
+        self.last_refresh_duration_ms = 0.0
+        # Duration of the last advance_epoch switch
+        self.last_epoch_switch_ms = 0.0
+
+        self.log = DeviceLog(device_guid)
+
+        # When set (fleet mode), KDF completions are handed back to this asyncio loop
+        # instead of running on the pool worker thread
+        self.completion_loop = None
+
+        # Verification material decoded once per provisioning (see _prepare_verifiers)
+        self.decoded_vectors = {"Vp": [], "Vc": [], "Vn": []}
+        self._local_id_index = {}
+        self._own_digest_proto = None
+        self._neighbor_digest_protos = {}
+
+        # Checksum of the current provisioning, computed on first use and then patched by deltas
+        self._provisioning_checksum = None
+
+        # Verifier state for the next epoch, built on the KDF pool whenever Vn changes
+        # (see _precompute_next_epoch); _epoch_generation discards builds made stale meanwhile
+        self._next_epoch = None
+        self._epoch_generation = 0
+        # Nonce of the last epoch switch, for handshakes that finish after it
+        self._last_epoch_nonce = None
+
+        # Replaced by the device context's metrics when they are enabled
+        self.metrics = NULL_METRICS
+
+        # Optional on-disk snapshot (see enable_snapshot); every key change is appended to it
+        self.snapshot = None
     
 
 
-    def load_evkms_payload(self, payload):
-        """Load EVKMS vectors from provisioning payload"""
+    def load_evkms_payload(self, payload, gateway_guid=None):
+        """Load EVKMS vectors from provisioning payload.
+
+        Returns None once loaded, "stale" for a versioned payload older than what we hold
+        (e.g. a retained config arriving after a newer delta), or "checksum" if it doesn't
+        match the checksum it carries.
+        """
+        version = payload.get("version", 0)
+        if version and version < self.evkms_state["provisioning_version"]:
+            self.log.info(f"[EVKMS] Ignoring provisioning v{version}, already at v{self.evkms_state['provisioning_version']}")
+            return "stale"
+        if payload.get("checksum") and format_checksum(provisioning_checksum(payload)) != payload["checksum"]:
+            self.log.warning(f"[EVKMS] Provisioning v{version} checksum mismatch")
+            return "checksum"
+        self._apply_provisioning(payload)
+        if self.snapshot:
+            self.snapshot.record_provisioning(self._provisioning_payload(), gateway_guid)
+        self.log.info("[EVKMS] Loaded provisioning data")
+        return None
+
+    def _apply_provisioning(self, payload):
+        kdf = get_kdf(payload.get("kdf"))  # KDFError leaves the current provisioning in place
         self.evkms_state.update({
             "secret_i": payload["secret_i"],
             "vector_Vp": payload["Vectore_p"],
             "vector_Vc": payload["Vectore_c"],
             "vector_Vn": payload["Vectore_n"],
             "alpha": payload["alpha"],
-            "local_id": self._extract_local_id()
+            "local_id": self._extract_local_id(),
+            "provisioning_version": payload.get("version", 0),
+            "epoch": payload.get("epoch", 0),
         })
-        print(f"\033[92m[INFO][EVKMS] Loaded provisioning data for {self.device_guid}\033[0m")
-    
+        self.kdf = kdf
+        self._provisioning_checksum = None
+        self._prepare_verifiers()
+
+    def _provisioning_payload(self):
+        """The provisioning fields we keep, in the gateway's payload shape"""
+        state = self.evkms_state
+        if state["secret_i"] is None:
+            return None
+        return {
+            "secret_i": state["secret_i"],
+            "Vectore_p": state["vector_Vp"],
+            "Vectore_c": state["vector_Vc"],
+            "Vectore_n": state["vector_Vn"],
+            "alpha": state["alpha"],
+            "kdf": self.kdf.id,
+            "version": state["provisioning_version"],
+            "epoch": state["epoch"],
+        }
+
+    def provisioning_checksum(self):
+        """Checksum of the provisioning we hold, in the gateway's hex form"""
+        if self._provisioning_checksum is None:
+            self._provisioning_checksum = provisioning_checksum(self._provisioning_payload())
+        return format_checksum(self._provisioning_checksum)
+
+    def apply_provisioning_delta(self, delta, gateway_guid=None, record=True):
+        """Patch only the changed vector entries (and secret_i / alpha if present).
+
+        Returns None once applied, or why it wasn't: "gap" if the delta isn't based on our
+        version, "invalid" if an index is out of range, "checksum" if the patched state
+        doesn't match the gateway's (the patch is rolled back). Any of these means we need
+        a full resync.
+        """
+        state = self.evkms_state
+        if state["secret_i"] is None or delta.get("baseVersion") != state["provisioning_version"]:
+            return "gap"
+
+        self.provisioning_checksum()
+        checksum = self._provisioning_checksum
+        undo = []   # (vector or None for a scalar, index or key, old value)
+        resized = False
+        try:
+            for name, changes in (delta.get("changes") or {}).items():
+                vector = state[VECTORS[name][0]]
+                # Ascending, so entries appended to a growing subset arrive in order
+                for index, secret in sorted((int(i), s) for i, s in changes.items()):
+                    if index == len(vector):
+                        vector.append(secret)
+                        undo.append((vector, index, None))
+                        resized = True
+                        checksum = add_entry(checksum, name, index, None, secret)
+                    elif 0 <= index < len(vector):
+                        undo.append((vector, index, vector[index]))
+                        checksum = add_entry(checksum, name, index, vector[index], secret)
+                        vector[index] = secret
+                    else:
+                        raise IndexError(f"{name}[{index}] outside {len(vector)} entries")
+            for key, name in (("secret_i", "i"), ("alpha", "alpha")):
+                if key in delta:
+                    undo.append((None, key, state[key]))
+                    checksum = add_entry(checksum, name, 0, state[key], delta[key])
+                    state[key] = delta[key]
+        except (KeyError, IndexError, ValueError) as e:
+            self.log.warning("Rejected provisioning delta %s->%s: %s", delta.get("baseVersion"), delta.get("version"), e)
+            self._undo_delta(undo)
+            return "invalid"
+
+        if delta.get("checksum") and format_checksum(checksum) != delta["checksum"]:
+            self.log.warning("Provisioning delta %s->%s checksum mismatch", delta.get("baseVersion"), delta.get("version"))
+            self._undo_delta(undo)
+            return "checksum"
+
+        state["provisioning_version"] = delta["version"]
+        self._provisioning_checksum = checksum
+        self._refresh_verifiers(undo, resized or "secret_i" in delta)
+        if record and self.snapshot:
+            self.snapshot.record_provisioning_delta(delta)
+        self.log.info("[EVKMS] Applied provisioning delta v%s->v%s (%d entries)",
+                      delta["baseVersion"], delta["version"], len(undo))
+        return None
+
+    def _undo_delta(self, undo):
+        for target, index, old in reversed(undo):
+            if target is None:
+                self.evkms_state[index] = old
+            elif old is None:
+                target.pop()
+            else:
+                target[index] = old
+
+    def _refresh_verifiers(self, changed, rebuild):
+        """Bring the decoded verification material up to date after a delta, touching only
+        the changed entries unless a vector grew or our own secret changed"""
+        if rebuild:
+            self._prepare_verifiers()
+            return
+        names = {id(self.evkms_state[state_key]): name for name, (state_key, _) in VECTORS.items()}
+        for vector, index, _ in changed:
+            if vector is None:
+                continue
+            name = names[id(vector)]
+            self.decoded_vectors[name][index] = vector[index].encode()
+            if name == "Vc":
+                self._neighbor_digest_protos.pop(index, None)
+        self._precompute_next_epoch()
+
+    def enable_snapshot(self, path):
+        """Persist EVKMS state to an append-only snapshot at path, restoring whatever it
+        already holds. Returns the restored state dict (None if there was nothing to restore)."""
+        snapshot = KeySnapshot(path, self.device_guid)
+        started = time.perf_counter()
+        try:
+            state = snapshot.load()
+        except (SnapshotError, OSError, ValueError) as e:
+            # Leave an unreadable or foreign file alone rather than appending to it
+            self.log.error(f"Snapshot disabled, cannot load {path}: {e}")
+            return None
+        self.snapshot = snapshot
+
+        if state is None:
+            return None
+        if state["dropped_bytes"]:
+            self.log.warning(f"Dropped {state['dropped_bytes']} bytes of torn/corrupt snapshot tail")
+
+        if state["provisioning"] is not None:
+            self._apply_provisioning(state["provisioning"])
+            for delta in state["provisioning_deltas"]:
+                self.apply_provisioning_delta(delta, record=False)
+        revoked = self.evkms_state["known_revoked_peers"]
+        if state["revocation_list"] is not None:
+            revoked.load_bytes(*state["revocation_list"])
+        revoked.add_many(state["revoked_peers"])
+        self.is_revoked = state["device_revoked"]
+
+        store = self.evkms_state["pairwise_keys"]
+        for peer_guid, (key, nonce, timestamp) in state["keys"].items():
+            store.put(peer_guid, key, nonce, timestamp)
+
+        if snapshot.needs_compaction(len(store)):
+            self.compact_snapshot()
+
+        self.log.info(f"[EVKMS] Restored provisioning and {len(store)} pairwise keys from snapshot "
+                      f"in {(time.perf_counter() - started) * 1000:.2f} ms")
+        return state
+
+    def compact_snapshot(self):
+        if self.snapshot:
+            revoked = self.evkms_state["known_revoked_peers"]
+            self.snapshot.compact(
+                self._provisioning_payload(),
+                self.evkms_state["pairwise_keys"].items(),
+                (revoked.version, revoked.to_bytes()),
+                self.is_revoked,
+            )
+
+    def _prepare_verifiers(self):
+        """Decode the secret vectors to bytes and index Vc by local id, once per provisioning,
+        so digest checks don't re-parse GUIDs or re-encode secrets per message"""
+        state = self.evkms_state
+        self.decoded_vectors = {
+            "Vp": [s.encode() for s in state["vector_Vp"]],
+            "Vc": [s.encode() for s in state["vector_Vc"]],
+            "Vn": [s.encode() for s in state["vector_Vn"]],
+        }
+        self._local_id_index = _build_local_id_index(len(state["vector_Vc"]))
+
+        # Keyed HMAC prototypes, built lazily per neighbor and copied for each message
+        self._own_digest_proto = hmac.new(state["secret_i"].encode(), digestmod=hashlib.sha256)
+        self._neighbor_digest_protos = {}
+        self._precompute_next_epoch()
+
+    # -------------------- epochs --------------------
+
+    def _own_vc_index(self):
+        # Our slot is the same in every epoch's Vc, whatever its length
+        try:
+            return int(self._extract_local_id().rpartition("@")[2]) - 1
+        except ValueError:
+            return None
+
+    def _precompute_next_epoch(self):
+        """Build the next epoch's verifier state in the background, so advance_epoch only
+        swaps references. Nothing to do until the gateway has sent Vn."""
+        self._epoch_generation += 1
+        self._next_epoch = None
+        state = self.evkms_state
+        if not state["vector_Vn"] or state["secret_i"] is None:
+            return
+        generation = self._epoch_generation
+        try:
+            future = kdf_executor.submit(_build_epoch, state["epoch"] + 1, list(self.decoded_vectors["Vn"]),
+                                         self._own_vc_index())
+        except RuntimeError:
+            return  # pool already shut down
+        future.add_done_callback(lambda f: self._store_next_epoch(f, generation))
+
+    def _store_next_epoch(self, future, generation):
+        if future.cancelled() or future.exception() is not None:
+            return
+        if generation == self._epoch_generation:
+            self._next_epoch = future.result()
+
+    def advance_epoch(self, epoch, next_vector=None, version=None):
+        """Switch to the next epoch: Vc becomes Vp, Vn becomes Vc, and next_vector (if given)
+        the new Vn. The vectors are rebound, not copied, and the verifier state was built
+        ahead of time, so the switch itself is a handful of reference swaps plus the key
+        migration: every pairwise key moves on with the refresh derivation,
+        K' = Hash(K, r) with r bound to the new Vc, so no peer has to handshake again.
+
+        Returns None once switched, "stale" for an epoch we're already past, "gap" if we
+        missed one, or "unprepared" if we never received Vn.
+        """
+        state = self.evkms_state
+        if epoch <= state["epoch"]:
+            return "stale"
+        if epoch != state["epoch"] + 1 or state["secret_i"] is None:
+            return "gap"
+        if not state["vector_Vn"]:
+            return "unprepared"
+
+        started = time.perf_counter()
+        prepared = self._next_epoch
+        if prepared is None or prepared["epoch"] != epoch:
+            # The background build hasn't finished (or never ran): do it inline
+            prepared = _build_epoch(epoch, list(self.decoded_vectors["Vn"]), self._own_vc_index())
+            self.metrics.epoch_precompute_misses.inc()
+        if prepared["own_index"] is None:
+            self.log.error("[EVKMS] Cannot advance to epoch %s: no slot for us in the new Vc", epoch)
+            return "gap"
+
+        grew = len(state["vector_Vn"]) != len(state["vector_Vc"])
+        next_vector = next_vector if next_vector is not None else []
+        state["vector_Vp"], state["vector_Vc"], state["vector_Vn"] = state["vector_Vc"], state["vector_Vn"], next_vector
+        state["secret_i"] = state["vector_Vc"][prepared["own_index"]]
+        state["epoch"] = epoch
+        if version is not None:
+            state["provisioning_version"] = version
+
+        decoded = self.decoded_vectors
+        self.decoded_vectors = {"Vp": decoded["Vc"], "Vc": prepared["decoded_vc"],
+                                "Vn": [s.encode() for s in next_vector]}
+        self._local_id_index = prepared["local_id_index"]
+        self._own_digest_proto = prepared["own_proto"]
+        self._neighbor_digest_protos = {}
+        self._provisioning_checksum = None
+        self._last_epoch_nonce = prepared["nonce"]
+
+        migrated = self.evkms_state["pairwise_keys"].refresh_all(prepared["nonce"])
+        self.compact_snapshot()
+        self._precompute_next_epoch()
+
+        self.last_epoch_switch_ms = (time.perf_counter() - started) * 1000
+        self.metrics.keys_refreshed.inc(migrated)
+        self.log.key_mgmt("Advanced to epoch %s: migrated %d pairwise keys in %.2f ms%s", epoch, migrated,
+                          self.last_epoch_switch_ms, " (Vc resized)" if grew else "")
+        return None
+
+    def _carry_key(self, key, epoch):
+        """A key derived under the epoch before the current one gets the same migration
+        the key table got at the switch, so both ends still agree"""
+        if epoch == self.evkms_state["epoch"] - 1 and self._last_epoch_nonce:
+            return hashlib.sha256((key + self._last_epoch_nonce).encode()).hexdigest()
+        return key
+
     def _extract_local_id(self):
         """Extract local ID from device GUID (e.g., 'subset1_device@05' → 'device@05')"""
         return self.device_guid.split("_")[-1]
@@ -52,52 +424,185 @@ class EVKMSDevice:
     def add_to_revoked_list(self, revoked_guid):
         """Mark a peer as revoked so no further key exchanges occur"""
         self.evkms_state["known_revoked_peers"].add(revoked_guid)
-        print(f"\033[91m[EVKMS_STATE][Device {self.device_guid}] Added {revoked_guid} to known_revoked_peers\033[0m")
+        if self.snapshot:
+            self.snapshot.record_revoked_peer(revoked_guid)
+        self.log.revocation(f"[EVKMS_STATE] Added {revoked_guid} to known_revoked_peers")
 
     def is_peer_revoked(self, peer_guid):
         """Check whether a given peer GUID is in the revoked list"""
-        return peer_guid in self.evkms_state.get("known_revoked_peers", set())
+        return peer_guid in self.evkms_state["known_revoked_peers"]
+
+    def apply_revocation_list(self, mode, version, base_version, revoked_guids):
+        """Apply a versioned revocation list from the gateway: "snapshot" merges the full
+        list, "delta" adds what was revoked since base_version. Keys with every newly revoked
+        peer are dropped in one pass. Returns the removed peer GUIDs, or None if the delta
+        doesn't follow on from our version (the caller should ask for a snapshot). A snapshot
+        older than our version is ignored (nothing removed)."""
+        revoked = self.evkms_state["known_revoked_peers"]
+        if mode == "snapshot":
+            if not revoked.apply_snapshot(version, revoked_guids):
+                self.log.warning("Ignoring revocation snapshot v%s, we already have v%s", version, revoked.version)
+                return []
+        elif not revoked.apply_delta(base_version, version, revoked_guids):
+            self.log.warning("Revocation delta %s->%s does not follow our version %s",
+                             base_version, version, revoked.version)
+            return None
+
+        # Walk whichever is smaller: the delta's GUIDs or our key table
+        store = self.evkms_state["pairwise_keys"]
+        if mode == "delta" and len(revoked_guids) < len(store):
+            candidates = [guid for guid in revoked_guids if guid in store]
+        else:
+            candidates = [guid for guid, _ in store.items() if guid in revoked]
+        removed = [guid for guid in candidates if store.pop(guid) is not None]
+
+        if self.device_guid in revoked and not self.is_revoked:
+            self.set_device_revoked(True)
+        self.compact_snapshot()
+
+        self.log.revocation("[EVKMS_STATE] Revocation list v%s (%s, %d entries): removed %d pairwise keys",
+                            revoked.version, mode, len(revoked), len(removed))
+        return removed
 
     
 
-    def compute_pairwise_key(self, neighbor_guid, neighbor_secret, nonce):
-        """EVKMS pairwise key derivation (Section 3.3.4)"""
+    def compute_pairwise_key(self, neighbor_guid, neighbor_secret, nonce, own_secret=None):
+        """EVKMS pairwise key derivation (Section 3.3.4). own_secret defaults to our current
+        secret_i; pass the one read together with neighbor_secret if an epoch switch may
+        have happened since."""
 
         #Sorted the global uid and then compute the pairways 
 
         guid_a, guid_b = get_sorted_guids(self.device_guid , neighbor_guid )
 
-        secret_a , secret_b = sorted([self.evkms_state['secret_i'] , neighbor_secret ])
+        if own_secret is None:
+            own_secret = self.evkms_state['secret_i']
+        secret_a , secret_b = sorted([own_secret , neighbor_secret ])
 
         key_material = f"{guid_a}{guid_b}{nonce}{secret_a}{secret_b}"
         
-        # PBKDF2-HMAC-SHA256 for key stretching
-        return hashlib.pbkdf2_hmac(
-            'sha256',
-            key_material.encode(),
-            nonce.encode(),
-            100000  # Iterations
-        ).hex()
+        # Provisioned KDF, PBKDF2-HMAC-SHA256 unless the subset picked another
+        started = time.perf_counter()
+        key = self.kdf.derive(key_material.encode(), nonce.encode()).hex()
+        self.metrics.kdf_seconds.observe(time.perf_counter() - started)
+        return key
+
+    def compute_pairwise_key_async(self, neighbor_guid, neighbor_secret, nonce, on_complete,
+                                   priority=PRIORITY_DISCOVERY, guard=None):
+        """Derive the pairwise key on the KDF pool and call on_complete(key) once it is ready.
+        Returns the Future immediately so the network loop never waits on the KDF.
+
+        The job goes through kdf_admission: the Future is cancelled (and on_complete never
+        runs) if the job is shed under load or guard() is false by the time it would run.
+
+        neighbor_secret must come from the current Vc. Our own secret is taken now, with the
+        epoch, not when the job runs: a job queued across an epoch switch still derives from
+        one epoch's pair of secrets, and its completion migrates the key like the table's."""
+        epoch = self.evkms_state["epoch"]
+        own_secret = self.evkms_state["secret_i"]
+        future = kdf_admission.submit(priority, self.compute_pairwise_key, neighbor_guid, neighbor_secret, nonce,
+                                      own_secret, guard=guard)
+        if self.completion_loop is not None:
+            loop = self.completion_loop
+            future.add_done_callback(
+                lambda f: loop.call_soon_threadsafe(self._run_kdf_completion, f, neighbor_guid, on_complete, epoch))
+        else:
+            future.add_done_callback(lambda f: self._run_kdf_completion(f, neighbor_guid, on_complete, epoch))
+        return future
+
+    def _run_kdf_completion(self, future, neighbor_guid, on_complete, epoch=None):
+        """Hand a finished derivation to its completion, logging failures instead of losing them"""
+        if future.cancelled():
+            return
+        try:
+            key = future.result()
+            if epoch is not None and epoch != self.evkms_state["epoch"]:
+                key = self._carry_key(key, epoch)
+            on_complete(key)
+        except Exception as e:
+            self.log.error("Pairwise key derivation with %s failed: %s", neighbor_guid, e)
     
-    def store_pairwise_key(self, neighbor_guid, key, nonce ):
+    def store_pairwise_key(self, neighbor_guid, key, nonce, confirmed=False):
         """Securely store pairwise key in memory"""
-        self.evkms_state["pairwise_keys"][neighbor_guid] = {
-            "key": key,
-            "nonce": nonce, # The discovery nonce that led to this key
-            "timestamp": time.time(), # Use time from Python's time module
-        }
-
-        log_key_mgmt(f"Stored pairwise key with {neighbor_guid} (Nonce: {nonce[:14]}...)")
-
-
+        # The discovery nonce that led to this key is kept with it
+        record = self.evkms_state["pairwise_keys"].put(neighbor_guid, key, nonce, confirmed=confirmed)
+        if self.snapshot:
+            self.snapshot.record_key(neighbor_guid, record)
+
+        self.log.key_mgmt("Stored pairwise key with %s (Nonce: %.14s...)", neighbor_guid, nonce)
+
+    def _confirmation_digest(self, neighbor_guid, record):
+        # Distinct from the key response's material, so a response can't pass as a confirmation
+        guid_a, guid_b = get_sorted_guids(self.device_guid, neighbor_guid)
+        return compute_pairwise_digest(record.key_hex, f"confirm:{guid_a}{guid_b}{record.nonce}")
+
+    def key_confirmation(self, neighbor_guid):
+        """(nonce, digest) proving to the peer that we hold our key with it, None without one"""
+        record = self.evkms_state["pairwise_keys"].get(neighbor_guid)
+        if record is None:
+            return None
+        return record.nonce, self._confirmation_digest(neighbor_guid, record)
+
+    def confirm_pairwise_key(self, neighbor_guid, nonce, digest):
+        """Mark our key with a peer confirmed if its confirmation matches it. Returns True
+        if it did (or the key already was), False for no key, another nonce or a bad digest."""
+        record = self.evkms_state["pairwise_keys"].get(neighbor_guid)
+        if record is None or record.nonce != nonce:
+            return False
+        if not hmac.compare_digest(self._confirmation_digest(neighbor_guid, record), digest):
+            return False
+        record.confirmed = True
+        return True
+
+    def remove_pairwise_key(self, neighbor_guid):
+        """Drop the key with a peer; returns False if there was none"""
+        if self.evkms_state["pairwise_keys"].pop(neighbor_guid) is None:
+            return False
+        if self.snapshot:
+            self.snapshot.record_delete(neighbor_guid)
+        return True
+
+
+
+    def get_vc_index(self, local_id):
+        """Map neighbor local id to Vc index ("05" → 4), None if unknown"""
+        index = self._local_id_index.get(local_id)
+        if index is None:
+            # Other spellings ("005") still resolve, but aren't cached: the id comes from an
+            # unverified GUID, so caching would let any sender grow the index
+            try:
+                index = int(local_id) - 1
+            except ValueError:
+                return None
+            if not 0 <= index < len(self.evkms_state["vector_Vc"]):
+                return None
+        return index
 
     def get_secret_from_vic(self, local_id):
         """Map neighbor GUID to Vc index"""
-        try:
-            index = int(local_id) - 1  # Convert "05" → index 4
-            return self.evkms_state["vector_Vc"][index]
-        except (ValueError, IndexError):
-            return None
+        index = self.get_vc_index(local_id)
+        return None if index is None else self.evkms_state["vector_Vc"][index]
+
+    def compute_own_discovery_digest(self, nonce):
+        """HMAC for our discovery messages, from the cached keyed prototype"""
+        digest = self._own_digest_proto.copy()
+        digest.update(f"{self.device_guid}{nonce}".encode())
+        return digest.hexdigest()
+
+    def verify_discovery_digest(self, neighbor_guid, local_id, nonce, received_digest):
+        """Constant-time check of a neighbor's discovery HMAC against its Vc secret"""
+        index = self.get_vc_index(local_id)
+        if index is None:
+            return False
+
+        proto = self._neighbor_digest_protos.get(index)
+        if proto is None:
+            proto = hmac.new(self.decoded_vectors["Vc"][index], digestmod=hashlib.sha256)
+            self._neighbor_digest_protos[index] = proto
+
+        digest = proto.copy()
+        digest.update(f"{neighbor_guid}{nonce}".encode())
+        return hmac.compare_digest(digest.hexdigest(), received_digest)
         
     
 
@@ -107,10 +612,12 @@ class EVKMSDevice:
     def set_device_revoked(self, revoked_status):
         """Set the device's revoked status"""
         self.is_revoked = revoked_status
+        if self.snapshot:
+            self.snapshot.record_device_revoked(revoked_status)
         if revoked_status:
-            log_warning(f"Device {self.device_guid} has been marked as revoked.")
+            self.log.warning(f"Device {self.device_guid} has been marked as revoked.")
         else:
-            log_info(f"Device {self.device_guid} is no longer revoked.")
+            self.log.info(f"Device {self.device_guid} is no longer revoked.")
 
 
 
@@ -121,40 +628,38 @@ class EVKMSDevice:
         """
         keys_refreshed_count = 0
         
-        # Check if the target peer's key exists
-        key_info = self.evkms_state["pairwise_keys"].get(peer_guid_to_refresh)
+        # New key: hash of old key and the refresh_nonce (None if the peer has no key)
+        key_info = self.evkms_state["pairwise_keys"].refresh(peer_guid_to_refresh, refresh_nonce)
 
         if key_info: # No 'verified' check due to simplification
-            old_key_hex = key_info["key"]
-            
-            # New key material: hash of old key and the refresh_nonce
-            new_key_material = f"{old_key_hex}{refresh_nonce}"
-            new_key_hex = hashlib.sha256(new_key_material.encode('utf-8')).hexdigest()
-
-            # Update the stored key
-            self.evkms_state["pairwise_keys"][peer_guid_to_refresh]["key"] = new_key_hex
-            self.evkms_state["pairwise_keys"][peer_guid_to_refresh]["timestamp"] = time.time() # Update timestamp
-
             keys_refreshed_count += 1
-            log_info(f"Refreshed pairwise key with {peer_guid_to_refresh}. New hash: {hash_key(new_key_hex)[:10]}...")
+            if self.snapshot:
+                self.snapshot.record_key(peer_guid_to_refresh, key_info)
+            # Hashing the new key is only worth it if the line is actually written
+            if self.log.is_enabled("info"):
+                self.log.info("Refreshed pairwise key with %s. New hash: %.10s...", peer_guid_to_refresh, hash_key(key_info.key_hex))
         else:
-            log_warning(f"Skipping refresh for {peer_guid_to_refresh} - key missing for this peer.")
+            self.log.warning("Skipping refresh for %s - key missing for this peer.", peer_guid_to_refresh)
         
-        log_info(f"Total specific pairwise keys refreshed: {keys_refreshed_count}")
+        self.metrics.keys_refreshed.inc(keys_refreshed_count)
+        self.log.info("Total specific pairwise keys refreshed: %d", keys_refreshed_count)
         return keys_refreshed_count
 
-    # Optional: If you still need to refresh ALL keys (e.g. for a global reset)
-
-
-
     def refresh_all_pairwise_keys(self, refresh_nonce):
-        """Refreshes ALL existing pairwise keys regardless of target_peer."""
-        keys_refreshed_count = 0
-        current_peers = list(self.evkms_state["pairwise_keys"].keys())
-        for peer_guid in current_peers:
-            # Re-use the specific refresh method
-            if self.refresh_pairwise_key_with_peer(peer_guid, refresh_nonce) > 0:
-                keys_refreshed_count += 1
+        """Refreshes ALL existing pairwise keys regardless of target_peer.
+
+        Batch engine: one pass over the key table with the same K'ij = Hash(Kij, r)
+        derivation as refresh_pairwise_key_with_peer, and a single summary log line.
+        The duration is kept in last_refresh_duration_ms for the gateway ACK.
+        """
+        started = time.perf_counter()
+        keys_refreshed_count = self.evkms_state["pairwise_keys"].refresh_all(refresh_nonce)
+        # Every key changed, so rewrite the snapshot rather than appending a record per key
+        self.compact_snapshot()
+
+        self.last_refresh_duration_ms = (time.perf_counter() - started) * 1000
+        self.metrics.keys_refreshed.inc(keys_refreshed_count)
+        self.log.key_mgmt("Refreshed %d pairwise keys in %.2f ms", keys_refreshed_count, self.last_refresh_duration_ms)
         return keys_refreshed_count
 
 
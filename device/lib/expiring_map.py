@@ -0,0 +1,85 @@
+# Small TTL map for short-lived protocol state (e.g. our outstanding discovery nonces)
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ExpiringMap:
+    """Insertion-ordered map whose entries expire a fixed ttl after they were added.
+
+    Because every entry lives for the same ttl, the oldest entry is always at the front:
+    expiry pops from the front until it finds a live entry, so insert, lookup and cleanup
+    are amortized O(1) no matter how many entries are outstanding. When capacity is
+    reached the oldest entry is evicted.
+    """
+
+    def __init__(self, ttl, capacity, clock=time.monotonic):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def add(self, key, value=None):
+        with self._lock:
+            now = self._clock()
+            self._purge(now)
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = (now + self.ttl, value)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def get(self, key, default=None):
+        """Look up a live entry, counting the lookup as a hit or a miss"""
+        with self._lock:
+            self._purge(self._clock())
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[1]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __contains__(self, key):
+        with self._lock:
+            self._purge(self._clock())
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def purge(self):
+        """Drop expired entries now (they are otherwise dropped on the next access)"""
+        with self._lock:
+            self._purge(self._clock())
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+    def _purge(self, now):
+        entries = self._entries
+        while entries:
+            key = next(iter(entries))
+            if entries[key][0] > now:
+                break
+            del entries[key]
+            self.expired += 1
@@ -0,0 +1,294 @@
+# Farm mode: fleet workers in separate processes, so key derivation uses every core.
+# Subsets are sharded whole across workers; a coordinator collects each worker's stats
+# and aggregates them into one report.
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from lib.config import *
+from lib.device_context import DeviceContext
+from lib.evkms_core import kdf_admission
+from lib.fleet import build_connections
+from lib.log_handler import DeviceLog, flush_logs
+from lib.loopback_broker import LoopbackBroker, LoopbackClient
+from lib.metrics import histogram_quantile, merge_histograms
+from lib.mqtt_handler import setup_mqtt
+from lib.outbound import PRIORITIES
+
+
+farm_log = DeviceLog("farm")
+
+
+def shard_roster(roster, workers):
+    """Split (device_guid, subset_guid) pairs into at most `workers` shards without
+    splitting a subset, biggest subsets first onto the least loaded shard"""
+    by_subset = {}
+    for device_guid, subset_guid in roster:
+        by_subset.setdefault(subset_guid, []).append((device_guid, subset_guid))
+
+    shards = [[] for _ in range(max(1, min(workers, len(by_subset))))]
+    for members in sorted(by_subset.values(), key=len, reverse=True):
+        min(shards, key=len).extend(members)
+    return shards
+
+
+# -------------------- worker side --------------------
+
+def worker_stats(index, contexts, started, mesh_complete_at):
+    """One worker's numbers: totals over its devices plus merged latency histograms"""
+    keys = covered = expected = 0
+    counters = {"discoveries_sent": 0, "keys_established": 0, "digest_mismatches": 0, "kdf_mismatches": 0,
+                "discovery_drops": 0, "outbound_dropped": 0}
+    handshakes, kdf = [], []
+    for ctx in contexts:
+        keys += len(ctx.device.evkms_state["pairwise_keys"])
+        c, e = ctx.discovery.coverage()
+        covered += c
+        expected += e
+        metrics = ctx.metrics
+        if metrics.enabled:
+            counters["discoveries_sent"] += metrics.discoveries_sent.value
+            counters["keys_established"] += (metrics.keys_established_initiator.value
+                                             + metrics.keys_established_responder.value)
+            counters["digest_mismatches"] += (metrics.discovery_digest_mismatches.value
+                                              + metrics.response_digest_mismatches.value)
+            counters["kdf_mismatches"] += metrics.kdf_mismatches.value
+            counters["discovery_drops"] += metrics.discovery_replays.value + metrics.discovery_rate_limited.value
+            counters["outbound_dropped"] += sum(getattr(metrics, f"outbound_dropped_{kind}").value
+                                                for kind in PRIORITIES)
+            handshakes.append(metrics.handshake_seconds)
+            kdf.append(metrics.kdf_seconds)
+
+    return {
+        "worker": index,
+        "pid": os.getpid(),
+        "devices": len(contexts),
+        "subsets": len({ctx.subset_guid for ctx in contexts}),
+        "uptime_s": time.perf_counter() - started,
+        "cpu_s": time.process_time(),
+        "keys": keys,
+        "covered": covered,
+        "expected": expected,
+        "mesh_complete_s": mesh_complete_at,
+        "counters": counters,
+        "handshake": merge_histograms(handshakes),
+        "kdf": merge_histograms(kdf),
+        "kdf_admission": kdf_admission.stats(),
+    }
+
+
+def _start_loopback(members, options):
+    """Run the shard against an in-process broker, provisioning each subset ourselves
+    (random secrets, Vc slot = local id - 1) the way the gateway would"""
+    broker = LoopbackBroker(latency=options["latency"])
+    gateway = LoopbackClient(broker, "farm-gateway")
+    gateway.connect()
+
+    contexts, clients = [], []
+    for device_guid, subset_guid in members:
+        ctx = DeviceContext(device_guid, subset_guid, snapshot_path="")
+        clients.append(setup_mqtt(ctx, LoopbackClient(broker, device_guid), run_forever=False))
+        contexts.append(ctx)
+
+    # Devices subscribe from on_connect; provisioning sent before that would be lost
+    while not all(client.subscriptions for client in clients):
+        time.sleep(0.01)
+
+    by_subset = {}
+    for ctx in contexts:
+        by_subset.setdefault(ctx.subset_guid, []).append(ctx)
+    for subset_contexts in by_subset.values():
+        slots = {ctx.device_guid: int(ctx.device_guid.rpartition("@")[2]) - 1 for ctx in subset_contexts}
+        secrets = [os.urandom(16).hex() for _ in range(max(slots.values()) + 1)]
+        for ctx in subset_contexts:
+            gateway.publish(f"iot_network/farm-gateway/devices/{ctx.device_guid}/config", json.dumps({
+                "secret_i": secrets[slots[ctx.device_guid]],
+                "Vectore_p": [],
+                "Vectore_c": secrets,
+                "Vectore_n": [],
+                "alpha": 5,
+                "kdf": options["kdf"],
+            }), qos=1)
+
+    return contexts, clients + [gateway]
+
+
+async def _worker_main(index, members, options, stats_queue, stop_event):
+    loop = asyncio.get_running_loop()
+    if options["loopback"]:
+        contexts, clients = _start_loopback(members, options)
+    else:
+        connections = build_connections(loop, members)
+        for connection in connections:
+            connection.connect(options["broker"])
+        contexts = [ctx for connection in connections for ctx in connection.contexts.values()]
+        clients = [connection.client for connection in connections]
+
+    started = time.perf_counter()
+    mesh_complete_at = None
+    while True:
+        stopping = stop_event.is_set()
+        stats = worker_stats(index, contexts, started, mesh_complete_at)
+        # Resolution is the report interval: the first report that sees every expected peer covered
+        if mesh_complete_at is None and stats["expected"] and stats["covered"] >= stats["expected"]:
+            mesh_complete_at = stats["mesh_complete_s"] = stats["uptime_s"]
+        stats["final"] = stopping
+        stats_queue.put(stats)
+        if stopping:
+            break
+        await loop.run_in_executor(None, stop_event.wait, options["interval"])
+
+    # Queued derivations would otherwise keep running (and retrying) into interpreter shutdown
+    kdf_admission.close()
+    for ctx in contexts:
+        ctx.scheduler.cancel_all()
+    for client in clients:
+        client.disconnect()
+    flush_logs()
+
+
+def run_worker(index, members, options, stats_queue, stop_event):
+    """Process entry point for one shard"""
+    # Ctrl+C reaches the whole process group; the coordinator decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger('paho.mqtt').setLevel(logging.WARNING)
+    asyncio.run(_worker_main(index, members, options, stats_queue, stop_event))
+
+
+# -------------------- coordinator side --------------------
+
+def aggregate(latest, wall_s, shards):
+    """Fold the workers' latest stats into one report"""
+    workers = [latest[i] for i in sorted(latest)]
+    handshake = merge_histograms(w["handshake"] for w in workers if w["handshake"])
+    kdf = merge_histograms(w["kdf"] for w in workers if w["kdf"])
+    cpu_s = sum(w["cpu_s"] for w in workers)
+    keys = sum(w["keys"] for w in workers)
+    covered = sum(w["covered"] for w in workers)
+    expected = sum(w["expected"] for w in workers)
+    counters = {}
+    for w in workers:
+        for name, value in w["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+    complete = [w["mesh_complete_s"] for w in workers]
+
+    def latency(histogram):
+        if not histogram or not histogram["count"]:
+            return None
+        return {
+            "count": histogram["count"],
+            "mean_ms": histogram["sum"] / histogram["count"] * 1000,
+            **{f"p{int(q * 100)}_ms": histogram_quantile(histogram, q) * 1000 for q in (0.5, 0.95, 0.99)},
+        }
+
+    return {
+        "workers": len(shards),
+        "workers_reporting": len(workers),
+        "devices": sum(len(s) for s in shards),
+        "subsets": sum(w["subsets"] for w in workers),
+        "wall_s": wall_s,
+        "cpu_s": cpu_s,
+        "cores_busy": cpu_s / wall_s if wall_s else 0.0,
+        "keys": keys,
+        "coverage": covered / expected if expected else 0.0,
+        "mesh_complete_s": max(complete) if complete and None not in complete else None,
+        "keys_per_s": counters.get("keys_established", 0) / wall_s if wall_s else 0.0,
+        "counters": counters,
+        "handshake_latency": latency(handshake),
+        "kdf_latency": latency(kdf),
+        "per_worker": [{k: v for k, v in w.items() if k not in ("handshake", "kdf", "final")} for w in workers],
+    }
+
+
+def _progress_line(report):
+    handshake = report["handshake_latency"] or {}
+    p95 = f"{handshake['p95_ms']:.0f} ms" if handshake else "-"
+    return (f"{report['wall_s']:7.1f}s  workers {report['workers_reporting']}/{report['workers']}  "
+            f"keys {report['keys']}  coverage {report['coverage']:6.1%}  handshake p95 {p95}  "
+            f"cores busy {report['cores_busy']:.2f}")
+
+
+def _worker_env(index, options):
+    """Environment a worker starts with: metrics on (the report reads them), only device
+    errors logged unless LOG_LEVEL says otherwise, and one Prometheus port per worker"""
+    env = {"METRICS_ENABLED": "1", "LOG_LEVEL": os.getenv("LOG_LEVEL", "ERROR")}
+    if METRICS_HTTP_PORT:
+        env["METRICS_HTTP_PORT"] = str(METRICS_HTTP_PORT + index)
+    if options["loopback"] and options["kdf_iterations"]:
+        env["KDF_ITERATIONS"] = str(options["kdf_iterations"])
+    return env
+
+
+def run_farm(roster, workers=FARM_WORKERS, duration=0, interval=FARM_REPORT_INTERVAL, broker=MQTT_BROKER,
+             loopback=False, latency=0.0, kdf=None, kdf_iterations=None):
+    """Start the workers, print aggregated progress every interval, and return the final
+    report once duration seconds have passed (0 = until Ctrl+C)"""
+    workers = workers or os.cpu_count() or 1
+    shards = shard_roster(roster, workers)
+    options = {"broker": broker, "loopback": loopback, "latency": latency, "kdf": kdf,
+               "kdf_iterations": kdf_iterations, "interval": interval}
+
+    # Spawn, not fork: this process already runs timer, KDF and log threads
+    mp = multiprocessing.get_context("spawn")
+    stats_queue = mp.Queue()
+    stop_event = mp.Event()
+    processes = []
+    for index, members in enumerate(shards):
+        saved = dict(os.environ)
+        os.environ.update(_worker_env(index, options))
+        try:
+            process = mp.Process(target=run_worker, args=(index, members, options, stats_queue, stop_event),
+                                 name=f"farm-worker-{index}", daemon=True)
+            process.start()
+        finally:
+            os.environ.clear()
+            os.environ.update(saved)
+        processes.append(process)
+    farm_log.info("Farm: %d devices in %d subsets over %d worker processes (%s)", len(roster),
+                  len({s for _, s in roster}), len(shards), "loopback broker" if loopback else broker)
+
+    started = time.perf_counter()
+    latest = {}
+    next_progress = started + interval
+    try:
+        while any(p.is_alive() for p in processes):
+            if duration and time.perf_counter() - started >= duration:
+                break
+            try:
+                stats = stats_queue.get(timeout=0.5)
+                latest[stats["worker"]] = stats
+            except queue.Empty:
+                pass
+            if latest and time.perf_counter() >= next_progress:
+                next_progress += interval
+                print(_progress_line(aggregate(latest, time.perf_counter() - started, shards)), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+    # Ask for final stats, then wait for each worker's last report
+    stop_event.set()
+    wall_s = time.perf_counter() - started
+    final = set()
+    deadline = time.monotonic() + 30
+    while len(final) < len(processes) and time.monotonic() < deadline:
+        if not any(p.is_alive() for p in processes) and stats_queue.empty():
+            break
+        try:
+            stats = stats_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        latest[stats["worker"]] = stats
+        if stats["final"]:
+            final.add(stats["worker"])
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+    return aggregate(latest, wall_s, shards) if latest else None
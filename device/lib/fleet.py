@@ -0,0 +1,176 @@
+# Fleet mode: many simulated devices in one process, on one asyncio event loop
+
+import asyncio
+import csv
+import json
+import logging
+import os
+import random
+import paho.mqtt.client as mqtt   # type: ignore
+
+from lib.config import *
+from lib.device_context import DeviceContext
+from lib.log_handler import DeviceLog
+from lib.metrics import start_http_server, start_metrics_publisher
+from lib.mqtt_handler import register_device_routes, start_discovery
+from lib.outbound import OutboundPublisher
+from lib.scheduler import Scheduler
+from lib.topic_router import TopicRouter
+
+
+fleet_log = DeviceLog("fleet")
+
+
+def load_roster(path):
+    """Read (device_guid, subset_guid) pairs from a JSON or CSV roster file.
+
+    JSON: [{"device_guid": "LR01_device@01", "subset": "LR01"}, ...]
+    CSV:  device_guid,subset  (one device per line, header optional)
+    """
+    if path.endswith(".json"):
+        with open(path) as f:
+            entries = json.load(f)
+        return [(e["device_guid"], e["subset"]) for e in entries]
+
+    roster = []
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith("#") or row[0] == "device_guid":
+                continue
+            roster.append((row[0].strip(), row[1].strip()))
+    return roster
+
+
+class AsyncioHelper:
+    """Drives a paho client from the asyncio loop instead of a loop_forever thread"""
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc:
+            self.misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        # Publishes normally happen on the loop, but stay safe if one comes from another thread
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock)
+
+    async def misc_loop(self):
+        """Keepalive pings and QoS retries while the socket is open"""
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class FleetConnection:
+    """One MQTT connection multiplexed across the devices of a single subset.
+
+    Every device registers its routes in the connection's shared router: subset-wide
+    topics (discovery, alerts, key refresh) are subscribed once and fanned out to every
+    device on the connection, per-device topics reach their owner only.
+    """
+
+    def __init__(self, loop, name, members):
+        self.loop = loop
+        self.name = name
+        self.router = TopicRouter()
+        # One inflight window per connection, whichever of its devices is publishing
+        self.outbound = OutboundPublisher()
+        self.scheduler = Scheduler(loop)
+        self.contexts = {}
+        for device_guid, subset_guid in members:
+            ctx = DeviceContext(device_guid, subset_guid, timer_backend=loop, router=self.router,
+                                outbound=self.outbound)
+            ctx.device.completion_loop = loop
+            register_device_routes(self.router, ctx)
+            self.contexts[device_guid] = ctx
+
+        self.client = mqtt.Client(
+            client_id=name,
+            protocol=mqtt.MQTTv311,
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION1
+        )
+        self.client.on_connect = self.on_connect
+        self.client.on_message = lambda client, userdata, msg: self.router.dispatch(client, msg)
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = lambda client, userdata, mid: self.outbound.on_publish(mid)
+        self.helper = AsyncioHelper(loop, self.client)
+
+    def connect(self, broker):
+        self.client.connect(broker, 1883, 60)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            fleet_log.error(f"[{self.name}] Connection failed with code {rc}")
+            return
+
+        subscription_count = self.router.subscribe_all(client)
+        fleet_log.info(f"[{self.name}] Connected, serving {len(self.contexts)} devices ({subscription_count} subscriptions)")
+        self.outbound.on_connect(client)
+        self.outbound.start_expiry(self.scheduler)
+        for ctx in self.contexts.values():
+            # Spread the first broadcast so a booting fleet doesn't burst
+            start_discovery(client, ctx, first_delay=random.uniform(0, 60))
+            start_metrics_publisher(client, ctx)
+
+    def on_disconnect(self, client, userdata, rc):
+        self.outbound.on_disconnect()
+        if rc != 0:
+            fleet_log.warning(f"[{self.name}] Lost connection (rc={rc}), reconnecting in 5s")
+            self.loop.call_later(5, self.reconnect)
+
+    def reconnect(self):
+        try:
+            self.client.reconnect()
+        except OSError as e:
+            fleet_log.error(f"[{self.name}] Reconnect failed: {e}")
+            self.loop.call_later(5, self.reconnect)
+
+
+def build_connections(loop, roster, devices_per_connection=FLEET_DEVICES_PER_CONNECTION):
+    """Group devices by subset, then split each subset into connections of bounded size"""
+    by_subset = {}
+    for device_guid, subset_guid in roster:
+        by_subset.setdefault(subset_guid, []).append((device_guid, subset_guid))
+
+    connections = []
+    for subset_guid, members in by_subset.items():
+        for start in range(0, len(members), devices_per_connection):
+            name = f"fleet-{subset_guid}-{start // devices_per_connection}-{os.getpid()}"
+            connections.append(FleetConnection(loop, name, members[start:start + devices_per_connection]))
+    return connections
+
+
+async def run_fleet(roster_path, broker=MQTT_BROKER):
+    loop = asyncio.get_running_loop()
+
+    logging.getLogger('paho.mqtt').setLevel(logging.WARNING)
+
+    # One Prometheus endpoint for the whole fleet, devices told apart by the device label
+    start_http_server()
+
+    roster = load_roster(roster_path)
+    connections = build_connections(loop, roster)
+    fleet_log.info(f"Fleet: {len(roster)} devices over {len(connections)} MQTT connections to {broker}")
+
+    for connection in connections:
+        connection.connect(broker)
+
+    # Run until cancelled (Ctrl+C)
+    await asyncio.Event().wait()
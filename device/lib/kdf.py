@@ -0,0 +1,85 @@
+# Pairwise key derivation strategies, chosen per subset in provisioning
+#
+# A strategy is named by a spec string that also travels in the handshake, so both
+# peers can tell they derive the same way:
+#
+#   pbkdf2-sha256:<iterations>     PBKDF2-HMAC-SHA256 (the original derivation)
+#   hkdf-sha256                    HKDF-SHA256 extract+expand (RFC 5869), no stretching
+#   scrypt:<n>:<r>:<p>             hashlib.scrypt, n a power of two
+#
+# Every strategy turns (key material, nonce) into 32 bytes; the device hex-encodes them.
+
+import hashlib
+import hmac
+from functools import lru_cache
+
+from lib.config import KDF_ITERATIONS
+
+
+KEY_LENGTH = 32
+
+# What a peer that doesn't announce a KDF (older firmware, JSON without "kdf") uses
+DEFAULT_KDF = f"pbkdf2-sha256:{KDF_ITERATIONS}"
+
+
+class KDFError(ValueError):
+    pass
+
+
+class PBKDF2:
+    def __init__(self, iterations):
+        if iterations < 1:
+            raise KDFError("pbkdf2 needs at least one iteration")
+        self.iterations = iterations
+        self.id = f"pbkdf2-sha256:{iterations}"
+
+    def derive(self, material, salt):
+        return hashlib.pbkdf2_hmac("sha256", material, salt, self.iterations)
+
+
+class HKDF:
+    """No work factor: the inputs already include high-entropy subset secrets, so this is
+    for boards where PBKDF2 costs more than the handshake budget allows"""
+
+    id = "hkdf-sha256"
+
+    def derive(self, material, salt):
+        prk = hmac.new(salt, material, hashlib.sha256).digest()
+        # One expand block covers the 32-byte key
+        return hmac.new(prk, b"evkms-pairwise\x01", hashlib.sha256).digest()
+
+
+class Scrypt:
+    def __init__(self, n, r, p):
+        if n < 2 or n & (n - 1):
+            raise KDFError("scrypt n must be a power of two")
+        self.n, self.r, self.p = n, r, p
+        self.id = f"scrypt:{n}:{r}:{p}"
+        # hashlib's default 32 MiB cap is too small for n >= 2^15 with r=8
+        self.maxmem = 128 * r * (n + p + 2) + 1024 * 1024
+
+    def derive(self, material, salt):
+        return hashlib.scrypt(material, salt=salt, n=self.n, r=self.r, p=self.p,
+                              maxmem=self.maxmem, dklen=KEY_LENGTH)
+
+
+@lru_cache(maxsize=16)
+def get_kdf(spec=None):
+    """Strategy for a spec string (None or "" means DEFAULT_KDF); raises KDFError if unknown"""
+    name, *params = (spec or DEFAULT_KDF).strip().lower().split(":")
+    try:
+        if name == "pbkdf2-sha256":
+            return PBKDF2(int(params[0]) if params else KDF_ITERATIONS)
+        if name == "hkdf-sha256" and not params:
+            return HKDF()
+        if name == "scrypt":
+            n, r, p = (int(v) for v in (params + ["16384", "8", "1"][len(params):]))
+            return Scrypt(n, r, p)
+    except ValueError as e:
+        raise KDFError(f"Bad KDF parameters in {spec!r}: {e}")
+    raise KDFError(f"Unknown KDF {spec!r}")
+
+
+def peer_kdf(data):
+    """The KDF spec a handshake message announces (DEFAULT_KDF if it carries none)"""
+    return get_kdf(data.get("kdf")).id
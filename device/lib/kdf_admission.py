@@ -0,0 +1,196 @@
+# Admission control in front of the KDF pool: priority queue, rate budget, load shedding
+
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+from lib.log_handler import log_error
+
+
+# Lower runs first
+PRIORITY_KEY_RESPONSE = 0   # a peer answered one of our discovery nonces
+PRIORITY_DISCOVERY = 1      # a peer's discovery; it will broadcast again if we shed it
+PRIORITY_SPECULATIVE = 2    # a key for our nonce that nobody has asked for yet (lib/speculative_keys.py)
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "fn", "args", "guard", "future")
+
+    def __init__(self, priority, seq, fn, args, guard):
+        self.priority = priority
+        self.seq = seq
+        self.fn = fn
+        self.args = args
+        self.guard = guard
+        self.future = Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class KDFAdmission:
+    """Decides which derivations reach the KDF pool, and when.
+
+    Jobs wait in a bounded priority queue and are released one per token of a
+    process-wide token bucket (rate per second, 0 = unlimited), with at most
+    max_inflight on the pool so the queue order is what actually runs. When the queue
+    is full the lowest-priority job (the newcomer on a tie) is shed: its future is
+    cancelled and the caller decides whether to retry later. A job's guard is checked
+    again when it is released, so work that went stale while queued (peer already
+    keyed, nonce expired) is dropped without spending a derivation on it.
+    """
+
+    def __init__(self, executor, max_inflight, max_queue, rate=0, burst=None, timers=None,
+                 clock=time.monotonic):
+        self.executor = executor
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.rate = rate
+        # Bucket size: how many derivations may run back to back after a quiet spell
+        self.burst = (burst or max(1, int(rate))) if rate > 0 else 0
+        self._clock = clock
+        self._timers = timers
+        self._tokens = float(self.burst)
+        self._last_refill = clock()
+        self._refill_pending = False
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._inflight = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+        self.admitted = 0
+        self.shed = 0
+        self.stale = 0
+        self.completed = 0
+
+    def submit(self, priority, fn, *args, guard=None):
+        """Queue fn(*args) for the pool; returns a Future that is cancelled if the job is
+        shed or goes stale, otherwise resolved with fn's result"""
+        job = _Job(priority, next(self._counter), fn, args, guard)
+        victim = None
+        with self._lock:
+            if self._closed:
+                victim = job
+            elif len(self._queue) >= self.max_queue:
+                worst = max(self._queue)
+                if job < worst:
+                    self._queue.remove(worst)
+                    heapq.heapify(self._queue)
+                    victim = worst
+                else:
+                    victim = job
+                self.shed += 1
+            if victim is not job:
+                heapq.heappush(self._queue, job)
+                self.admitted += 1
+
+        if victim:
+            victim.future.cancel()
+        self._pump()
+        return job.future
+
+    def _take_token(self):
+        """Called with the lock held; returns the seconds to wait if no token is available"""
+        if self.rate <= 0:
+            return 0
+        now = self._clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def _pump(self):
+        """Release queued jobs while there is pool capacity and budget"""
+        released, stale = [], []
+        wait = 0
+        with self._lock:
+            while self._queue and self._inflight < self.max_inflight and not self._closed:
+                job = self._queue[0]
+                if job.guard is not None and not job.guard():
+                    heapq.heappop(self._queue)
+                    stale.append(job)
+                    continue
+                wait = self._take_token()
+                if wait:
+                    break
+                heapq.heappop(self._queue)
+                self._inflight += 1
+                released.append(job)
+
+            schedule_refill = wait and not self._refill_pending and self._timers is not None
+            if schedule_refill:
+                self._refill_pending = True
+            self.stale += len(stale)
+
+        for job in stale:
+            job.future.cancel()
+        for job in released:
+            self._start(job)
+        if schedule_refill:
+            self._timers.call_later(wait, self._on_refill)
+
+    def _on_refill(self):
+        with self._lock:
+            self._refill_pending = False
+        self._pump()
+
+    def _start(self, job):
+        outer = job.future
+        if not outer.set_running_or_notify_cancel():
+            self._finish(completed=False)
+            return
+        try:
+            inner = self.executor.submit(job.fn, *job.args)
+        except Exception as e:
+            outer.set_exception(e)
+            self._finish()
+            return
+
+        def relay(f):
+            # Free the slot before running completions, which may submit follow-up work
+            self._finish()
+            try:
+                outer.set_result(f.result())
+            except BaseException as e:
+                outer.set_exception(e)
+
+        inner.add_done_callback(relay)
+
+    def _finish(self, completed=True):
+        with self._lock:
+            self._inflight -= 1
+            if completed:
+                self.completed += 1
+        try:
+            self._pump()
+        except Exception as e:
+            log_error(f"KDF admission pump failed: {e}")
+
+    def close(self):
+        """Stop releasing work before the process exits: queued jobs are cancelled and new
+        ones are refused; derivations already on the pool finish normally"""
+        with self._lock:
+            self._closed = True
+            dropped, self._queue = self._queue, []
+        for job in dropped:
+            job.future.cancel()
+
+    def queued(self):
+        return len(self._queue)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": len(self._queue),
+                "inflight": self._inflight,
+                "admitted": self.admitted,
+                "shed": self.shed,
+                "stale": self.stale,
+                "completed": self.completed,
+            }
@@ -0,0 +1,241 @@
+# On-disk snapshot of provisioning material and pairwise keys, for warm restarts
+
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+
+SNAPSHOT_MAGIC = b"EVKS"
+SNAPSHOT_VERSION = 1
+
+_FILE_HEADER = struct.Struct(">4sBH")     # magic, version, device GUID length (GUID follows)
+_RECORD_HEADER = struct.Struct(">BII")    # record type, payload length, crc32(type + payload)
+_KEY_RECORD = struct.Struct(">d32sB")     # timestamp, raw key, nonce length (nonce, then GUID follow)
+
+REC_PROVISION = 1       # JSON: {"payload": <provisioning fields>, "gateway": <guid>}
+REC_KEY = 2             # pairwise key stored or refreshed
+REC_DELETE = 3          # pairwise key removed
+REC_REVOKED_PEER = 4    # GUID added to known_revoked_peers
+REC_DEVICE_REVOKED = 5  # one byte: this device's revoked flag
+REC_REVOCATION_LIST = 6 # list version, then the sorted fingerprint array's raw bytes
+REC_PROVISION_DELTA = 7 # JSON: an applied provisioning delta, replayed on top of REC_PROVISION
+
+_LIST_VERSION = struct.Struct(">Q")
+
+# Longest nonce a key record can hold (its length is one byte); handlers refuse longer ones
+MAX_NONCE_LENGTH = 255
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _crc(record_type, payload):
+    return zlib.crc32(payload, zlib.crc32(bytes((record_type,))))
+
+
+def _pack_record(record_type, payload):
+    return _RECORD_HEADER.pack(record_type, len(payload), _crc(record_type, payload)) + payload
+
+
+def _open_private(path, flags, mode):
+    """open() for a file only the device's user may read: it holds secret_i, the vectors
+    and raw pairwise keys in plaintext"""
+    fd = os.open(path, flags, 0o600)
+    os.fchmod(fd, 0o600)  # also tightens a file created before we did this
+    return os.fdopen(fd, mode)
+
+
+def _pack_key(peer_guid, record):
+    nonce = record.nonce.encode()
+    return _KEY_RECORD.pack(record.timestamp, record.key, len(nonce)) + nonce + peer_guid.encode()
+
+
+class KeySnapshot:
+    """Append-only log of a device's EVKMS state.
+
+    Every change is appended as a CRC-checked record, so writes are small and a crash
+    can at worst leave a torn last record, which load() drops. The CRC only catches torn
+    or corrupted writes, not deliberate edits: the file is plaintext and protected by
+    being readable and writable by the device's user alone (0600). Loading maps the file
+    and walks the records in place, keeping only the latest state per peer. compact()
+    rewrites the log to just the live state (atomically, via a temp file) and runs
+    after batch changes such as refresh_all, or once the log is mostly superseded records.
+    """
+
+    def __init__(self, path, device_guid, compact_ratio=4):
+        self.path = path
+        self.device_guid = device_guid
+        self.compact_ratio = compact_ratio
+        self.gateway_guid = None
+        self.records = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _header(self):
+        guid = self.device_guid.encode()
+        return _FILE_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(guid)) + guid
+
+    # -------------------- loading --------------------
+
+    def load(self):
+        """Replay the log; returns the restored state, or None if there is no snapshot.
+
+        State: {"provisioning", "provisioning_deltas", "gateway", "keys": {guid: (key, nonce, timestamp)},
+        "revoked_peers", "revocation_list": (version, fingerprint bytes) or None,
+        "device_revoked", "records", "dropped_bytes"}
+        """
+        try:
+            with open(self.path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                if size == 0:
+                    return None
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as buf:
+                    state, good_end = self._replay(buf)
+        except FileNotFoundError:
+            return None
+
+        # Drop a torn or corrupt tail so new records are appended after valid data
+        state["dropped_bytes"] = size - good_end
+        if good_end < size:
+            with open(self.path, "r+b") as f:
+                f.truncate(good_end)
+
+        self.gateway_guid = state["gateway"]
+        self.records = state["records"]
+        return state
+
+    def _replay(self, buf):
+        try:
+            magic, version, guid_length = _FILE_HEADER.unpack_from(buf, 0)
+        except struct.error:
+            raise SnapshotError(f"{self.path} is not a key snapshot")
+        if magic != SNAPSHOT_MAGIC or version > SNAPSHOT_VERSION:
+            raise SnapshotError(f"{self.path} is not a version {SNAPSHOT_VERSION} key snapshot")
+
+        offset = _FILE_HEADER.size + guid_length
+        guid = bytes(buf[_FILE_HEADER.size:offset]).decode()
+        if guid != self.device_guid:
+            raise SnapshotError(f"{self.path} belongs to {guid}, not {self.device_guid}")
+
+        state = {
+            "provisioning": None,
+            "provisioning_deltas": [],
+            "gateway": None,
+            "keys": {},
+            "revoked_peers": set(),
+            "revocation_list": None,
+            "device_revoked": False,
+            "records": 0,
+        }
+        keys = state["keys"]
+        size = len(buf)
+
+        while offset + _RECORD_HEADER.size <= size:
+            record_type, length, crc = _RECORD_HEADER.unpack_from(buf, offset)
+            start = offset + _RECORD_HEADER.size
+            end = start + length
+            if end > size:
+                break
+            payload = buf[start:end]
+            if _crc(record_type, payload) != crc:
+                break
+
+            if record_type == REC_KEY:
+                timestamp, key, nonce_length = _KEY_RECORD.unpack_from(payload, 0)
+                nonce_end = _KEY_RECORD.size + nonce_length
+                nonce = bytes(payload[_KEY_RECORD.size:nonce_end]).decode()
+                keys[bytes(payload[nonce_end:]).decode()] = (key, nonce, timestamp)
+            elif record_type == REC_DELETE:
+                keys.pop(bytes(payload).decode(), None)
+            elif record_type == REC_PROVISION:
+                provision = json.loads(bytes(payload))
+                state["provisioning"] = provision["payload"]
+                state["gateway"] = provision.get("gateway")
+                state["provisioning_deltas"].clear()
+            elif record_type == REC_PROVISION_DELTA:
+                state["provisioning_deltas"].append(json.loads(bytes(payload)))
+            elif record_type == REC_REVOKED_PEER:
+                state["revoked_peers"].add(bytes(payload).decode())
+            elif record_type == REC_DEVICE_REVOKED:
+                state["device_revoked"] = bool(payload[0])
+            elif record_type == REC_REVOCATION_LIST:
+                (version,) = _LIST_VERSION.unpack_from(payload, 0)
+                state["revocation_list"] = (version, bytes(payload[_LIST_VERSION.size:]))
+                state["revoked_peers"].clear()  # the list record supersedes earlier single revocations
+
+            state["records"] += 1
+            offset = end
+
+        return state, offset
+
+    # -------------------- appending --------------------
+
+    def _append(self, *records):
+        with self._lock:
+            if self._file is None:
+                new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+                self._file = _open_private(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, "ab")
+                if new_file:
+                    self._file.write(self._header())
+            self._file.write(b"".join(records))
+            self._file.flush()
+            self.records += len(records)
+
+    def record_provisioning(self, payload, gateway_guid=None):
+        self.gateway_guid = gateway_guid
+        self._append(_pack_record(REC_PROVISION, json.dumps({"payload": payload, "gateway": gateway_guid}).encode()))
+
+    def record_provisioning_delta(self, delta):
+        self._append(_pack_record(REC_PROVISION_DELTA, json.dumps(delta).encode()))
+
+    def record_key(self, peer_guid, record):
+        self._append(_pack_record(REC_KEY, _pack_key(peer_guid, record)))
+
+    def record_delete(self, peer_guid):
+        self._append(_pack_record(REC_DELETE, peer_guid.encode()))
+
+    def record_revoked_peer(self, peer_guid):
+        self._append(_pack_record(REC_REVOKED_PEER, peer_guid.encode()))
+
+    def record_device_revoked(self, revoked):
+        self._append(_pack_record(REC_DEVICE_REVOKED, bytes((1 if revoked else 0,))))
+
+    def needs_compaction(self, live_records):
+        return self.records > self.compact_ratio * max(live_records, 16)
+
+    def compact(self, provisioning, keys, revocation_list, device_revoked):
+        """Rewrite the log as just the given live state; keys is an iterable of (guid, record)
+        and revocation_list a (version, fingerprint bytes) pair"""
+        records = []
+        if provisioning is not None:
+            records.append(_pack_record(REC_PROVISION,
+                json.dumps({"payload": provisioning, "gateway": self.gateway_guid}).encode()))
+        version, fingerprints = revocation_list
+        records.append(_pack_record(REC_REVOCATION_LIST, _LIST_VERSION.pack(version) + fingerprints))
+        if device_revoked:
+            records.append(_pack_record(REC_DEVICE_REVOKED, b"\x01"))
+        for peer_guid, record in keys:
+            records.append(_pack_record(REC_KEY, _pack_key(peer_guid, record)))
+
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            with _open_private(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, "wb") as f:
+                f.write(self._header())
+                f.write(b"".join(records))
+                f.flush()
+                os.fsync(f.fileno())
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(tmp_path, self.path)
+            self.records = len(records)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
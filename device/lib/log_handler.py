@@ -1,28 +1,248 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
 
 from lib.config import *
 
 
-def log_revocation(message):
+# Every device log record goes through the "evkms" logger. Callers only pay for a level
+# check and an enqueue: formatting and the write to stdout happen on a listener thread,
+# so handler latency doesn't depend on how fast stdout drains.
+
+_CATEGORIES = {
+    # category: (level, label shown before the message, ANSI color)
+    "info": (logging.INFO, "", "92"),
+    "warning": (logging.WARNING, "WARNING: ", "93"),
+    "error": (logging.ERROR, "ERROR: ", "91"),
+    "revocation": (logging.INFO, "REVOCATION: ", "95"),
+    "discovery": (logging.INFO, "DISCOVERY: ", "94"),
+    "key_mgmt": (logging.INFO, "KEY_MGMT: ", "96"),
+}
+
+_logger = logging.getLogger("evkms")
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Writes to whatever sys.stdout is at emit time (so redirect_stdout still captures it)"""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class ColorFormatter(logging.Formatter):
+    """The original console look: colored "[guid] CATEGORY: message" lines"""
+
+    def format(self, record):
+        _, label, color = _CATEGORIES.get(record.category, _CATEGORIES["info"])
+        line = f"\033[{color}m[{record.device}] {label}{record.getMessage()}{_suppressed(record)}\033[0m"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class PlainFormatter(logging.Formatter):
+    def format(self, record):
+        _, label, _ = _CATEGORIES.get(record.category, _CATEGORIES["info"])
+        line = f"{self.formatTime(record)} [{record.device}] {label}{record.getMessage()}{_suppressed(record)}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers"""
+
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "device": record.device,
+            "category": record.category,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def _suppressed(record):
+    count = getattr(record, "suppressed", 0)
+    return f" (+{count} similar suppressed)" if count else ""
+
+
+class CategoryRateFilter(logging.Filter):
+    """Caps records per second per category; warnings and errors always pass.
+
+    Dropped records are counted and the count rides along on the next record of that
+    category that gets through, so the output still says how much was left out.
+    """
+
+    def __init__(self, limits):
+        super().__init__()
+        self.limits = limits            # category -> records per second
+        self._windows = {}              # category -> [window start, count, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        limit = self.limits.get(record.category)
+        if not limit or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(record.category)
+            if window is None or now - window[0] >= 1.0:
+                window = self._windows[record.category] = [now, 0, window[2] if window else 0]
+            if window[1] >= limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+            record.suppressed, window[2] = window[2], 0
+        return True
+
+
+def _parse_limits(spec):
+    """"discovery=20,key_mgmt=50" -> {"discovery": 20.0, "key_mgmt": 50.0}"""
+    limits = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        category, _, rate = part.partition("=")
+        limits[category.strip()] = float(rate)
+    return limits
+
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues the record as is. The stock prepare() formats it first, on the logging
+    thread; here %-args and tracebacks are only formatted by the listener."""
+
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, rate_limits=LOG_RATE_LIMITS):
+    """(Re)build the evkms logger: queue handler in front, formatter and stdout behind
+    a QueueListener thread. Called on import with the LOG_* settings."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    formatter = {"json": JsonFormatter, "plain": PlainFormatter}.get(fmt, ColorFormatter)()
+    output = _StdoutHandler()
+    output.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    queue_handler = _RecordQueueHandler(records)
+    limits = _parse_limits(rate_limits) if isinstance(rate_limits, str) else dict(rate_limits or {})
+    if limits:
+        queue_handler.addFilter(CategoryRateFilter(limits))
+
+    _logger.handlers[:] = [queue_handler]
+    _logger.setLevel(level if isinstance(level, int) else logging.getLevelName(str(level).upper()))
+    _logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+
+def flush_logs():
+    """Write out everything queued so far (the listener keeps running)"""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+
+
+configure_logging()
+atexit.register(lambda: _listener and _listener.stop())
+
+
+class DeviceLog:
+    """Logging prefixed with one device's GUID.
+
+    Messages take %-style args that are only formatted if the record is actually
+    written: log.info("Key with %s", guid) costs a level check when INFO is off.
+    """
+
+    def __init__(self, device_guid):
+        self.device_guid = device_guid
+        self._extra = {
+            category: {"device": device_guid, "category": category} for category in _CATEGORIES
+        }
+
+    def _log(self, category, message, args):
+        level = _CATEGORIES[category][0]
+        if _logger.isEnabledFor(level):
+            _logger.log(level, message, *args, extra=self._extra[category])
+
+    def is_enabled(self, category="info"):
+        """For log lines whose arguments are expensive to compute"""
+        return _logger.isEnabledFor(_CATEGORIES[category][0])
+
+    def revocation(self, message, *args):
+        """Revocation-specific logging"""
+        self._log("revocation", message, args)
+
+    def info(self, message, *args):
+        """Clean info logging with device ID"""
+        self._log("info", message, args)
+
+    def warning(self, message, *args):
+        """Clean warning logging with device ID"""
+        self._log("warning", message, args)
+
+    def error(self, message, *args):
+        """Clean error logging with device ID"""
+        self._log("error", message, args)
+
+    def discovery(self, message, *args):
+        """Discovery-specific logging"""
+        self._log("discovery", message, args)
+
+    def key_mgmt(self, message, *args):
+        """Key management logging"""
+        self._log("key_mgmt", message, args)
+
+
+# Process-wide logger for the single-device mode (DEVICE_GUID from the environment)
+_default_log = DeviceLog(DEVICE_GUID)
+
+
+def log_revocation(message, *args):
     """Revocation-specific logging"""
-    print(f"\033[95m[{DEVICE_GUID}] REVOCATION: {message}\033[0m")
+    _default_log.revocation(message, *args)
 
 
-def log_info(message):
+def log_info(message, *args):
     """Clean info logging with device ID"""
-    print(f"\033[92m[{DEVICE_GUID}] {message}\033[0m")
+    _default_log.info(message, *args)
 
-def log_warning(message):
+def log_warning(message, *args):
     """Clean warning logging with device ID"""
-    print(f"\033[93m[{DEVICE_GUID}] WARNING: {message}\033[0m")
+    _default_log.warning(message, *args)
 
-def log_error(message):
+def log_error(message, *args):
     """Clean error logging with device ID"""
-    print(f"\033[91m[{DEVICE_GUID}] ERROR: {message}\033[0m")
+    _default_log.error(message, *args)
 
-def log_discovery(message):
+def log_discovery(message, *args):
     """Discovery-specific logging"""
-    print(f"\033[94m[{DEVICE_GUID}] DISCOVERY: {message}\033[0m")
+    _default_log.discovery(message, *args)
 
-def log_key_mgmt(message):
+def log_key_mgmt(message, *args):
     """Key management logging"""
-    print(f"\033[96m[{DEVICE_GUID}] KEY_MGMT: {message}\033[0m")    
\ No newline at end of file
+    _default_log.key_mgmt(message, *args)
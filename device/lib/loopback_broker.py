@@ -0,0 +1,246 @@
+# In-process MQTT stand-in: wildcard routing, QoS 0/1 delivery, injectable latency and loss
+
+import random
+import threading
+import time
+
+from lib.scheduler import TimerThread
+from lib.topic_router import TopicRouter
+
+
+class LoopbackMessage:
+    """Same attributes handlers read from paho's MQTTMessage"""
+
+    __slots__ = ("topic", "payload", "qos", "retain", "dup", "mid")
+
+    def __init__(self, topic, payload, qos=0, retain=False, dup=False, mid=0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.dup = dup
+        self.mid = mid
+
+
+class LoopbackPublishInfo:
+    """Stands in for paho's MQTTMessageInfo; loopback publishes are accepted immediately"""
+
+    __slots__ = ("rc", "mid")
+
+    def __init__(self, mid, rc=0):
+        self.rc = rc
+        self.mid = mid
+
+    def wait_for_publish(self, timeout=None):
+        return True
+
+    def is_published(self):
+        return True
+
+
+def _to_bytes(payload):
+    if payload is None:
+        return b""
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, (int, float)):
+        payload = str(payload)
+    return payload.encode()
+
+
+class LoopbackBroker:
+    """Routes publishes between LoopbackClients in the same process, no sockets involved.
+
+    Each delivery is scheduled on the broker's own timer thread after latency (+ uniform
+    jitter) seconds, so handlers run off the publisher's stack as they would with a real
+    broker. With loss > 0 each delivery is lost with that probability: QoS 0 messages
+    are simply dropped, QoS 1 ones are sent again after retry_interval (flagged dup),
+    and a delivered QoS 1 message is duplicated with the same probability to model a
+    lost PUBACK. The effective QoS is the lower of the publish and the subscription QoS.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, retry_interval=1.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.retry_interval = retry_interval
+        self._random = random.Random(seed)
+        self._router = TopicRouter()
+        self._timers = TimerThread()
+        self._lock = threading.Lock()
+        self._mid = 0
+
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.redelivered = 0
+        self.duplicates = 0
+        self.bytes_delivered = 0
+
+    def subscribe(self, client, pattern, qos):
+        with self._lock:
+            self._router.add_route(pattern, client, qos)
+
+    def unsubscribe_client(self, client):
+        """Drop every subscription a client holds (on disconnect)"""
+        with self._lock:
+            router = TopicRouter()
+            for route in self._router.routes:
+                if route.handler is not client:
+                    router.add_route(route.pattern, route.handler, route.qos)
+            self._router = router
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        payload = _to_bytes(payload)
+        with self._lock:
+            self.published += 1
+            self._mid += 1
+            mid = self._mid
+            # One copy per subscribed client, at the highest QoS any of its matching subscriptions asked for
+            targets = {}
+            for route in self._router.match(topic):
+                targets[route.handler] = max(targets.get(route.handler, 0), route.qos)
+
+        for client, sub_qos in targets.items():
+            msg = LoopbackMessage(topic, payload, min(qos, sub_qos), retain, mid=mid)
+            self._schedule(client, msg)
+        return mid
+
+    def _delay(self):
+        return self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def _schedule(self, client, msg, extra_delay=0.0):
+        self._timers.call_later(self._delay() + extra_delay, lambda: self._deliver(client, msg))
+
+    def _deliver(self, client, msg):
+        # Counters under the lock publish() counts under; the client callback runs outside it
+        with self._lock:
+            lost = self.loss and self._random.random() < self.loss
+            if lost and msg.qos == 0:
+                self.dropped += 1
+            elif lost:
+                self.redelivered += 1
+            else:
+                self.delivered += 1
+                self.bytes_delivered += len(msg.payload)
+                duplicate = msg.qos > 0 and self.loss and self._random.random() < self.loss
+                if duplicate:
+                    self.duplicates += 1
+        if lost:
+            if msg.qos > 0:
+                self._schedule(client, LoopbackMessage(msg.topic, msg.payload, msg.qos, msg.retain, True, msg.mid),
+                               self.retry_interval)
+            return
+
+        client._deliver(msg)
+
+        if duplicate:
+            self._schedule(client, LoopbackMessage(msg.topic, msg.payload, msg.qos, msg.retain, True, msg.mid),
+                           self.retry_interval)
+
+    def call_later(self, delay, callback):
+        """Run something on the broker's delivery thread (used for CONNACK)"""
+        return self._timers.call_later(delay, callback)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "published": self.published,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "redelivered": self.redelivered,
+                "duplicates": self.duplicates,
+                "bytes_delivered": self.bytes_delivered,
+            }
+
+
+class LoopbackClient:
+    """The slice of paho.mqtt.client.Client the device uses, backed by a LoopbackBroker.
+
+    Callbacks use paho's VERSION1 signatures and run on the broker's delivery thread.
+    """
+
+    def __init__(self, broker, client_id="", userdata=None):
+        self.broker = broker
+        self.client_id = client_id
+        self._userdata = userdata
+        self._connected = False
+        self._stopped = threading.Event()
+
+        self.on_connect = None
+        self.on_message = None
+        self.on_disconnect = None
+        self.on_publish = None
+
+        self.subscriptions = []
+        self.sent = 0
+        self.received = 0
+
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+
+    def enable_logger(self, logger=None):
+        pass
+
+    def connect(self, host=None, port=1883, keepalive=60):
+        self._connected = True
+        self._stopped.clear()
+        if self.on_connect:
+            self.broker.call_later(self.broker._delay(), lambda: self.on_connect(self, self._userdata, {}, 0))
+        return 0
+
+    def reconnect(self):
+        return self.connect()
+
+    def disconnect(self):
+        if not self._connected:
+            return 0
+        self._connected = False
+        self.broker.unsubscribe_client(self)
+        self.subscriptions = []
+        if self.on_disconnect:
+            self.on_disconnect(self, self._userdata, 0)
+        self._stopped.set()
+        return 0
+
+    def is_connected(self):
+        return self._connected
+
+    def subscribe(self, topic, qos=0):
+        """Accepts a single topic or a list of (topic, qos) pairs, like paho"""
+        subscriptions = topic if isinstance(topic, list) else [(topic, qos)]
+        for pattern, sub_qos in subscriptions:
+            self.broker.subscribe(self, pattern, sub_qos)
+            self.subscriptions.append((pattern, sub_qos))
+        return 0, 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if not self._connected:
+            return LoopbackPublishInfo(0, rc=4)  # MQTT_ERR_NO_CONN
+        self.sent += 1
+        mid = self.broker.publish(topic, payload, qos, retain)
+        if self.on_publish:
+            # PUBACK after one broker hop, as on a real connection
+            self.broker.call_later(self.broker._delay(), lambda: self._acked(mid))
+        return LoopbackPublishInfo(mid)
+
+    def _acked(self, mid):
+        if self._connected and self.on_publish:
+            self.on_publish(self, self._userdata, mid)
+
+    def _deliver(self, msg):
+        if not self._connected:
+            return
+        self.received += 1
+        if self.on_message:
+            self.on_message(self, self._userdata, msg)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def loop_forever(self):
+        """Block until disconnect(); delivery itself runs on the broker's thread"""
+        self._stopped.wait()
@@ -0,0 +1,370 @@
+# Counters, latency histograms and gauges for the device, exported as Prometheus text
+# over HTTP and/or as periodic JSON publishes on a metrics topic
+
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lib.config import METRICS_ENABLED, METRICS_HTTP_PORT, METRICS_PUBLISH_INTERVAL, METRICS_TOPIC_TEMPLATE
+
+
+# Seconds; covers a dispatch of a few microseconds up to a slow 100k-iteration PBKDF2
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# A handshake also waits on the broker and the peer's KDF queue, so it gets a longer tail
+HANDSHAKE_BUCKETS = LATENCY_BUCKETS + (10.0, 30.0, 60.0)
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """Cumulative-bucket histogram in Prometheus' shape"""
+
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Gauge:
+    """Read when collected, from a callable, so nothing is updated on the hot path"""
+
+    __slots__ = ("read",)
+
+    def __init__(self, read):
+        self.read = read
+
+    @property
+    def value(self):
+        try:
+            return self.read()
+        except Exception:
+            return float("nan")
+
+
+class MetricsRegistry:
+    """Metric families by name, each holding one metric per label set"""
+
+    def __init__(self):
+        self._families = {}   # name -> [type, help, {labels: metric}]
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, help_text, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            family = self._families.setdefault(name, [kind, help_text, {}])
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+    def counter(self, name, help_text, **labels):
+        return self._get("counter", name, help_text, labels, Counter)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS, **labels):
+        return self._get("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name, help_text, read, **labels):
+        return self._get("gauge", name, help_text, labels, lambda: Gauge(read))
+
+    def remove(self, **labels):
+        """Drop every metric carrying these labels (e.g. a device leaving the process)"""
+        wanted = set(labels.items())
+        with self._lock:
+            for family in self._families.values():
+                for key in [k for k in family[2] if wanted <= set(k)]:
+                    del family[2][key]
+
+    def _items(self):
+        with self._lock:
+            return [(name, kind, help_text, list(metrics.items()))
+                    for name, (kind, help_text, metrics) in sorted(self._families.items())]
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for name, kind, help_text, metrics in self._items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, metric in metrics:
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), metric.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_labels(key, le=le)} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(key)} {metric.sum}")
+                    lines.append(f"{name}_count{_labels(key)} {metric.count}")
+                else:
+                    lines.append(f"{name}{_labels(key)} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, **labels):
+        """{name: value} for the metrics carrying these labels; histograms as count/sum/buckets"""
+        wanted = set(labels.items())
+        result = {}
+        for name, kind, _, metrics in self._items():
+            for key, metric in metrics:
+                if not wanted <= set(key):
+                    continue
+                extra = [f"{k}={v}" for k, v in key if k not in labels]
+                full_name = f"{name}{{{','.join(extra)}}}" if extra else name
+                if kind == "histogram":
+                    result[full_name] = {"count": metric.count, "sum": metric.sum, "buckets": list(metric.counts)}
+                else:
+                    result[full_name] = metric.value
+        return result
+
+
+def merge_histograms(histograms):
+    """Sum same-bucketed histograms (Histogram objects or their snapshot dicts) into one
+    {"buckets", "counts", "sum", "count"} dict; None if there are none"""
+    merged = None
+    for h in histograms:
+        if isinstance(h, Histogram):
+            h = {"buckets": h.buckets, "counts": h.counts, "sum": h.sum, "count": h.count}
+        if merged is None:
+            merged = {"buckets": list(h["buckets"]), "counts": [0] * len(h["counts"]), "sum": 0.0, "count": 0}
+        merged["counts"] = [a + b for a, b in zip(merged["counts"], h["counts"])]
+        merged["sum"] += h["sum"]
+        merged["count"] += h["count"]
+    return merged
+
+
+def histogram_quantile(histogram, q):
+    """Estimate the q-quantile from a merged histogram, interpolating inside the bucket
+    like Prometheus' histogram_quantile; None when empty"""
+    if not histogram or not histogram["count"]:
+        return None
+    rank = q * histogram["count"]
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(histogram["buckets"], histogram["counts"]):
+        if count and cumulative + count >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    return histogram["buckets"][-1]  # in the +Inf bucket: the highest finite bound is all we know
+
+
+def _labels(key, **extra):
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+# Process-wide: one registry for every device context in the process
+registry = MetricsRegistry()
+
+
+class _NullMetric:
+    __slots__ = ()
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+_NULL = _NullMetric()
+
+
+class NullMetrics:
+    """What a device gets when metrics are disabled: every call is a no-op"""
+
+    enabled = False
+
+    def __getattr__(self, name):
+        return _NULL
+
+    def timed(self, name, handler):
+        return handler
+
+
+NULL_METRICS = NullMetrics()
+
+
+class DeviceMetrics:
+    """One device's metrics, bound to its device label in the shared registry"""
+
+    enabled = True
+
+    def __init__(self, ctx, registry=registry):
+        self.device_guid = ctx.device_guid
+        self.registry = registry
+        device = ctx.device_guid
+
+        def counter(name, help_text, **labels):
+            return registry.counter(name, help_text, device=device, **labels)
+
+        self.discoveries_sent = counter("evkms_discoveries_sent_total", "Discovery broadcasts sent")
+        self.discoveries_received = counter("evkms_discoveries_received_total", "Discovery messages from peers")
+        self.discovery_digest_mismatches = counter(
+            "evkms_digest_mismatches_total", "Digests that failed verification", kind="discovery")
+        self.response_digest_mismatches = counter(
+            "evkms_digest_mismatches_total", "Digests that failed verification", kind="key_response")
+        self.keys_established_responder = counter(
+            "evkms_keys_established_total", "Pairwise keys stored", role="responder")
+        self.keys_established_initiator = counter(
+            "evkms_keys_established_total", "Pairwise keys stored", role="initiator")
+        self.keys_confirmed = counter("evkms_keys_confirmed_total", "Keys a peer confirmed it holds too")
+        self.confirm_digest_mismatches = counter(
+            "evkms_digest_mismatches_total", "Digests that failed verification", kind="key_confirm")
+        self.keys_refreshed = counter("evkms_keys_refreshed_total", "Pairwise keys refreshed")
+        self.revocations = counter("evkms_revocations_total", "Revocation alerts applied")
+        self.discovery_replays = counter(
+            "evkms_discovery_drops_total", "Verified discoveries dropped before key derivation", reason="replay")
+        self.discovery_rate_limited = counter(
+            "evkms_discovery_drops_total", "Verified discoveries dropped before key derivation", reason="rate_limited")
+        self.kdf_mismatches = counter("evkms_kdf_mismatches_total", "Handshakes refused for announcing another KDF")
+        self.speculative_started = counter("evkms_speculative_keys_started_total",
+                                           "Key derivations started for a nonce before anyone answered")
+        self.speculative_hits = counter(
+            "evkms_speculative_key_claims_total", "Key responses matched to speculative keys", outcome="hit")
+        self.speculative_requeued = counter(
+            "evkms_speculative_key_claims_total", "Key responses matched to speculative keys", outcome="requeued")
+        self.speculative_misses = counter(
+            "evkms_speculative_key_claims_total", "Key responses matched to speculative keys", outcome="miss")
+        self.epoch_precompute_misses = counter(
+            "evkms_epoch_precompute_misses_total", "Epoch switches that had to build verifier state inline")
+        for kind in ("key_response", "status", "discovery", "metrics"):
+            setattr(self, f"outbound_dropped_{kind}", counter(
+                "evkms_outbound_dropped_total", "Publishes dropped from a full outbound queue", kind=kind))
+        self.outbound_coalesced = counter(
+            "evkms_outbound_coalesced_total", "Queued publishes replaced by a newer one with the same key")
+        self.outbound_ack_timeouts = counter(
+            "evkms_outbound_ack_timeouts_total", "Publishes whose PUBACK never came within OUTBOUND_ACK_TIMEOUT")
+
+        self.kdf_seconds = registry.histogram("evkms_kdf_seconds", "Pairwise key derivation time",
+                                              device=device)
+        self.publish_seconds = registry.histogram("evkms_publish_seconds", "Time spent in client.publish",
+                                                  device=device)
+        self.puback_seconds = registry.histogram("evkms_puback_seconds", "Publish to PUBACK (QoS 0: to socket write)",
+                                                 buckets=HANDSHAKE_BUCKETS, device=device)
+        self.handshake_seconds = registry.histogram(
+            "evkms_handshake_seconds", "Discovery broadcast to verified pairwise key (initiator side)",
+            buckets=HANDSHAKE_BUCKETS, device=device)
+
+        registry.gauge("evkms_discovery_nonces", "Outstanding discovery nonces",
+                       lambda: len(ctx.active_discovery_nonces), device=device)
+        registry.gauge("evkms_epoch", "Current vector epoch",
+                       lambda: ctx.device.evkms_state["epoch"], device=device)
+        registry.gauge("evkms_outbound_queued", "Publishes queued on this device's connection",
+                       lambda: len(ctx.outbound), device=device)
+        registry.gauge("evkms_pairwise_keys", "Pairwise keys held",
+                       lambda: len(ctx.device.evkms_state["pairwise_keys"]), device=device)
+        registry.gauge("evkms_discovery_interval_seconds", "Current discovery interval (0 = quiet)",
+                       lambda: ctx.discovery.interval or 0, device=device)
+        registry.gauge("evkms_discovery_coverage_ratio", "Share of expected peers with a confirmed key or revoked",
+                       lambda: _ratio(*ctx.discovery.coverage()), device=device)
+
+    def timed(self, name, handler):
+        """Wrap a (client, msg) route handler to record its run time under handler=name"""
+        histogram = self.registry.histogram("evkms_handler_seconds", "Message handler run time",
+                                            device=self.device_guid, handler=name)
+
+        def timed_handler(client, msg):
+            started = time.perf_counter()
+            try:
+                return handler(client, msg)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        return timed_handler
+
+    def snapshot(self):
+        return self.registry.snapshot(device=self.device_guid)
+
+
+def _ratio(covered, expected):
+    return covered / expected if expected else 0.0
+
+
+def metrics_for(ctx):
+    return DeviceMetrics(ctx) if METRICS_ENABLED else NULL_METRICS
+
+
+def timed_publish(metrics, client, topic, payload, qos=0):
+    """client.publish, timed into the device's publish histogram"""
+    if not metrics.enabled:
+        return client.publish(topic, payload, qos=qos)
+    started = time.perf_counter()
+    try:
+        return client.publish(topic, payload, qos=qos)
+    finally:
+        metrics.publish_seconds.observe(time.perf_counter() - started)
+
+
+# -------------------- exporters --------------------
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would otherwise print a line each
+
+
+_http_server = None
+
+
+def start_http_server(port=METRICS_HTTP_PORT, host="0.0.0.0"):
+    """Serve the registry at http://host:port/metrics from a daemon thread (once per process)"""
+    global _http_server
+    if _http_server is None and port:
+        _http_server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        threading.Thread(target=_http_server.serve_forever, name="evkms-metrics", daemon=True).start()
+    return _http_server
+
+
+def start_metrics_publisher(client, ctx, interval=METRICS_PUBLISH_INTERVAL):
+    """Publish the device's metrics as JSON every interval seconds (keyed, so reconnects don't stack)"""
+    if not ctx.metrics.enabled or interval <= 0:
+        return
+
+    def publish():
+        if not ctx.discovered_gateway_guid:
+            return
+        topic = METRICS_TOPIC_TEMPLATE.format(gateway_guid=ctx.discovered_gateway_guid, device_guid=ctx.device_guid)
+        # Only the newest snapshot is worth sending after an outage
+        ctx.outbound.publish(client, topic, json.dumps({
+            "deviceGuid": ctx.device_guid,
+            "timestamp": time.time(),
+            "metrics": ctx.metrics.snapshot(),
+        }), kind="metrics", coalesce_key=topic, metrics=ctx.metrics)
+
+    ctx.scheduler.call_periodic(interval, publish, key="metrics")
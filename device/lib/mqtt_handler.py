@@ -5,161 +5,200 @@ import random
 import time
 import paho.mqtt.client as mqtt   # type: ignore
 import json
+import hmac
 from lib.config import *
-from lib.evkms_core import EVKMSDevice
-from lib.utils import generate_nonce, compute_pairwise_digest, hash_key, start_periodic_task , compute_discovery_digest , get_sorted_guids
+from lib.utils import generate_nonce, compute_pairwise_digest, hash_key, get_sorted_guids
+from lib.metrics import start_http_server, start_metrics_publisher
+from lib.kdf import KDFError, peer_kdf
+from lib.key_snapshot import MAX_NONCE_LENGTH
+from lib.kdf_admission import PRIORITY_DISCOVERY, PRIORITY_KEY_RESPONSE
+from lib.wire_codec import (KEY_CONFIRM_WIRE, decode_discovery, decode_key_response, encode_discovery_for,
+                             encode_key_confirm_for, encode_key_response_for, note_peer_wire)
 from lib.actions.revocation_handler import handle_revocation_alert 
 
 
 from lib.actions.refresh_handler import handle_refresh_command 
 from lib.actions.handle_key_refresh_broadcast import handle_key_refresh_broadcast
+from lib.actions.provisioning_handler import handle_provisioning_message
 
-import lib.shared_state
 
-from lib.shared_state import reported_key_establishment ,  device  ,is_this_device_revoked
+def register_device_routes(router, ctx):
+    """Register one device's topics and handlers; the router also drives the subscriptions"""
 
-from lib.log_handler import log_info, log_warning, log_error, log_discovery, log_key_mgmt
+    # Provisioning config from the gateway
+    # Handlers are wrapped for run-time histograms when metrics are on (returned as-is otherwise)
+    timed = ctx.metrics.timed
 
+    # QoS 1 like the gateway publishes it: chunked transfers and deltas aren't retained,
+    # so one lost at QoS 0 costs a timeout and a full resync
+    router.add_route(CONFIG_TOPIC_TEMPLATE.format(device_guid=ctx.device_guid),
+                     timed("config", lambda client, msg: handle_config(client, ctx, msg)), qos=1)
 
+    # Refresh commands from the gateway
+    router.add_route(COMMAND_TOPIC_TEMPLATE.format(device_guid=ctx.device_guid),
+                     timed("commands", lambda client, msg: handle_refresh_command(client, ctx, msg.payload)))
+
+    # Targeted key responses to our discoveries
+    router.add_route(KEY_RESPONSE_TOPIC.format(target_guid=ctx.device_guid),
+                     timed("key_response", lambda client, msg: handle_key_response(client, ctx, msg)), qos=1)
+
+    # Subset discovery
+    router.add_route(DISCOVERY_TOPIC.format(subset_guid=ctx.subset_guid),
+                     timed("discovery", lambda client, msg: handle_discovery(client, ctx, msg)))
+
+    # Subset broadcast alerts
+    router.add_route(SUBSET_ALERT_TOPIC.format(subset_guid=ctx.subset_guid),
+                     timed("alerts", lambda client, msg: handle_revocation_alert(client, ctx, msg.payload)), qos=1)
+
+    # Subset-wide scheduled key refresh
+    router.add_route(KEY_REFRESH_TOPIC.format(subset_guid=ctx.subset_guid),
+                     timed("key_refresh", lambda client, msg: handle_key_refresh_broadcast(client, ctx, msg.payload)), qos=1)
 
-# Store our own sent nonces: { 'nonce_value': timestamp } to track active discoveries
-active_discovery_nonces = {} 
 
 
 def on_connect(client, userdata, flags, rc, properties=None):
+    ctx = userdata
+
     if rc == 0:
         
-        log_info("Connected to MQTT broker")
+        ctx.log.info("Connected to MQTT broker")
 
-        
-        # Subscribe to config topic
-        config_topic = CONFIG_TOPIC_TEMPLATE.format(device_guid=DEVICE_GUID)
-        client.subscribe(config_topic)
+        # Backlog from while we were down goes out first, key responses ahead of the rest
+        ctx.outbound.on_connect(client)
+        ctx.outbound.start_expiry(ctx.scheduler)
 
-        # Subscribe to command topic
-        command_topic = COMMAND_TOPIC_TEMPLATE.format(device_guid=DEVICE_GUID)
-        client.subscribe(command_topic)
+        subscription_count = ctx.router.subscribe_all(client)
+        ctx.log.info(f"Subscribed to all required topics ({subscription_count})")
 
-        # Subscribe to targeted key response topic
-        key_response_topic = KEY_RESPONSE_TOPIC.format(target_guid=DEVICE_GUID)
-        client.subscribe(key_response_topic, qos=1)
 
-        # Subscribe to discovery topic
-        discovery_subscription_topic = DISCOVERY_TOPIC.format(subset_guid=SUBSET_GUID)
-        client.subscribe(discovery_subscription_topic)
+        # Start discovery protocol
+        start_discovery(client, ctx, first_delay=0)
 
+        # Periodic metrics publishes (no-op unless METRICS_PUBLISH_INTERVAL is set)
+        start_metrics_publisher(client, ctx)
 
-         # Subscribe to subset broadcast alerts
-        subset_alert_topic = SUBSET_ALERT_TOPIC.format(subset_guid=SUBSET_GUID) 
-        client.subscribe(subset_alert_topic, qos=1)
+        
+    else:
+        ctx.log.error(f"Connection failed with code {rc}")
 
 
-        log_info("Subscribed to all required topics")
 
+def on_disconnect(client, userdata, rc, properties=None):
+    ctx = userdata
+    # Hold publishes in the bounded queue instead of paho's unbounded one until we're back
+    ctx.outbound.on_disconnect()
+    if rc != 0:
+        ctx.log.warning(f"Disconnected from MQTT broker (rc={rc})")
 
-        # Start discovery protocol
-        discovery_interval = random.uniform(60, 120)
-        start_periodic_task(discovery_interval , lambda: broadcast_discovery(client))
 
-        log_info(f"Started discovery protocol (interval: {discovery_interval:.1f}s)")
+def on_publish(client, userdata, mid, *args):
+    userdata.outbound.on_publish(mid)
+
 
-        
-    else:
-        log_error(f"Connection failed with code {rc}")
 
+def start_discovery(client, ctx, first_delay=None):
+    """(Re)start the device's discovery loop. The job is keyed, so calling this again
+    on every reconnect replaces the previous loop instead of adding another one.
+    The pacer backs it off as the mesh fills in and stops it once complete."""
 
+    discovery_interval = ctx.discovery.start(lambda: broadcast_discovery(client, ctx), first_delay)
 
-def broadcast_discovery(client):
+    ctx.log.info(f"Started discovery protocol (interval: {discovery_interval:.1f}s)")
+
+
+
+def broadcast_discovery(client, ctx):
+    device = ctx.device
 
     # Check if device is revoked
-    if is_this_device_revoked['value']:
-        log_error("Device is revoked, skipping discovery broadcast")
+    if device.is_this_device_revoked():
+        ctx.log.error("Device is revoked, skipping discovery broadcast")
         return
 
     if not device.evkms_state["secret_i"]: # Don't discover if not provisioned
-        log_warning("Not provisioned yet, skipping discovery broadcast")
+        ctx.log.warning("Not provisioned yet, skipping discovery broadcast")
         return
 
 
     # Generate nonce and track it 
     nonce = generate_nonce() 
 
-    active_discovery_nonces[nonce] = time.time() 
-
-
-
-    # Clean up old nonces 
-    # This prevents active_discovery_nonces from growing indefinitely
-
-    current_time = time.time()
-    nonces_to_delete = [n for n, t in active_discovery_nonces.items() if current_time - t > 60]
-    for n_del in nonces_to_delete:
-        del active_discovery_nonces[n_del]
+    # The nonce store expires it after DISCOVERY_NONCE_TTL and caps how many are outstanding
+    ctx.active_discovery_nonces.add(nonce, time.time())
 
 
     discovery_msg = {
-        "guid": DEVICE_GUID,
-        "subset": SUBSET_GUID,
+        "guid": ctx.device_guid,
+        "subset": ctx.subset_guid,
         "nonce": nonce,
-        "digest": compute_discovery_digest(
-                    device.evkms_state["secret_i"], 
-                    DEVICE_GUID, 
-                    nonce
-                    )
+        "digest": device.compute_own_discovery_digest(nonce),
+        "kdf": device.kdf.id
     }
     
 
     # Publish discovery
     
-    discovery_topic = DISCOVERY_TOPIC.format(subset_guid=SUBSET_GUID)
-
-    client.publish(discovery_topic, json.dumps(discovery_msg), qos=1)
-
-    log_discovery(f"Broadcasted discovery message (nonce: {nonce[:14]}...)")
+    discovery_topic = DISCOVERY_TOPIC.format(subset_guid=ctx.subset_guid)
+
+    # A discovery still queued from an outage is replaced by this one, not sent alongside it
+    ctx.outbound.publish(client, discovery_topic, encode_discovery_for(ctx, discovery_msg), qos=1,
+                         kind="discovery", coalesce_key=("discovery", ctx.device_guid), metrics=ctx.metrics)
+    ctx.metrics.discoveries_sent.inc()
+
+    # Everything but the responder is known now: start on the likely answers' keys
+    if ctx.speculative_keys is not None:
+        ctx.speculative_keys.start(nonce)
+
+    if ctx.log.is_enabled("discovery"):
+        nonce_stats = ctx.active_discovery_nonces.stats()
+        ctx.log.discovery(
+            "Broadcasted discovery message (nonce: %.14s...) [nonces outstanding=%d hits=%d misses=%d expired=%d]",
+            nonce, nonce_stats['size'], nonce_stats['hits'], nonce_stats['misses'], nonce_stats['expired']
+        )
 
 
 
-def handle_discovery(client, msg):
-    
+def handle_discovery(client, ctx, msg):
+    device = ctx.device
 
     if device.is_this_device_revoked(): # Uses the flag for this specific device (self-revocation)
-        log_error("This device is revoked, skipping handle discovery.")
+        ctx.log.error("This device is revoked, skipping handle discovery.")
         return
     
 
     if not device.evkms_state["secret_i"]:
-        log_warning("Not provisioned yet, ignoring discovery message")
+        ctx.log.warning("Not provisioned yet, ignoring discovery message")
         return # Not provisioned
 
 
     try:
-        data = json.loads(msg.payload)
+        data = decode_discovery(msg.payload) # Binary or JSON
         source_guid = data["guid"]
         nonce = data["nonce"] #This is Nonce_Source 
         received_digest = data["digest"]
         
         # Skip self-discovery
-        if source_guid == DEVICE_GUID:
+        if source_guid == ctx.device_guid:
             return   
+
+        # Our snapshot stores the nonce with the key it leads to; anything longer can't be kept
+        if not isinstance(nonce, str) or len(nonce.encode()) > MAX_NONCE_LENGTH:
+            ctx.log.warning("Ignoring discovery from %s with a malformed nonce", source_guid)
+            return
+
+        ctx.metrics.discoveries_received.inc()
         
 
 
         #drop any discovery from a revoked peer
         if device.is_peer_revoked(source_guid):
 
-            log_warning(f"Ignoring discovery from revoked device {source_guid}")
+            ctx.log.warning("Ignoring discovery from revoked device %s", source_guid)
 
             return
 
 
-        # CRITICAL FIX: Check if we already have a pairwise key with this peer
-        # If yes, ignore this discovery to prevent duplicate key establishment
-        if source_guid in device.evkms_state["pairwise_keys"]:
-            log_info(f"Already have pairwise key with {source_guid}, ignoring discovery")
-            return
-
-        
-        log_discovery(f"Received discovery from {source_guid}")
+        ctx.log.discovery("Received discovery from %s", source_guid)
 
         # 1- Calculate Digest and  Verify Digset
         # Extract neighbor's local ID
@@ -170,67 +209,165 @@ def handle_discovery(client, msg):
 
 
         if not neighbor_secret_s_source:
-            log_error(f"No secret found for {source_guid} in Vc")
+            ctx.log.error("No secret found for %s in Vc", source_guid)
             return
         
-        # Verify discovery digest
-        expected_digest = compute_discovery_digest(neighbor_secret_s_source, source_guid, nonce)
-        
-        
-        if expected_digest != received_digest:
-            log_error(f"Discovery digest mismatch from {source_guid}")
+        # Verify discovery digest (cached keyed HMAC, constant-time compare)
+        if not device.verify_discovery_digest(source_guid, neighbor_local_id, nonce, received_digest):
+            ctx.metrics.discovery_digest_mismatches.inc()
+            ctx.log.error("Discovery digest mismatch from %s", source_guid)
             return
-        
-        #2- Compute pairwise key
-        pairwise_key = device.compute_pairwise_key(source_guid, neighbor_secret_s_source, nonce)
 
+        note_peer_wire(ctx, source_guid, data)
 
-        guid_a, guid_b = get_sorted_guids(DEVICE_GUID, source_guid)
+        # Both sides must derive the same way or the keys won't match
+        if not kdf_agrees(ctx, source_guid, data):
+            return
 
-        response_digest_material = f"{guid_a}{guid_b}{nonce}"
-        
-        #Generate HMAC proof using the computed key
-        ack_digest = compute_pairwise_digest(pairwise_key, response_digest_material)
+        # Same source and nonce as a discovery we already handled: redelivery or replay
+        if ctx.discovery_filter.seen(source_guid, nonce):
+            ctx.metrics.discovery_replays.inc()
+            ctx.log.info("Dropping replayed discovery from %s (nonce: %.14s...)", source_guid, nonce)
+            return
+
+        # Already keyed: no second key (the peer may hold a confirmed copy of this one), but
+        # the peer is still discovering, so it may be missing our confirmation. If ours was
+        # never confirmed either, it may never have got our response: resume our own
+        # discovery, which it answers if it has no key, or confirms if it has ours.
+        key_info = device.evkms_state["pairwise_keys"].get(source_guid)
+        if key_info is not None:
+            ctx.log.info("Already have pairwise key with %s, confirming instead of deriving", source_guid)
+            send_key_confirmation(client, ctx, source_guid)
+            if not key_info.confirmed and ctx.peer_wire_versions.get(source_guid, 0) >= KEY_CONFIRM_WIRE:
+                ctx.discovery.wake("unconfirmed key")
+            return
+
+        # A verified peer we hold no key with: if our own discovery went quiet, resume it
+        ctx.discovery.wake("new peer")
         
+        # A derivation for this peer is already in flight (e.g. QoS-1 redelivery)
+        if source_guid in ctx.pending_key_derivations:
+            ctx.log.info("Key derivation with %s already in progress, ignoring discovery", source_guid)
+            return
 
-        # Send ACK
-        ack_topic = KEY_RESPONSE_TOPIC.format(target_guid=source_guid)
+        # Per-peer derivation budget, so one peer can't keep the KDF busy
+        if not ctx.discovery_filter.allow(source_guid):
+            ctx.metrics.discovery_rate_limited.inc()
+            ctx.log.warning("Discovery from %s over its derivation budget, dropping", source_guid)
+            return
 
+        #2- Compute pairwise key on the KDF pool; the ACK is sent from the completion
+        def on_key_derived(pairwise_key):
+            guid_a, guid_b = get_sorted_guids(ctx.device_guid, source_guid)
 
-        client.publish(ack_topic, json.dumps({
-            "source_guid": DEVICE_GUID,
-            "target_guid": source_guid,
-            "original_nonce": nonce,
-            "digest": ack_digest,
-            "timestamp": time.time()
-        }))
+            response_digest_material = f"{guid_a}{guid_b}{nonce}"
+            
+            #Generate HMAC proof using the computed key
+            ack_digest = compute_pairwise_digest(pairwise_key, response_digest_material)
+            
 
+            # Send ACK
+            ack_topic = KEY_RESPONSE_TOPIC.format(target_guid=source_guid)
 
-        
-        #Store tentative key until ACK is received
-        device.store_pairwise_key(source_guid, pairwise_key, nonce)
-        log_key_mgmt(f"Sent key response to {source_guid} and stored tentative key")
+
+            ctx.outbound.publish(client, ack_topic, encode_key_response_for(ctx, source_guid, {
+                "source_guid": ctx.device_guid,
+                "target_guid": source_guid,
+                "original_nonce": nonce,
+                "digest": ack_digest,
+                "timestamp": time.time(),
+                "kdf": device.kdf.id
+            }), kind="key_response", metrics=ctx.metrics)
+
+
+            
+            #Store tentative key until ACK is received
+            device.store_pairwise_key(source_guid, pairwise_key, nonce)
+            ctx.metrics.keys_established_responder.inc()
+            ctx.log.key_mgmt("Sent key response to %s and stored tentative key", source_guid)
+
+        # Still worth deriving once the admission queue gets to it?
+        def still_needed():
+            return (source_guid not in device.evkms_state["pairwise_keys"]
+                    and not device.is_peer_revoked(source_guid) and not device.is_this_device_revoked())
+
+        derive_pairwise_key(ctx, source_guid, PRIORITY_DISCOVERY, source_guid, neighbor_secret_s_source,
+                            nonce, on_key_derived, still_needed)
 
 
     except Exception as e:
-        log_error(f"Discovery handling error: {e}")
+        ctx.log.error("Discovery handling error: %s", e)
 
 
 
-def handle_key_response(client, userdata, msg):
+def kdf_agrees(ctx, peer_guid, data):
+    """Whether a peer's handshake announces our KDF (no announcement = the PBKDF2 default)"""
+    try:
+        theirs = peer_kdf(data)
+    except KDFError:
+        theirs = data.get("kdf")
+    if theirs == ctx.device.kdf.id:
+        return True
+    ctx.metrics.kdf_mismatches.inc()
+    ctx.log.warning("%s derives keys with %s, we use %s; skipping handshake", peer_guid, theirs, ctx.device.kdf.id)
+    return False
+
+
+def derive_pairwise_key(ctx, derivation_id, priority, peer_guid, peer_secret, nonce, on_key_derived, still_needed,
+                        attempt=0):
+    """Queue a pairwise key derivation through KDF admission. If it is shed under load
+    it is retried after a jittered, doubling backoff while still_needed() holds."""
+    ctx.pending_key_derivations.add(derivation_id)
+    epoch = ctx.device.evkms_state["epoch"]
+    future = ctx.device.compute_pairwise_key_async(peer_guid, peer_secret, nonce, on_key_derived,
+                                                   priority=priority, guard=still_needed)
+
+    def retry():
+        ctx.pending_key_derivations.discard(derivation_id)
+        if not still_needed():
+            return
+        secret = peer_secret
+        if ctx.device.evkms_state["epoch"] != epoch:
+            # The peer's secret we were given belongs to the Vc before the switch
+            secret = ctx.device.get_secret_from_vic(peer_guid.split("@")[-1])
+            if not secret:
+                return
+        derive_pairwise_key(ctx, derivation_id, priority, peer_guid, secret, nonce, on_key_derived,
+                            still_needed, attempt + 1)
+
+    def on_done(f):
+        if not f.cancelled() or attempt >= KDF_RETRY_MAX or not still_needed():
+            ctx.pending_key_derivations.discard(derivation_id)
+            return
+        # Shed: keep the pending marker so duplicates are still ignored while we back off
+        delay = KDF_RETRY_BASE * (2 ** attempt) * random.uniform(0.5, 1.5)
+        ctx.log.warning("KDF queue full, deferring derivation with %s by %.1fs", peer_guid, delay)
+        ctx.scheduler.call_later(delay, retry, key=("kdf_retry", derivation_id))
+
+    future.add_done_callback(on_done)
+    return future
+
+
+
+def handle_key_response(client, ctx, msg):
     """Processes a response to OUR discovery message."""
+    device = ctx.device
     
     if device.is_this_device_revoked():
-        log_error("This device is revoked, ignoring key response.")
+        ctx.log.error("This device is revoked, ignoring key response.")
         return
 
     if not device.evkms_state["secret_i"]: 
-        log_warning("Not provisioned yet, ignoring key response")
+        ctx.log.warning("Not provisioned yet, ignoring key response")
         return
 
     try:
 
-        data = json.loads(msg.payload.decode('utf-8')) # Decode buffer
+        data = decode_key_response(msg.payload) # Binary or JSON
+        if data.get("type") == "key_confirm":
+            handle_key_confirm(ctx, data)
+            return
+
         responder_guid = data["source_guid"]    # Who sent this response (e.g., Device B)
         intended_target_guid = data["target_guid"] # Should be us (e.g., Device A)
         our_original_nonce = data["original_nonce"] # The nonce from OUR discovery broadcast
@@ -238,21 +375,27 @@ def handle_key_response(client, userdata, msg):
 
 
 
-        if intended_target_guid != DEVICE_GUID:
+        if intended_target_guid != ctx.device_guid:
             return # This response isn't for us
 
 
+        # One lookup: its broadcast time is reused for the handshake latency below
+        broadcast_at = ctx.active_discovery_nonces.get(our_original_nonce)
+        if broadcast_at is None:
+            ctx.log.error("Received key response for unknown or expired nonce from %s", responder_guid)
+            return
 
-        if our_original_nonce not in active_discovery_nonces:
-            log_error(f"Received key response for unknown nonce from {responder_guid}")
-
-            active_discovery_nonces.pop(our_original_nonce, None) # Clean up if somehow missed
+        # Every peer answers the same broadcast nonce, so it stays valid until it expires;
+        # only skip a response we already turned into a key
+        key_info = device.evkms_state["pairwise_keys"].get(responder_guid)
+        if key_info and key_info.nonce == our_original_nonce:
+            ctx.log.info("Key with %s for nonce %.14s... already established, ignoring duplicate", responder_guid, our_original_nonce)
             return
 
 
 
 
-        log_key_mgmt(f"Received key response from {responder_guid} for our discovery (nonce: {our_original_nonce[:14]}...) Processing...")
+        ctx.log.key_mgmt("Received key response from %s for our discovery (nonce: %.14s...) Processing...", responder_guid, our_original_nonce)
 
 
 
@@ -263,168 +406,260 @@ def handle_key_response(client, userdata, msg):
         responder_secret_s_responder = device.get_secret_from_vic(responder_local_id)
 
         if not responder_secret_s_responder:
-            log_error(f"No secret found for {responder_guid} in Vc")
-            active_discovery_nonces.pop(our_original_nonce, None) # Clean up nonce
+            ctx.log.error("No secret found for %s in Vc", responder_guid)
+            return
+
+        if not kdf_agrees(ctx, responder_guid, data):
             return
 
 
 
         # Compute (or re-compute if not already done for this specific nonce context) the pairwise key
-        computed_key_with_responder = device.compute_pairwise_key(
-            responder_guid,                 
-            responder_secret_s_responder,   
-            our_original_nonce              
-        )
+        # on the KDF pool; verification and reporting run as the completion
+        def on_key_derived(computed_key_with_responder):
+            # Verify response digest
 
-        # Verify response digest
+            guid_a, guid_b = get_sorted_guids(ctx.device_guid, responder_guid)
 
-        guid_a, guid_b = get_sorted_guids(DEVICE_GUID, responder_guid)
+            expected_response_digest_material = f"{guid_a}{guid_b}{our_original_nonce}"
 
-        expected_response_digest_material = f"{guid_a}{guid_b}{our_original_nonce}"
+            expected_response_digest = compute_pairwise_digest(computed_key_with_responder, expected_response_digest_material)
 
-        expected_response_digest = compute_pairwise_digest(computed_key_with_responder, expected_response_digest_material)
 
 
+            if hmac.compare_digest(received_response_digest, expected_response_digest):
+                note_peer_wire(ctx, responder_guid, data)
 
-        if received_response_digest == expected_response_digest:
-                
-                log_key_mgmt(f"✓ Established verified pairwise key with {responder_guid} or nonce {our_original_nonce[:14]}... .")
+                ctx.log.key_mgmt("✓ Established verified pairwise key with %s or nonce %.14s... .", responder_guid, our_original_nonce)
 
 
                 # Key is confirmed. Store/update it and mark as verified.
-                device.store_pairwise_key(responder_guid, computed_key_with_responder, our_original_nonce)
-
-                active_discovery_nonces.pop(our_original_nonce, None) # This discovery for this nonce is now fully processed.
+                device.store_pairwise_key(responder_guid, computed_key_with_responder, our_original_nonce,
+                                          confirmed=True)
+                ctx.metrics.keys_established_initiator.inc()
+                # The responder only holds a tentative key until we tell it we have it too
+                send_key_confirmation(client, ctx, responder_guid)
+                ctx.metrics.handshake_seconds.observe(time.time() - broadcast_at)
 
 
                 # Inform server/gateway about this successfully established key (NEW)
                 # Report to gateway IF not already reported for this specific peer.
-                if not reported_key_establishment.get(responder_guid, False):
-                    if lib.shared_state.discovered_gateway_guid:
-                        
+                if not ctx.reported_key_establishment.get(responder_guid, False):
+                    if ctx.discovered_gateway_guid:
+                    
                         key_hash_for_server = hash_key(computed_key_with_responder) # Optional, but can be useful for logging/tracking without sending raw key
-                        
+                    
                         status_payload_for_server = {
-                            "deviceGuid": DEVICE_GUID, # This device
+                            "deviceGuid": ctx.device_guid, # This device
                             "status_type": "pairwise_key_established", # Clearer type
                             "peerDeviceGuid": responder_guid, # The other device
                             "keyContextNonce": our_original_nonce, # Context for this key establishment
                             "keyHash": key_hash_for_server, # Optional
                             "timestamp": time.time()
                         }
-                        status_topic = STATUS_TOPIC_TEMPLATE.format(
-                            gateway_guid=lib.shared_state.discovered_gateway_guid,
-                            device_guid=DEVICE_GUID
-                        )
-                        client.publish(status_topic, json.dumps(status_payload_for_server), qos=1)
+                        # Batched when STATUS_BATCH_WINDOW is set: this is the O(N^2) report
+                        ctx.status_reporter.report(client, status_payload_for_server)
 
-                        reported_key_establishment[responder_guid] = True
+                        ctx.reported_key_establishment[responder_guid] = True
 
 
-                        log_info(f"Reported key establishment with {responder_guid} to gateway")
+                        ctx.log.info("Reported key establishment with %s to gateway", responder_guid)
 
                 else:
-                    log_info(f"Key with {responder_guid} already reported, skipping gateway report.")
-        else:
+                    ctx.log.info("Key with %s already reported, skipping gateway report.", responder_guid)
+            else:
 
-            log_error(f"Key response digest mismatch from {responder_guid} for nonce {our_original_nonce[:14]}... .")
+                ctx.metrics.response_digest_mismatches.inc()
+                ctx.log.error("Key response digest mismatch from %s for nonce %.14s... .", responder_guid, our_original_nonce)
 
-                    
-            
-    except Exception as e:
-        log_error(f"Key response handling error: {e}")
+        derivation_id = (responder_guid, our_original_nonce)
+        if derivation_id in ctx.pending_key_derivations:
+            ctx.log.info("Key response from %s already being processed, ignoring duplicate", responder_guid)
+            return
 
+        def still_needed():
+            key_info = device.evkms_state["pairwise_keys"].get(responder_guid)
+            return (our_original_nonce in ctx.active_discovery_nonces
+                    and not (key_info and key_info.nonce == our_original_nonce)
+                    and not device.is_peer_revoked(responder_guid))
 
+        # Answers to our own nonces jump the admission queue ahead of inbound discoveries
+        def derive():
+            derive_pairwise_key(ctx, derivation_id, PRIORITY_KEY_RESPONSE, responder_guid,
+                                responder_secret_s_responder, our_original_nonce, on_key_derived, still_needed)
 
+        # A key derived speculatively at broadcast time turns this into a lookup
+        if ctx.speculative_keys is not None:
+            def on_speculative_key(key):
+                ctx.pending_key_derivations.discard(derivation_id)
+                on_key_derived(key)
 
-def on_message(client, userdata, msg):
-    """Main MQTT message handler"""
+            def fallback():
+                ctx.pending_key_derivations.discard(derivation_id)
+                derive()
 
-    if f"/devices/{DEVICE_GUID}/config" in msg.topic:
-        handle_config(client, msg)
-    
-    elif msg.topic == DISCOVERY_TOPIC.format(subset_guid=SUBSET_GUID):
-        handle_discovery(client, msg)
+            ctx.pending_key_derivations.add(derivation_id)
+            if ctx.speculative_keys.claim(responder_guid, our_original_nonce, on_speculative_key, fallback):
+                return
+            ctx.pending_key_derivations.discard(derivation_id)
+
+        derive()
+
+    except Exception as e:
+        ctx.log.error("Key response handling error: %s", e)
 
 
-    elif f"/devices/{DEVICE_GUID}/key_response" in msg.topic:
-        handle_key_response(client, userdata, msg)    
 
-    elif f"/subsets/{SUBSET_GUID}/broadcast_alerts" in msg.topic: # NEW
-        handle_revocation_alert(client, msg.payload)    
 
-    elif f"/devices/{DEVICE_GUID}/commands" in msg.topic:
-        handle_refresh_command(client, msg.payload)
+def send_key_confirmation(client, ctx, peer_guid):
+    """Prove to a peer that we hold the same key it does, so it can count the key as
+    confirmed (peers on an older wire version don't know the message and get none)"""
+    if ctx.peer_wire_versions.get(peer_guid, 0) < KEY_CONFIRM_WIRE:
+        return
+    confirmation = ctx.device.key_confirmation(peer_guid)
+    if confirmation is None:
+        return
+    nonce, digest = confirmation
+    ctx.outbound.publish(client, KEY_RESPONSE_TOPIC.format(target_guid=peer_guid), encode_key_confirm_for(ctx, peer_guid, {
+        "source_guid": ctx.device_guid,
+        "target_guid": peer_guid,
+        "original_nonce": nonce,
+        "digest": digest,
+    }), kind="key_response", coalesce_key=("key_confirm", peer_guid), metrics=ctx.metrics)
+
+
+def handle_key_confirm(ctx, data):
+    """A peer says it holds the same key we do"""
+    device = ctx.device
+    peer_guid = data["source_guid"]
+    if data["target_guid"] != ctx.device_guid or device.is_peer_revoked(peer_guid):
+        return
+    key_info = device.evkms_state["pairwise_keys"].get(peer_guid)
+    if key_info is None or key_info.confirmed:
+        return
+    if device.confirm_pairwise_key(peer_guid, data["original_nonce"], data["digest"]):
+        note_peer_wire(ctx, peer_guid, data)
+        ctx.metrics.keys_confirmed.inc()
+        ctx.log.key_mgmt("%s confirmed our pairwise key (nonce: %.14s...)", peer_guid, data["original_nonce"])
+        return
 
-    elif f"/subsets/{SUBSET_GUID}/key_refresh" in msg.topic:
-        handle_key_refresh_broadcast(client, msg.payload)    
+    ctx.metrics.confirm_digest_mismatches.inc()
+    # Both of us answered the other's discovery and both responses were lost: two tentative
+    # keys, neither side answering again. The lower GUID drops its key and answers the
+    # other's next discovery instead (at worst, a forged confirmation costs a re-handshake).
+    if get_sorted_guids(ctx.device_guid, peer_guid)[0] == ctx.device_guid:
+        device.remove_pairwise_key(peer_guid)
+        ctx.log.warning("Key confirmation from %s does not match our unconfirmed key, dropping it", peer_guid)
+    else:
+        ctx.log.warning("Key confirmation from %s does not match our unconfirmed key", peer_guid)
 
 
 
-def handle_config(client, msg):
+def on_message(client, userdata, msg):
+    """Main MQTT message handler (userdata is the DeviceContext)"""
+    userdata.router.dispatch(client, msg)
+
+
+
+def handle_config(client, ctx, msg):
     """Process provisioning config topic"""
 
     try:
-        
+        # An empty retained message only clears the config topic
+        if not msg.payload:
+            return
+
         payload = json.loads(msg.payload.decode('utf-8'))  # Decode buffer
 
         # Extract gateway GUID from topic
         topic_parts = msg.topic.split('/')
 
-        lib.shared_state.discovered_gateway_guid = topic_parts[1] # set the gateway Gid for comunication later
-        
-        # Store EVKMS material
-        device.load_evkms_payload(payload)
+        ctx.discovered_gateway_guid = topic_parts[1] # set the gateway Gid for comunication later
         
+        # Store EVKMS material (full payload, chunk or delta); None until something was applied
+        payload = handle_provisioning_message(client, ctx, payload)
+        if payload is None:
+            return
 
-        log_info(f"✓ Received and loaded provisioning config from gateway {lib.shared_state.discovered_gateway_guid}")
+        ctx.log.info(f"✓ Received and loaded provisioning config from gateway {ctx.discovered_gateway_guid}")
 
         # Acknowledge provisioning for the gateway wit hstatus topic 
-        status_topic = STATUS_TOPIC_TEMPLATE.format(
-            gateway_guid=lib.shared_state.discovered_gateway_guid,
-            device_guid=DEVICE_GUID
-        )
-        
-        client.publish(status_topic, json.dumps({
+        # Sent immediately: the gateway completes the provisioning task on it
+        ctx.status_reporter.report(client, {
             "status_type": "provisioned",
             "timestamp": time.time(),
             "taskId" : payload.get("taskId") , # Optional task ID for tracking 
-            "deviceGuid": DEVICE_GUID,
+            "deviceGuid": ctx.device_guid,
+            "provisioningVersion": ctx.device.evkms_state["provisioning_version"],
             # "key_hash": hash_key(device.evkms_state["secret_i"])
-        }), qos=1)
+        }, flush=True)
         
-        log_info("Sent provisioning acknowledgment to gateway")
+        ctx.log.info("Sent provisioning acknowledgment to gateway")
+
+        # Retry discovery shortly now that we hold secrets (and a possibly new peer set),
+        # instead of waiting for the next tick
+        if not ctx.discovery.wake("provisioned", delay=random.uniform(1, 5)):
+            ctx.scheduler.call_later(
+                random.uniform(1, 5),
+                lambda: broadcast_discovery(client, ctx),
+                key="discovery_retry"
+            )
     except Exception as e:
-        log_error(f"Config handling error: {e}")
+        ctx.log.error(f"Config handling error: {e}")
+
 
 
+def setup_mqtt(ctx=None, client=None, run_forever=True):
+    """Initialize MQTT client
 
-def setup_mqtt():
-    """Initialize MQTT client"""
+    ctx defaults to the process's device context and client to a paho client for
+    MQTT_BROKER; pass a LoopbackClient (lib.loopback_broker) to run without a broker.
+    With run_forever=False the network loop runs in the background and the client is returned.
+    """
+
+    if ctx is None:
+        # Imported here: it builds the single-device context, which fleet, farm and
+        # simulation processes (passing their own) must not get as a side effect
+        import lib.shared_state
+        ctx = lib.shared_state.context
+    register_device_routes(ctx.router, ctx)
+
+    # Opt-in Prometheus endpoint (METRICS_HTTP_PORT)
+    start_http_server()
 
     mqtt_logger = logging.getLogger('paho.mqtt')
     mqtt_logger.setLevel(logging.WARNING)
 
-    client = mqtt.Client(
-        client_id=DEVICE_GUID,
-        protocol=mqtt.MQTTv311,
-        callback_api_version=mqtt.CallbackAPIVersion.VERSION1
-    )
+    if client is None:
+        client = mqtt.Client(
+            client_id=ctx.device_guid,
+            protocol=mqtt.MQTTv311,
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION1,
+            userdata=ctx
+        )
+    else:
+        client.user_data_set(ctx)
     
     # client.enable_logger(logging.getLogger(__name__))
 
     client.enable_logger(mqtt_logger)
     client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_publish = on_publish
     client.on_message = on_message
     
     try:
-        log_info(f"Connecting to MQTT broker at {MQTT_BROKER}:1883...")
+        ctx.log.info(f"Connecting to MQTT broker at {MQTT_BROKER}:1883...")
         client.connect(MQTT_BROKER, 1883, 60)
-         
+
+        if not run_forever:
+            client.loop_start()
+            return client
+
         client.loop_forever()
         
     except Exception as e:
-        log_error(f"MQTT connection failed: {e}")
+        ctx.log.error(f"MQTT connection failed: {e}")
         logging.exception("MQTT connection error")
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+# Outbound publish queue: bounded, priority-ordered, with an inflight window per connection
+
+import heapq
+import itertools
+import threading
+import time
+
+from lib.config import OUTBOUND_QUEUE_MAX, OUTBOUND_INFLIGHT, OUTBOUND_ACK_TIMEOUT
+from lib.log_handler import log_error
+from lib.metrics import NULL_METRICS, timed_publish
+
+
+# Message classes, most urgent first. Under a full queue the least urgent, oldest
+# message goes first; a newcomer less urgent than everything queued is dropped itself.
+PRIORITIES = {
+    "key_response": 0,  # a peer is waiting on it to finish a handshake
+    "status": 1,        # gateway task acks and reports
+    "discovery": 2,     # the pacer broadcasts again anyway
+    "metrics": 3,       # only the latest snapshot matters
+}
+
+_NO_CONN = 4            # paho's MQTT_ERR_NO_CONN
+
+
+class _Outgoing:
+    __slots__ = ("priority", "seq", "topic", "payload", "qos", "kind", "coalesce_key", "metrics", "sent_at")
+
+    def __init__(self, priority, seq, topic, payload, qos, kind, coalesce_key, metrics):
+        self.priority = priority
+        self.seq = seq
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.kind = kind
+        self.coalesce_key = coalesce_key
+        self.metrics = metrics
+        self.sent_at = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundPublisher:
+    """Everything a connection publishes goes through here instead of client.publish.
+
+    At most max_inflight messages are handed to the client before their PUBACK (on_publish)
+    comes back, so paho's own queue never grows past the window; the rest wait in a
+    bounded priority queue. While the connection is down nothing is handed over at all,
+    and on reconnect the backlog drains most urgent first. A message published with a
+    coalesce_key replaces a still-queued one with the same key (a newer discovery or
+    metrics snapshot makes the older one pointless). Publish-to-PUBACK time is recorded
+    per message in its device's metrics.
+
+    max_inflight 0 turns the layer off: publishes go straight to the client as before.
+    """
+
+    def __init__(self, max_queue=OUTBOUND_QUEUE_MAX, max_inflight=OUTBOUND_INFLIGHT, ack_timeout=OUTBOUND_ACK_TIMEOUT,
+                 clock=time.perf_counter):
+        self.max_queue = max_queue
+        self.max_inflight = max_inflight
+        self.ack_timeout = ack_timeout
+        self._clock = clock
+        self.client = None
+        # Optimistic until told otherwise, so clients without connect callbacks still send
+        self.connected = True
+
+        self._queue = []            # heap of _Outgoing
+        self._coalesce = {}         # coalesce key -> queued _Outgoing
+        self._inflight = {}         # mid -> _Outgoing awaiting its PUBACK
+        self._early_acks = set()    # PUBACKs that beat publish() returning the mid
+        self._sending = 0           # taken off the queue, not yet handed to the client
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+        self.sent = 0
+        self.acked = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.ack_timeouts = 0
+
+    def publish(self, client, topic, payload, qos=0, kind="status", coalesce_key=None, metrics=NULL_METRICS):
+        """Queue one message; it goes out as soon as the window and connection allow"""
+        if self.max_inflight <= 0:
+            return timed_publish(metrics, client, topic, payload, qos=qos)
+
+        victim = None
+        with self._lock:
+            self.client = client
+            pending = self._coalesce.get(coalesce_key) if coalesce_key is not None else None
+            if pending is not None:
+                pending.topic, pending.payload, pending.qos, pending.metrics = topic, payload, qos, metrics
+                self.coalesced += 1
+            else:
+                entry = _Outgoing(PRIORITIES[kind], next(self._seq), topic, payload, qos, kind, coalesce_key, metrics)
+                if len(self._queue) >= self.max_queue:
+                    # Least urgent class, oldest message within it
+                    worst = max(self._queue, key=lambda e: (e.priority, -e.seq))
+                    if entry.priority <= worst.priority:
+                        self._queue.remove(worst)
+                        heapq.heapify(self._queue)
+                        victim = worst
+                    else:
+                        victim = entry
+                    self.dropped += 1
+                if victim is not entry:
+                    heapq.heappush(self._queue, entry)
+                    if coalesce_key is not None:
+                        self._coalesce[coalesce_key] = entry
+                if victim is not None and victim.coalesce_key is not None \
+                        and self._coalesce.get(victim.coalesce_key) is victim:
+                    del self._coalesce[victim.coalesce_key]
+
+        if pending is not None:
+            metrics.outbound_coalesced.inc()
+        if victim is not None:
+            getattr(victim.metrics, f"outbound_dropped_{victim.kind}").inc()
+        self._pump()
+
+    def _pump(self):
+        """Hand queued messages to the client while the window has room"""
+        while True:
+            with self._lock:
+                if (not self.connected or not self._queue or self.client is None
+                        or len(self._inflight) + self._sending >= self.max_inflight):
+                    return
+                entry = heapq.heappop(self._queue)
+                if entry.coalesce_key is not None and self._coalesce.get(entry.coalesce_key) is entry:
+                    del self._coalesce[entry.coalesce_key]
+                self._sending += 1
+                client = self.client
+
+            # Outside the lock: paho may run on_publish from its own thread while holding its
+            # message mutex, which publish() needs too
+            entry.sent_at = self._clock()
+            try:
+                info = timed_publish(entry.metrics, client, entry.topic, entry.payload, qos=entry.qos)
+            except Exception as e:
+                info = None
+                log_error(f"Publish to {entry.topic} failed: {e}")
+            self._sent(entry, info)
+
+    def _sent(self, entry, info):
+        mid = getattr(info, "mid", None)
+        rc = getattr(info, "rc", 0)
+        with self._lock:
+            self._sending -= 1
+            if rc == _NO_CONN and entry.qos == 0:
+                # Dropped by paho; keep it for the reconnect
+                self.connected = False
+                heapq.heappush(self._queue, entry)
+                return
+            # (QoS 1 with NO_CONN is kept by paho and resent on reconnect, so it stays inflight)
+            self.sent += 1
+            if mid is None:
+                return      # a client without PUBACK tracking
+            if mid in self._early_acks:
+                self._early_acks.discard(mid)
+            else:
+                self._inflight[mid] = entry
+                return
+        self._acked(entry)
+
+    def on_publish(self, mid):
+        """PUBACK (or, for QoS 0, written to the socket): frees a window slot"""
+        with self._lock:
+            entry = self._inflight.pop(mid, None)
+            if entry is None:
+                # Not registered yet; bounded in case mids from a dead session never show up
+                if len(self._early_acks) < 4 * max(1, self.max_inflight):
+                    self._early_acks.add(mid)
+                return
+        self._acked(entry)
+        self._pump()
+
+    def _acked(self, entry):
+        self.acked += 1
+        entry.metrics.puback_seconds.observe(self._clock() - entry.sent_at)
+
+    def start_expiry(self, scheduler):
+        """Check for lost PUBACKs every half ack_timeout (keyed, so reconnects don't stack)"""
+        if self.max_inflight > 0 and self.ack_timeout > 0:
+            scheduler.call_periodic(self.ack_timeout / 2, self.expire_inflight, key="outbound_expiry")
+
+    def expire_inflight(self):
+        """Give back the window slots of PUBACKs older than ack_timeout, then send what they held up"""
+        with self._lock:
+            deadline = self._clock() - self.ack_timeout
+            expired = [mid for mid, entry in self._inflight.items() if entry.sent_at < deadline]
+            entries = [self._inflight.pop(mid) for mid in expired]
+            self.ack_timeouts += len(entries)
+        for entry in entries:
+            entry.metrics.outbound_ack_timeouts.inc()
+        if entries:
+            self._pump()
+
+    def on_connect(self, client):
+        """Connection (re)established: drain the backlog, most urgent first"""
+        with self._lock:
+            self.client = client
+            self.connected = True
+        self._pump()
+
+    def on_disconnect(self):
+        with self._lock:
+            self.connected = False
+            # QoS 0 in flight is lost with the socket; QoS 1 is resent and acked by paho
+            for mid in [mid for mid, entry in self._inflight.items() if entry.qos == 0]:
+                del self._inflight[mid]
+
+    def __len__(self):
+        return len(self._queue)
+
+    def inflight(self):
+        return len(self._inflight) + self._sending
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": len(self._queue),
+                "inflight": len(self._inflight) + self._sending,
+                "sent": self.sent,
+                "acked": self.acked,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "ack_timeouts": self.ack_timeouts,
+            }
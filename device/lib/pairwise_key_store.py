@@ -0,0 +1,108 @@
+# Compact in-memory pairwise key table
+
+import hashlib
+import re
+import sys
+import time
+
+
+_NONCE_PREFIX = "NONCE_"
+
+
+# Only the exact form generate_nonce() produces: fromhex() would also take uppercase or
+# spaces, which wouldn't come back as the same string
+_RAW_NONCE = re.compile(r"NONCE_[0-9a-f]{16}")
+
+
+def _pack_nonce(nonce):
+    """generate_nonce() values ("NONCE_" + 16 lowercase hex chars) are kept as their 8 raw bytes"""
+    if _RAW_NONCE.fullmatch(nonce):
+        return bytes.fromhex(nonce[len(_NONCE_PREFIX):])
+    return nonce
+
+
+class PairwiseKey:
+    """One peer's key record: raw 32-byte key, packed nonce, establishment time, and whether
+    the peer has shown it holds the same key (a verified response or confirmation)"""
+
+    __slots__ = ("key", "_nonce", "timestamp", "confirmed")
+
+    def __init__(self, key, nonce, timestamp, confirmed=False):
+        self.key = key
+        self._nonce = _pack_nonce(nonce)
+        self.timestamp = timestamp
+        self.confirmed = confirmed
+
+    @property
+    def key_hex(self):
+        """The key as the hex string the handshake and refresh derivations are defined on"""
+        return self.key.hex()
+
+    @property
+    def nonce(self):
+        """The discovery nonce that led to this key"""
+        if isinstance(self._nonce, bytes):
+            return _NONCE_PREFIX + self._nonce.hex()
+        return self._nonce
+
+
+class PairwiseKeyStore:
+    """Pairwise keys by peer GUID, replacing the old dict of
+    {"key": <64 hex chars>, "nonce": <str>, "timestamp": <float>} per peer.
+
+    Records use __slots__ and raw bytes, and peer GUIDs are interned so the copies held
+    by other per-peer tables share one string.
+    """
+
+    def __init__(self):
+        self._records = {}
+
+    def put(self, peer_guid, key, nonce, timestamp=None, confirmed=False):
+        """Store (or replace) a key; key may be raw bytes or a hex string"""
+        if isinstance(key, str):
+            key = bytes.fromhex(key)
+        record = PairwiseKey(key, nonce, time.time() if timestamp is None else timestamp, confirmed)
+        self._records[sys.intern(peer_guid)] = record
+        return record
+
+    def get(self, peer_guid, default=None):
+        return self._records.get(peer_guid, default)
+
+    def pop(self, peer_guid, default=None):
+        return self._records.pop(peer_guid, default)
+
+    def __contains__(self, peer_guid):
+        return peer_guid in self._records
+
+    def __delitem__(self, peer_guid):
+        del self._records[peer_guid]
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(list(self._records))
+
+    def items(self):
+        return list(self._records.items())
+
+    def refresh(self, peer_guid, refresh_nonce):
+        """K'ij = Hash(Kij, r) for one peer; returns the record or None if there is no key"""
+        record = self._records.get(peer_guid)
+        if record:
+            record.key = hashlib.sha256(record.key.hex().encode('utf-8') + refresh_nonce.encode('utf-8')).digest()
+            record.timestamp = time.time()
+        return record
+
+    def refresh_all(self, refresh_nonce):
+        """K'ij = Hash(Kij, r) for every key in one pass; returns how many were refreshed"""
+        nonce_bytes = refresh_nonce.encode('utf-8')
+        sha256 = hashlib.sha256
+        now = time.time()
+
+        # Snapshot the records: KDF completions may add keys while we iterate
+        records = list(self._records.values())
+        for record in records:
+            record.key = sha256(record.key.hex().encode('utf-8') + nonce_bytes).digest()
+            record.timestamp = now
+        return len(records)
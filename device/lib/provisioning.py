@@ -0,0 +1,106 @@
+# Versioned provisioning: an order-independent checksum over the EVKMS vectors, and
+# reassembly of provisioning payloads sent in chunks
+#
+# Besides the original single JSON payload, the config topic carries:
+#
+#   {"type": "EVKMS_CHUNK", "transfer": id, "version": V, "seq": k, "total": n,
+#    "lengths": {"Vp": .., "Vc": .., "Vn": ..}, "vector": "Vc", "offset": i, "secrets": [...],
+#    + on seq 0: "secret_i", "alpha", "kdf", "checksum"; on the last seq: "taskId"}
+#
+#   {"type": "EVKMS_DELTA", "baseVersion": B, "version": V, "checksum": c, "taskId": ..,
+#    "changes": {"Vc": {"<index>": "<secret>", ...}, ...}, optional "secret_i" / "alpha"}
+
+import hashlib
+
+# Vector short names on the wire -> (evkms_state key, full-payload key)
+VECTORS = {
+    "Vp": ("vector_Vp", "Vectore_p"),
+    "Vc": ("vector_Vc", "Vectore_c"),
+    "Vn": ("vector_Vn", "Vectore_n"),
+}
+
+_MASK = (1 << 64) - 1
+
+
+def entry_hash(name, index, value):
+    return int.from_bytes(hashlib.sha256(f"{name}:{index}:{value}".encode()).digest()[:8], "big")
+
+
+def provisioning_checksum(payload):
+    """Sum (mod 2^64) of one hash per vector entry plus secret_i and alpha.
+
+    Being a sum, it can be patched per changed entry (subtract the old entry's hash, add
+    the new one), so a delta never needs a pass over the whole vectors.
+    """
+    total = entry_hash("i", 0, payload["secret_i"]) + entry_hash("alpha", 0, payload["alpha"])
+    for name, (_, payload_key) in VECTORS.items():
+        for index, secret in enumerate(payload[payload_key]):
+            total += entry_hash(name, index, secret)
+    return total & _MASK
+
+
+def format_checksum(value):
+    return f"{value:016x}"
+
+
+def add_entry(checksum, name, index, old, new):
+    """checksum with one entry changed from old to new (old None = newly appended)"""
+    if old is not None:
+        checksum -= entry_hash(name, index, old)
+    return (checksum + entry_hash(name, index, new)) & _MASK
+
+
+class ChunkAssembler:
+    """Rebuilds one chunked transfer in place: each vector is allocated once at its final
+    length from the first chunk seen, and chunks (in any order) fill their slices, so the
+    only copy held is the one that gets applied."""
+
+    def __init__(self, transfer, version, total, lengths):
+        self.transfer = transfer
+        self.version = version
+        self.total = total
+        self.header = None
+        self.task_id = None
+        self.vectors = {name: [None] * int(lengths.get(name, 0)) for name in VECTORS}
+        self._seen = set()
+
+    def add(self, chunk):
+        """Store one chunk; raises ValueError if it doesn't fit the announced shape"""
+        seq = chunk["seq"]
+        if seq in self._seen:
+            return  # QoS 1 redelivery
+        if not 0 <= seq < self.total:
+            raise ValueError(f"chunk {seq} outside 0..{self.total - 1}")
+        secrets = chunk.get("secrets") or []
+        if secrets:
+            vector = self.vectors[chunk["vector"]]
+            offset = chunk["offset"]
+            if offset < 0 or offset + len(secrets) > len(vector):
+                raise ValueError(f"chunk {seq} overruns {chunk['vector']} ({len(vector)} entries)")
+            vector[offset:offset + len(secrets)] = secrets
+        if "secret_i" in chunk:
+            self.header = {key: chunk.get(key) for key in ("secret_i", "alpha", "kdf", "checksum")}
+        if "taskId" in chunk:
+            self.task_id = chunk["taskId"]
+        self._seen.add(seq)
+
+    @property
+    def received(self):
+        return len(self._seen)
+
+    def complete(self):
+        return len(self._seen) == self.total and self.header is not None
+
+    def payload(self):
+        """The reassembled transfer in the single-message payload shape"""
+        payload = {
+            "secret_i": self.header["secret_i"],
+            "alpha": self.header["alpha"],
+            "kdf": self.header["kdf"],
+            "checksum": self.header["checksum"],
+            "version": self.version,
+            "taskId": self.task_id,
+        }
+        for name, (_, payload_key) in VECTORS.items():
+            payload[payload_key] = self.vectors[name]
+        return payload
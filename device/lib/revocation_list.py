@@ -0,0 +1,148 @@
+# Versioned revocation list: a Bloom filter in front of a sorted array of GUID fingerprints
+
+import hashlib
+import threading
+from array import array
+from bisect import bisect_left
+
+
+_BITS_PER_ENTRY = 10    # ~2% false positives, all confirmed against the array
+_MIN_CAPACITY = 1024
+
+
+def fingerprint(guid):
+    """64-bit GUID fingerprint; collisions are negligible at the list sizes we handle"""
+    return int.from_bytes(hashlib.blake2b(guid.encode(), digest_size=8).digest(), "big")
+
+
+def _bloom_mask(fp):
+    # Six bit positions within the word, from the fingerprint's low 36 bits
+    return ((1 << (fp & 63)) | (1 << ((fp >> 6) & 63)) | (1 << ((fp >> 12) & 63))
+            | (1 << ((fp >> 18) & 63)) | (1 << ((fp >> 24) & 63)) | (1 << ((fp >> 30) & 63)))
+
+
+class RevocationList:
+    """Revoked GUIDs as fingerprints: 8 bytes each in a sorted array('Q'), plus a Bloom
+    filter so the common case (peer not revoked) is answered in O(1) without searching
+    the array. A Bloom hit is confirmed by binary search, so there are no false positives.
+
+    The list carries the version of the gateway's revocation list it reflects. Revocation
+    only ever adds, so any delta whose base is at or below our version can be applied;
+    a base above it means we missed an update and need a full snapshot.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._fingerprints = array("Q")
+        self._capacity = 0
+        self._bloom = array("Q", (0,))
+        self._lock = threading.Lock()
+        self._rebuild_bloom(_MIN_CAPACITY)
+
+    # -------------------- bloom filter --------------------
+
+    # Blocked Bloom filter: each fingerprint sets 6 bits inside one 64-bit word, so a
+    # check is one array read and a mask compare instead of k scattered probes
+
+    def _rebuild_bloom(self, capacity, extra=()):
+        words = 1
+        while words * 64 < capacity * _BITS_PER_ENTRY:
+            words *= 2
+        # Built aside and swapped in, so lock-free readers never see a half-filled filter
+        bloom = array("Q", bytes(8 * words))
+        for fps in (self._fingerprints, extra):
+            for fp in fps:
+                bloom[(fp >> 32) & (words - 1)] |= _bloom_mask(fp)
+        self._capacity = capacity
+        self._bloom = bloom
+
+    def _bloom_add(self, fp):
+        bloom = self._bloom
+        bloom[(fp >> 32) & (len(bloom) - 1)] |= _bloom_mask(fp)
+
+    def _bloom_check(self, fp):
+        bloom = self._bloom
+        mask = _bloom_mask(fp)
+        return bloom[(fp >> 32) & (len(bloom) - 1)] & mask == mask
+
+    # -------------------- membership --------------------
+
+    def _contains_fp(self, fp):
+        if not self._bloom_check(fp):
+            return False
+        fps = self._fingerprints
+        i = bisect_left(fps, fp)
+        return i < len(fps) and fps[i] == fp
+
+    def __contains__(self, guid):
+        return self._contains_fp(fingerprint(guid))
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    # -------------------- updates --------------------
+
+    def _merge(self, new_fps):
+        """Merge fingerprints in one pass; returns how many were new"""
+        fresh = sorted({fp for fp in new_fps if not self._contains_fp(fp)})
+        if not fresh:
+            return 0
+        # Bloom bits go in before the array that confirms them, so a lock-free reader never
+        # sees a new fingerprint in the array that the filter still rejects
+        size = len(self._fingerprints) + len(fresh)
+        if size > self._capacity:
+            self._rebuild_bloom(max(self._capacity * 2, size), fresh)
+        else:
+            for fp in fresh:
+                self._bloom_add(fp)
+
+        if len(fresh) == 1:
+            fps = self._fingerprints
+            fps.insert(bisect_left(fps, fresh[0]), fresh[0])
+        else:
+            self._fingerprints = array("Q", sorted(self._fingerprints.tolist() + fresh))
+        return len(fresh)
+
+    def add(self, guid):
+        """Single revocation outside the versioned list (legacy REVOCATION_ALERT)"""
+        with self._lock:
+            return self._merge((fingerprint(guid),)) > 0
+
+    def add_many(self, guids):
+        with self._lock:
+            return self._merge(fingerprint(g) for g in guids)
+
+    def apply_snapshot(self, version, guids):
+        """Merge the gateway's full list at version. Returns False (and changes nothing) if
+        version is behind ours: a redelivered or reordered snapshot, or a gateway that lost
+        its list. Merging rather than replacing keeps what came in through alerts, since
+        revocation only ever adds."""
+        with self._lock:
+            if version < self.version:
+                return False
+            self._merge(fingerprint(g) for g in guids)
+            self.version = version
+            return True
+
+    def apply_delta(self, base_version, version, guids):
+        """Add the GUIDs revoked between base_version and version. Returns False (and
+        changes nothing) if base_version is ahead of ours: an update was missed."""
+        with self._lock:
+            if base_version > self.version:
+                return False
+            self._merge(fingerprint(g) for g in guids)
+            self.version = max(self.version, version)
+            return True
+
+    # -------------------- persistence --------------------
+
+    def to_bytes(self):
+        with self._lock:
+            return self._fingerprints.tobytes()
+
+    def load_bytes(self, version, data):
+        fps = array("Q")
+        fps.frombytes(data)
+        with self._lock:
+            self._merge(fps)
+            self.version = max(self.version, version)
@@ -0,0 +1,201 @@
+# Timers for discovery ticks and retries, without a thread per tick
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+from lib.log_handler import log_error
+
+
+class TimerHandle:
+    """Cancellable handle for one scheduled callback"""
+
+    __slots__ = ("when", "callback", "cancelled")
+
+    def __init__(self, when, callback):
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerThread:
+    """A heap of timers serviced by one daemon thread.
+
+    Same call_later(delay, callback) shape as an asyncio loop, so a Scheduler can run
+    on either. Cancelled handles are dropped lazily when they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay, callback):
+        handle = TimerHandle(time.monotonic() + delay, callback)
+        with self._cond:
+            heapq.heappush(self._heap, (handle.when, next(self._counter), handle))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="evkms-timers", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return handle
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    when, _, handle = self._heap[0]
+                    if handle.cancelled:
+                        heapq.heappop(self._heap)
+                        continue
+                    delay = when - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        break
+                    self._cond.wait(delay)
+
+            try:
+                handle.callback()
+            except Exception as e:
+                log_error(f"Scheduled task failed: {e}")
+
+
+class _LoopTimer:
+    """One timer on an asyncio loop, armed and cancelled from whichever thread asks"""
+
+    __slots__ = ("_loop", "_callback", "_handle", "cancelled")
+
+    def __init__(self, loop, callback):
+        self._loop = loop
+        self._callback = callback
+        self._handle = None
+        self.cancelled = False
+
+    def _arm(self, delay):
+        if not self.cancelled:
+            self._handle = self._loop.call_later(delay, self._run)
+
+    def _run(self):
+        if not self.cancelled:
+            self._callback()
+
+    def _cancel_handle(self):
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def cancel(self):
+        self.cancelled = True
+        if _on_loop_thread(self._loop):
+            self._cancel_handle()
+        else:
+            self._loop.call_soon_threadsafe(self._cancel_handle)
+
+
+def _on_loop_thread(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+class LoopTimers:
+    """TimerThread's call_later on an asyncio loop, safe to call from any thread.
+
+    Loop methods are not thread-safe, but jobs get scheduled and cancelled from KDF
+    workers and the timer thread too: off the loop thread the call is handed over with
+    call_soon_threadsafe, and the returned handle can be cancelled before it is armed.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def call_later(self, delay, callback):
+        timer = _LoopTimer(self.loop, callback)
+        if _on_loop_thread(self.loop):
+            timer._arm(delay)
+        else:
+            self.loop.call_soon_threadsafe(timer._arm, delay)
+        return timer
+
+
+# Shared by every device in the process unless it is given an event loop instead
+_default_timers = TimerThread()
+
+
+class Scheduler:
+    """Per-device jobs on a shared timer backend (a TimerThread or an asyncio loop).
+
+    Jobs are keyed: scheduling a key that is already pending replaces it, so repeated
+    calls (e.g. on every reconnect) never stack up duplicate loops.
+    """
+
+    def __init__(self, backend=None):
+        if isinstance(backend, asyncio.AbstractEventLoop):
+            backend = LoopTimers(backend)
+        self._backend = backend or _default_timers
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def call_later(self, delay, callback, key=None):
+        """Run callback once after delay seconds; returns the handle"""
+        key = key if key is not None else object()
+
+        def run():
+            with self._lock:
+                if self._jobs.get(key) is handle:
+                    del self._jobs[key]
+            callback()
+
+        with self._lock:
+            handle = self._backend.call_later(delay, run)
+            self._replace(key, handle)
+        return handle
+
+    def call_periodic(self, interval, callback, key, first_delay=None):
+        """Run callback every interval seconds until the key is cancelled or replaced"""
+
+        def run():
+            with self._lock:
+                if self._jobs.get(key) is not state["handle"]:
+                    return  # replaced or cancelled while this tick was due
+                # Re-arm before running so a failing tick doesn't end the loop
+                state["handle"] = self._backend.call_later(interval, run)
+                self._jobs[key] = state["handle"]
+            callback()
+
+        state = {}
+        with self._lock:
+            state["handle"] = self._backend.call_later(interval if first_delay is None else first_delay, run)
+            self._replace(key, state["handle"])
+        return state["handle"]
+
+    def cancel(self, key):
+        with self._lock:
+            handle = self._jobs.pop(key, None)
+        if handle:
+            handle.cancel()
+
+    def cancel_all(self):
+        with self._lock:
+            handles, self._jobs = list(self._jobs.values()), {}
+        for handle in handles:
+            handle.cancel()
+
+    def pending(self):
+        """Number of jobs currently scheduled"""
+        return len(self._jobs)
+
+    def _replace(self, key, handle):
+        old = self._jobs.get(key)
+        if old:
+            old.cancel()
+        self._jobs[key] = handle
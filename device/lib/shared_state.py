@@ -1,15 +1,7 @@
-
-from lib.evkms_core import EVKMSDevice
+from lib.device_context import DeviceContext
 from lib.config import *
 
 
-is_this_device_revoked = {"value": False}
-
-
-reported_key_establishment = {}
-
-
-discovered_gateway_guid = None
-
-
-device = EVKMSDevice(DEVICE_GUID, SUBSET_GUID)
+# The single device this process runs in the default (one container per device) mode.
+# Fleet mode builds its own contexts from a roster instead.
+context = DeviceContext(DEVICE_GUID, SUBSET_GUID)
@@ -0,0 +1,119 @@
+# Speculative pairwise key derivation for our own discovery nonces (SPECULATIVE_KDF=1)
+#
+# When we broadcast a nonce we already hold every input to compute_pairwise_key except
+# who will answer. So keys for the expected peers we have no key with start deriving
+# right away, at the lowest KDF priority, and a key response finds its key ready (or
+# already running) instead of starting the derivation only once it arrives.
+
+import threading
+
+from lib.config import DISCOVERY_NONCE_TTL, SPECULATIVE_KDF_MAX
+from lib.expiring_map import ExpiringMap
+from lib.kdf_admission import PRIORITY_SPECULATIVE
+
+
+class _Speculation:
+    """One speculative derivation and whoever is waiting on it"""
+
+    __slots__ = ("future", "key", "waiters", "lock")
+
+    def __init__(self):
+        self.future = None
+        self.key = None
+        self.waiters = []       # (on_key, fallback); None once the outcome is known
+        self.lock = threading.Lock()
+
+    def resolve(self, key):
+        with self.lock:
+            self.key = key
+            waiters, self.waiters = self.waiters or [], None
+        for on_key, _ in waiters:
+            on_key(key)
+
+    def on_done(self, future):
+        # A derivation that was shed or failed never resolves: hand waiters back to the normal path
+        if not future.cancelled() and future.exception() is None:
+            return
+        with self.lock:
+            waiters, self.waiters = self.waiters or [], None
+        for _, fallback in waiters:
+            fallback()
+
+    def wait(self, on_key, fallback):
+        """Run on_key with the key now or once it is derived; False if it never will be"""
+        with self.lock:
+            if self.key is None:
+                if self.waiters is None:
+                    return False
+                self.waiters.append((on_key, fallback))
+                return True
+            key = self.key
+        on_key(key)
+        return True
+
+
+class SpeculativeKeys:
+    """Speculative derivations per (peer, nonce), kept as long as the nonce stays valid"""
+
+    def __init__(self, ctx, max_peers=SPECULATIVE_KDF_MAX, ttl=DISCOVERY_NONCE_TTL):
+        self.ctx = ctx
+        self.max_peers = max_peers
+        self._entries = ExpiringMap(ttl, max(1, max_peers) * 4)
+        self._cursor = 0    # where the next broadcast starts in the expected peer list
+
+    def start(self, nonce):
+        """Start deriving keys for un-keyed expected peers under our new nonce; returns how many"""
+        ctx = self.ctx
+        device = ctx.device
+        keys = device.evkms_state["pairwise_keys"]
+        peers = ctx.discovery.expected_peers()
+        started = scanned = 0
+        # Rotate through the list so peers that never answer don't take every slot
+        while scanned < len(peers) and started < self.max_peers:
+            peer_guid = peers[(self._cursor + scanned) % len(peers)]
+            scanned += 1
+            if peer_guid in keys or device.is_peer_revoked(peer_guid):
+                continue
+            secret = device.get_secret_from_vic(peer_guid.rpartition("@")[2])
+            if secret:
+                self._start_one(peer_guid, secret, nonce)
+                started += 1
+        if peers:
+            self._cursor = (self._cursor + scanned) % len(peers)
+        ctx.metrics.speculative_started.inc(started)
+        return started
+
+    def _start_one(self, peer_guid, secret, nonce):
+        device = self.ctx.device
+        active_nonces = self.ctx.active_discovery_nonces
+
+        def still_wanted():
+            return (nonce in active_nonces and peer_guid not in device.evkms_state["pairwise_keys"]
+                    and not device.is_peer_revoked(peer_guid) and not device.is_this_device_revoked())
+
+        speculation = _Speculation()
+        speculation.future = device.compute_pairwise_key_async(peer_guid, secret, nonce, speculation.resolve,
+                                                               priority=PRIORITY_SPECULATIVE, guard=still_wanted)
+        speculation.future.add_done_callback(speculation.on_done)
+        self._entries.add((peer_guid, nonce), speculation)
+
+    def claim(self, peer_guid, nonce, on_key, fallback):
+        """Hand a key response to the speculative derivation for (peer, nonce). on_key gets the
+        key (right away if it is ready); fallback runs if the derivation is shed after all.
+        Returns False if there is nothing to claim and the caller should derive itself."""
+        speculation = self._entries.pop((peer_guid, nonce))
+        if speculation is None:
+            self.ctx.metrics.speculative_misses.inc()
+            return False
+        # Still queued behind other work: the caller re-derives at response priority instead
+        if speculation.future.cancel():
+            self.ctx.metrics.speculative_requeued.inc()
+            return False
+        if not speculation.wait(on_key, fallback):
+            self.ctx.metrics.speculative_misses.inc()
+            return False
+        self.ctx.metrics.speculative_hits.inc()
+        return True
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,82 @@
+# Gateway status reporting, optionally coalesced into status_batch messages
+
+import json
+import threading
+import time
+
+from lib.config import STATUS_TOPIC_TEMPLATE, STATUS_BATCH_WINDOW, STATUS_BATCH_MAX
+
+
+# Status types that only say "this is where I am now" (no taskId to complete): a newer one
+# still queued from an outage replaces the older instead of making the gateway act twice
+LATEST_ONLY = {"provisioning_resync", "revocation_resync"}
+
+
+class StatusReporter:
+    """Publishes a device's status events to its gateway.
+
+    With batching enabled (window > 0) events are collected for up to `window` seconds
+    or `max_size` events and sent as one status_batch message. report(..., flush=True)
+    bypasses the batch for latency-critical events, sending anything pending first so
+    the gateway still sees events in order.
+    """
+
+    def __init__(self, ctx, window=STATUS_BATCH_WINDOW, max_size=STATUS_BATCH_MAX):
+        self.ctx = ctx
+        self.window = window
+        self.max_size = max_size
+        self._pending = []
+        self._client = None
+        self._lock = threading.Lock()
+
+    def report(self, client, payload, flush=False):
+        """Queue or send one status event; returns False if no gateway is known yet"""
+        if not self.ctx.discovered_gateway_guid:
+            return False
+
+        if self.window <= 0 or flush:
+            self.flush(client)
+            self._publish(client, payload)
+            return True
+
+        with self._lock:
+            self._client = client
+            self._pending.append(payload)
+            full = len(self._pending) >= self.max_size
+            first = len(self._pending) == 1
+
+        if full:
+            self.flush(client)
+        elif first:
+            self.ctx.scheduler.call_later(self.window, self.flush, key="status_flush")
+        return True
+
+    def flush(self, client=None):
+        """Send everything pending as a single status_batch message"""
+        with self._lock:
+            events, self._pending = self._pending, []
+            client = client or self._client
+        self.ctx.scheduler.cancel("status_flush")
+
+        if not events:
+            return
+        if len(events) == 1:
+            self._publish(client, events[0])
+            return
+
+        self._publish(client, {
+            "status_type": "status_batch",
+            "deviceGuid": self.ctx.device_guid,
+            "timestamp": time.time(),
+            "events": events,
+        })
+
+    def _publish(self, client, payload):
+        status_topic = STATUS_TOPIC_TEMPLATE.format(
+            gateway_guid=self.ctx.discovered_gateway_guid,
+            device_guid=self.ctx.device_guid
+        )
+        status_type = payload.get("status_type")
+        coalesce_key = (status_topic, status_type) if status_type in LATEST_ONLY else None
+        self.ctx.outbound.publish(client, status_topic, json.dumps(payload), qos=1, kind="status",
+                                  coalesce_key=coalesce_key, metrics=self.ctx.metrics)
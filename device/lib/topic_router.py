@@ -0,0 +1,109 @@
+# Topic trie: routes incoming MQTT messages to handlers and drives subscriptions
+
+class Route:
+    """One registered (pattern, handler, qos) entry with its dispatch counter"""
+
+    __slots__ = ("pattern", "handler", "qos", "dispatched")
+
+    def __init__(self, pattern, handler, qos):
+        self.pattern = pattern
+        self.handler = handler
+        self.qos = qos
+        self.dispatched = 0
+
+
+class _Node:
+    __slots__ = ("children", "routes", "hash_routes")
+
+    def __init__(self):
+        self.children = {}      # level -> _Node ('+' is stored as a child like any other level)
+        self.routes = []        # routes whose pattern ends at this node
+        self.hash_routes = []   # routes whose pattern ends with '#' below this node
+
+
+class TopicRouter:
+    """Routes messages to every handler whose MQTT pattern matches the topic.
+
+    Patterns are compiled into a trie once, so matching costs O(topic levels) with no
+    string formatting per message. Several routes may share a pattern (fleet mode
+    registers the same subset topic once per device); each gets the message and the
+    broker subscription is made once.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self.routes = []
+        self.unmatched = 0
+
+    def add_route(self, pattern, handler, qos=0):
+        """Register handler(client, msg) for an MQTT topic pattern (+ and # allowed)"""
+        route = Route(pattern, handler, qos)
+        node = self._root
+        levels = pattern.split("/")
+        for i, level in enumerate(levels):
+            if level == "#":
+                if i != len(levels) - 1:
+                    raise ValueError(f"'#' must be the last level in {pattern}")
+                node.hash_routes.append(route)
+                break
+            node = node.children.setdefault(level, _Node())
+        else:
+            node.routes.append(route)
+
+        self.routes.append(route)
+        return route
+
+    def match(self, topic):
+        """All routes whose pattern matches the topic"""
+        matched = []
+        nodes = [self._root]
+        for level in topic.split("/"):
+            next_nodes = []
+            for node in nodes:
+                matched.extend(node.hash_routes)
+                child = node.children.get(level)
+                if child:
+                    next_nodes.append(child)
+                plus = node.children.get("+")
+                if plus:
+                    next_nodes.append(plus)
+            if not next_nodes:
+                return matched
+            nodes = next_nodes
+
+        for node in nodes:
+            matched.extend(node.routes)
+            matched.extend(node.hash_routes)  # 'a/#' also matches 'a'
+        return matched
+
+    def dispatch(self, client, msg):
+        """Hand the message to every matching route; returns how many handled it"""
+        routes = self.match(msg.topic)
+        if not routes:
+            self.unmatched += 1
+        for route in routes:
+            route.dispatched += 1
+            route.handler(client, msg)
+        return len(routes)
+
+    def subscriptions(self):
+        """Distinct (pattern, qos) pairs, using the highest qos any route asked for"""
+        qos_by_pattern = {}
+        for route in self.routes:
+            qos_by_pattern[route.pattern] = max(route.qos, qos_by_pattern.get(route.pattern, 0))
+        return list(qos_by_pattern.items())
+
+    def subscribe_all(self, client, batch_size=100):
+        """Subscribe the client to every registered pattern, a batch per SUBSCRIBE packet"""
+        subscriptions = self.subscriptions()
+        for start in range(0, len(subscriptions), batch_size):
+            client.subscribe(subscriptions[start:start + batch_size])
+        return len(subscriptions)
+
+    def stats(self):
+        """Dispatch counts per pattern"""
+        counts = {}
+        for route in self.routes:
+            counts[route.pattern] = counts.get(route.pattern, 0) + route.dispatched
+        counts["<unmatched>"] = self.unmatched
+        return counts
@@ -4,7 +4,6 @@ import hashlib
 import hmac
 import secrets
 import time
-import threading
 
 def generate_nonce():
     """Generate cryptographically secure nonce"""
@@ -37,15 +36,6 @@ def secure_erase(data):
     elif isinstance(data, str):
         data = '0' * len(data)
 
-def start_periodic_task(interval, task):
-    """Helper for periodic tasks"""
-    def loop():
-        task()
-        threading.Timer(interval, loop).start()
-    
-    loop()
-
-
 def get_sorted_guids(guid1, guid2):
     # Assumes GUID format like "somename@1", "somename@2", etc.
     # Extracts the numeric part after the "@" for sorting.
@@ -0,0 +1,246 @@
+# Compact binary encoding for discovery and key-response messages, with JSON fallback
+
+import json
+import re
+import struct
+
+from lib.config import WIRE_FORMAT
+
+
+WIRE_MAGIC = 0xE5     # never '{', so binary and JSON payloads can't be confused
+WIRE_VERSION = 3      # v2 appends the sender's KDF spec (lib/kdf.py), v3 adds key confirmations;
+                      # v1 and v2 messages still decode
+
+MSG_DISCOVERY = 1
+MSG_KEY_RESPONSE = 2
+MSG_KEY_CONFIRM = 3
+
+# Oldest version that understands MSG_KEY_CONFIRM (JSON or binary)
+KEY_CONFIRM_WIRE = 3
+
+_HEADER = struct.Struct(">BBB")        # magic, version, message type
+_DIGEST = struct.Struct(">32s")        # raw HMAC-SHA256
+_TIMESTAMP = struct.Struct(">d")
+
+# GUIDs of the form "<subset>_device@<digits>" are sent as (width, number) against the
+# message's subset; anything else is sent as a length-prefixed string
+_GUID_NUMERIC = 0
+_GUID_STRING = 1
+_NUMERIC_GUID = struct.Struct(">BBH")  # kind, zero-pad width, local number
+
+# Nonces from generate_nonce() ("NONCE_" + 16 hex chars) are sent as their 8 raw bytes
+_NONCE_PREFIX = "NONCE_"
+_NONCE_RAW = 0
+_NONCE_STRING = 1
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+def is_binary(payload):
+    return len(payload) > 0 and payload[0] == WIRE_MAGIC
+
+
+# -------------------- encoding --------------------
+
+def _encode_str(value):
+    raw = value.encode()
+    if len(raw) > 255:
+        raise WireFormatError(f"Field too long for wire format: {value[:20]}...")
+    return bytes((len(raw),)) + raw
+
+
+def _encode_guid(guid, subset):
+    prefix = f"{subset}_device@"
+    local = guid[len(prefix):] if guid.startswith(prefix) else ""
+    if local.isdigit() and len(local) < 256 and int(local) < 65536:
+        return _NUMERIC_GUID.pack(_GUID_NUMERIC, len(local), int(local))
+    return bytes((_GUID_STRING,)) + _encode_str(guid)
+
+
+# Raw only for the exact form generate_nonce() produces: fromhex() also takes uppercase
+# and spaces, which the receiver's .hex() would turn into a different nonce
+_RAW_NONCE = re.compile(r"NONCE_[0-9a-f]{16}")
+
+
+def _encode_nonce(nonce):
+    if _RAW_NONCE.fullmatch(nonce):
+        return bytes((_NONCE_RAW,)) + bytes.fromhex(nonce[len(_NONCE_PREFIX):])
+    return bytes((_NONCE_STRING,)) + _encode_str(nonce)
+
+
+def encode_discovery(msg):
+    subset = msg["subset"]
+    return b"".join((
+        _HEADER.pack(WIRE_MAGIC, WIRE_VERSION, MSG_DISCOVERY),
+        _encode_str(subset),
+        _encode_guid(msg["guid"], subset),
+        _encode_nonce(msg["nonce"]),
+        bytes.fromhex(msg["digest"]),
+        _encode_str(msg.get("kdf") or ""),
+    ))
+
+
+def encode_key_response(msg, subset):
+    return b"".join((
+        _HEADER.pack(WIRE_MAGIC, WIRE_VERSION, MSG_KEY_RESPONSE),
+        _encode_str(subset),
+        _encode_guid(msg["source_guid"], subset),
+        _encode_guid(msg["target_guid"], subset),
+        _encode_nonce(msg["original_nonce"]),
+        bytes.fromhex(msg["digest"]),
+        _TIMESTAMP.pack(msg["timestamp"]),
+        _encode_str(msg.get("kdf") or ""),
+    ))
+
+
+def encode_key_confirm(msg, subset):
+    return b"".join((
+        _HEADER.pack(WIRE_MAGIC, WIRE_VERSION, MSG_KEY_CONFIRM),
+        _encode_str(subset),
+        _encode_guid(msg["source_guid"], subset),
+        _encode_guid(msg["target_guid"], subset),
+        _encode_nonce(msg["original_nonce"]),
+        bytes.fromhex(msg["digest"]),
+    ))
+
+
+# -------------------- decoding --------------------
+
+def _decode_str(buf, offset):
+    length = buf[offset]
+    end = offset + 1 + length
+    return bytes(buf[offset + 1:end]).decode(), end
+
+
+def _decode_guid(buf, offset, subset):
+    if buf[offset] == _GUID_NUMERIC:
+        _, width, number = _NUMERIC_GUID.unpack_from(buf, offset)
+        return f"{subset}_device@{number:0{width}d}", offset + _NUMERIC_GUID.size
+    return _decode_str(buf, offset + 1)
+
+
+def _decode_nonce(buf, offset):
+    if buf[offset] == _NONCE_RAW:
+        return _NONCE_PREFIX + bytes(buf[offset + 1:offset + 9]).hex(), offset + 9
+    return _decode_str(buf, offset + 1)
+
+
+def _decode_header(buf, *expected_types):
+    magic, version, msg_type = _HEADER.unpack_from(buf, 0)
+    if magic != WIRE_MAGIC or version > WIRE_VERSION:
+        raise WireFormatError(f"Unsupported wire version {version}")
+    if msg_type not in expected_types:
+        raise WireFormatError(f"Unexpected message type {msg_type}")
+    return version, msg_type, _HEADER.size
+
+
+def _decode_kdf(buf, offset, version, msg):
+    """v2+ trailer: the sender's KDF spec, left out of msg when empty (= default)"""
+    if version >= 2:
+        kdf, _ = _decode_str(buf, offset)
+        if kdf:
+            msg["kdf"] = kdf
+    return msg
+
+
+def decode_discovery(payload):
+    """Decode a discovery payload (binary or JSON) into the JSON message's dict shape"""
+    if not is_binary(payload):
+        return json.loads(payload)
+    try:
+        version, _, offset = _decode_header(payload, MSG_DISCOVERY)
+        subset, offset = _decode_str(payload, offset)
+        guid, offset = _decode_guid(payload, offset, subset)
+        nonce, offset = _decode_nonce(payload, offset)
+        (digest,) = _DIGEST.unpack_from(payload, offset)
+        return _decode_kdf(payload, offset + _DIGEST.size, version, {
+            "guid": guid, "subset": subset, "nonce": nonce, "digest": digest.hex(), "wire": version,
+        })
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise WireFormatError(f"Malformed discovery message: {e}")
+
+
+def decode_key_response(payload):
+    """Decode a key-response payload (binary or JSON) into the JSON message's dict shape.
+    Key confirmations share the topic and come back with "type": "key_confirm"."""
+    if not is_binary(payload):
+        return json.loads(payload)
+    try:
+        version, msg_type, offset = _decode_header(payload, MSG_KEY_RESPONSE, MSG_KEY_CONFIRM)
+        subset, offset = _decode_str(payload, offset)
+        source_guid, offset = _decode_guid(payload, offset, subset)
+        target_guid, offset = _decode_guid(payload, offset, subset)
+        nonce, offset = _decode_nonce(payload, offset)
+        (digest,) = _DIGEST.unpack_from(payload, offset)
+        offset += _DIGEST.size
+        if msg_type == MSG_KEY_CONFIRM:
+            return {
+                "type": "key_confirm",
+                "source_guid": source_guid,
+                "target_guid": target_guid,
+                "original_nonce": nonce,
+                "digest": digest.hex(),
+                "wire": version,
+            }
+        (timestamp,) = _TIMESTAMP.unpack_from(payload, offset)
+        return _decode_kdf(payload, offset + _TIMESTAMP.size, version, {
+            "source_guid": source_guid,
+            "target_guid": target_guid,
+            "original_nonce": nonce,
+            "digest": digest.hex(),
+            "timestamp": timestamp,
+            "wire": version,
+        })
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise WireFormatError(f"Malformed key response: {e}")
+
+
+# -------------------- negotiation --------------------
+
+def note_peer_wire(ctx, peer_guid, data):
+    """Remember which wire version a peer speaks; JSON messages from older peers carry none.
+    Only call this once the message is authenticated: it decides what we send the peer
+    (and every broadcast). Kept to the expected roster, so the map can't grow past it."""
+    if ctx.discovery.is_expected(peer_guid):
+        ctx.peer_wire_versions[peer_guid] = data.get("wire", 0) if isinstance(data, dict) else 0
+
+
+def use_binary_for_peer(ctx, peer_guid):
+    if WIRE_FORMAT == "json":
+        return False
+    if WIRE_FORMAT == "binary":
+        return True
+    return ctx.peer_wire_versions.get(peer_guid, 0) >= WIRE_VERSION
+
+
+def use_binary_for_broadcast(ctx):
+    """Broadcasts reach every peer, so in auto mode they go binary only once every
+    expected peer in the subset has been seen speaking the binary format"""
+    if WIRE_FORMAT == "json":
+        return False
+    if WIRE_FORMAT == "binary":
+        return True
+    expected_peers = len(ctx.device.evkms_state["vector_Vc"]) - 1
+    versions = ctx.peer_wire_versions
+    return (expected_peers > 0 and len(versions) >= expected_peers
+            and all(v >= WIRE_VERSION for v in versions.values()))
+
+
+def encode_discovery_for(ctx, msg):
+    if use_binary_for_broadcast(ctx):
+        return encode_discovery(msg)
+    return json.dumps(dict(msg, wire=WIRE_VERSION))
+
+
+def encode_key_response_for(ctx, peer_guid, msg):
+    if use_binary_for_peer(ctx, peer_guid):
+        return encode_key_response(msg, ctx.subset_guid)
+    return json.dumps(dict(msg, wire=WIRE_VERSION))
+
+
+def encode_key_confirm_for(ctx, peer_guid, msg):
+    if use_binary_for_peer(ctx, peer_guid):
+        return encode_key_confirm(msg, ctx.subset_guid)
+    return json.dumps(dict(msg, type="key_confirm", wire=WIRE_VERSION))
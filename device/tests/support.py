@@ -0,0 +1,177 @@
+# Shared fakes for the unit tests: a hand-driven timer backend and clock, a recording
+# MQTT client, and provisioned device contexts without snapshots or a broker
+#
+#   cd device && python -m unittest discover -s tests     (or: python -m pytest tests)
+
+import heapq
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from lib.device_context import DeviceContext  # noqa: E402
+from lib.log_handler import configure_logging  # noqa: E402
+from lib.loopback_broker import LoopbackMessage, LoopbackPublishInfo  # noqa: E402
+from lib.mqtt_handler import broadcast_discovery, register_device_routes, start_discovery  # noqa: E402
+from lib.outbound import OutboundPublisher  # noqa: E402
+from lib.scheduler import TimerHandle  # noqa: E402
+from lib.wire_codec import decode_key_response  # noqa: E402
+
+
+# Device logs go out on the listener thread, past the test runner's capture; set
+# LOG_LEVEL to see them
+if "LOG_LEVEL" not in os.environ:
+    configure_logging("CRITICAL")
+
+# HKDF keeps handshakes in the tests instant; the protocol doesn't depend on the KDF
+TEST_KDF = "hkdf-sha256"
+
+
+class FakeClock:
+    """A clock that only moves when told to"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeTimers:
+    """Scheduler backend with the TimerThread call_later shape, run by advance() on the
+    test's own thread instead of a daemon thread and the wall clock"""
+
+    def __init__(self, clock=None):
+        self.clock = clock or FakeClock()
+        self._heap = []
+        self._counter = itertools.count()
+
+    def call_later(self, delay, callback):
+        handle = TimerHandle(self.clock.now + delay, callback)
+        heapq.heappush(self._heap, (handle.when, next(self._counter), handle))
+        return handle
+
+    def advance(self, seconds=0.0):
+        """Move the clock forward, running every timer that comes due, in order"""
+        deadline = self.clock.now + seconds
+        while self._heap and self._heap[0][0] <= deadline:
+            when, _, handle = heapq.heappop(self._heap)
+            self.clock.now = max(self.clock.now, when)
+            if not handle.cancelled:
+                handle.callback()
+        self.clock.now = deadline
+
+    def next_delay(self):
+        """Seconds until the next live timer, None if nothing is scheduled"""
+        live = [when for when, _, handle in self._heap if not handle.cancelled]
+        return min(live) - self.clock.now if live else None
+
+
+class RecordingClient:
+    """The publish() slice of a paho client; keeps what was published, in order"""
+
+    def __init__(self):
+        self.published = []
+        self._mids = itertools.count(1)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        mid = next(self._mids)
+        self.published.append(LoopbackMessage(topic, payload if isinstance(payload, bytes) else payload.encode(),
+                                              qos, retain, mid=mid))
+        return LoopbackPublishInfo(mid)
+
+    def take(self):
+        """Everything published since the last take()"""
+        published, self.published = self.published, []
+        return published
+
+
+def provisioning(secrets, index, vector_n=None):
+    return {
+        "secret_i": secrets[index],
+        "Vectore_p": [],
+        "Vectore_c": list(secrets),
+        "Vectore_n": list(vector_n or []),
+        "alpha": 5,
+        "kdf": TEST_KDF,
+    }
+
+
+def make_secrets(count):
+    return [os.urandom(16).hex() for _ in range(count)]
+
+
+def wait_until(predicate, timeout=5.0):
+    """For work that completes on the KDF pool"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met within timeout")
+        time.sleep(0.001)
+
+
+class Mesh:
+    """Provisioned devices of one subset on a shared FakeTimers, their publishes held in
+    RecordingClients until deliver() routes them. Handlers run on the test's thread,
+    only the derivations run on the KDF pool."""
+
+    SUBSET = "T"
+
+    def __init__(self, count, next_epoch=False):
+        self.timers = FakeTimers()
+        self.secrets = make_secrets(count)
+        # Vn as well, so the devices can advance_epoch
+        self.next_secrets = make_secrets(count) if next_epoch else []
+        self.devices = []
+        for index in range(count):
+            ctx = DeviceContext(f"{self.SUBSET}_device@{index + 1:02d}", self.SUBSET, timer_backend=self.timers,
+                                snapshot_path="", outbound=OutboundPublisher(max_inflight=0))
+            register_device_routes(ctx.router, ctx)
+            ctx.device.load_evkms_payload(provisioning(self.secrets, index, self.next_secrets))
+            ctx.client = RecordingClient()
+            self.devices.append(ctx)
+
+    def __getitem__(self, index):
+        return self.devices[index]
+
+    def start(self, index, first_delay):
+        """Put a device's discovery on its pacer (devices otherwise only broadcast by hand)"""
+        start_discovery(self.devices[index].client, self.devices[index], first_delay)
+
+    def broadcast(self, index):
+        broadcast_discovery(self.devices[index].client, self.devices[index])
+
+    def settle(self):
+        wait_until(lambda: not any(ctx.pending_key_derivations for ctx in self.devices))
+
+    def deliver(self, drop=None):
+        """Route everything published so far (and whatever that triggers) until quiet;
+        drop(sender, message) returning True loses a message. Returns what was delivered."""
+        delivered = []
+        while True:
+            self.settle()
+            batch = [(ctx, message) for ctx in self.devices for message in ctx.client.take()]
+            if not batch:
+                return delivered
+            for sender, message in batch:
+                if drop is not None and drop(sender, message):
+                    continue
+                delivered.append((sender, message))
+                for ctx in self.devices:
+                    if ctx.router.match(message.topic):
+                        ctx.router.dispatch(ctx.client, message)
+
+    def key(self, index, peer):
+        return self.devices[index].device.evkms_state["pairwise_keys"].get(self.devices[peer].device_guid)
+
+
+def message_type(message):
+    """discovery, key_response or key_confirm, for drop filters"""
+    if message.topic.endswith("/discovery"):
+        return "discovery"
+    return decode_key_response(message.payload).get("type", "key_response")
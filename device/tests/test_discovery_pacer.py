@@ -0,0 +1,118 @@
+# DiscoveryPacer: coverage rules, quiet at full coverage, backoff and wake transitions
+
+import unittest
+
+from support import Mesh
+from lib.config import DISCOVERY_BACKOFF_MAX, DISCOVERY_INTERVAL_MAX, DISCOVERY_INTERVAL_MIN
+from lib.wire_codec import KEY_CONFIRM_WIRE
+
+
+class TestDiscoveryPacer(unittest.TestCase):
+    def setUp(self):
+        self.mesh = Mesh(3)
+        self.ctx = self.mesh[0]
+        self.timers = self.mesh.timers
+        self.peers = self.ctx.discovery.expected_peers()
+        self.broadcasts = 0
+
+    def broadcast(self):
+        self.broadcasts += 1
+
+    def start(self):
+        self.ctx.discovery.start(self.broadcast, first_delay=0)
+        self.timers.advance()
+
+    def key(self, peer, confirmed=True, wire=KEY_CONFIRM_WIRE):
+        self.ctx.device.store_pairwise_key(peer, "ab" * 32, "NONCE_x", confirmed=confirmed)
+        self.ctx.peer_wire_versions[peer] = wire
+
+    def tick(self):
+        """Run the next discovery tick"""
+        self.timers.advance(self.timers.next_delay())
+
+    def test_expected_peers_exclude_ourselves(self):
+        self.assertEqual(self.peers, ["T_device@02", "T_device@03"])
+        self.assertFalse(self.ctx.discovery.is_expected("T_device@01"))
+        self.assertFalse(self.ctx.discovery.is_expected("T_device@2"))
+
+    def test_coverage_counts_confirmed_keys_and_revoked_peers(self):
+        self.key(self.peers[0], confirmed=False)
+        self.assertEqual(self.ctx.discovery.coverage(), (0, 2))
+        self.key(self.peers[0], confirmed=True)
+        self.assertEqual(self.ctx.discovery.coverage(), (1, 2))
+        self.ctx.device.add_to_revoked_list(self.peers[1])
+        self.assertEqual(self.ctx.discovery.coverage(), (2, 2))
+
+    def test_any_key_counts_for_peers_without_confirmations(self):
+        self.key(self.peers[0], confirmed=False, wire=2)
+        self.ctx.device.store_pairwise_key(self.peers[1], "cd" * 32, "NONCE_y")   # wire version never seen
+        self.assertEqual(self.ctx.discovery.coverage(), (2, 2))
+
+    def test_quiet_at_full_coverage(self):
+        self.key(self.peers[0])
+        self.key(self.peers[1])
+        self.start()
+        self.assertIsNone(self.ctx.discovery.interval)
+        self.assertEqual(self.broadcasts, 0)
+        self.assertEqual(self.ctx.scheduler.pending(), 0)
+
+    def test_tentative_key_keeps_discovering(self):
+        self.key(self.peers[0])
+        self.key(self.peers[1], confirmed=False)
+        self.start()
+        self.assertEqual(self.broadcasts, 1)
+        self.assertEqual(self.ctx.scheduler.pending(), 1)
+
+    def test_backoff_grows_to_cap_and_resets_on_progress(self):
+        self.start()
+        self.assertTrue(DISCOVERY_INTERVAL_MIN <= self.ctx.discovery.interval <= DISCOVERY_INTERVAL_MAX)
+        for _ in range(64):
+            self.tick()
+            self.assertLessEqual(self.ctx.discovery.interval, max(DISCOVERY_BACKOFF_MAX, DISCOVERY_INTERVAL_MAX))
+        self.assertEqual(self.ctx.discovery.interval, DISCOVERY_BACKOFF_MAX)
+        self.assertLess(self.ctx.discovery._backoff, 64)
+        self.assertEqual(self.broadcasts, 65)
+
+        self.key(self.peers[0])
+        self.tick()
+        self.assertEqual(self.ctx.discovery._backoff, 0)
+        self.assertLessEqual(self.ctx.discovery.interval, DISCOVERY_INTERVAL_MAX)
+
+    def test_wake_transitions(self):
+        self.assertFalse(self.ctx.discovery.wake("before start"))
+
+        self.start()
+        self.assertFalse(self.ctx.discovery.wake("on base schedule"))
+
+        self.tick()     # no progress: backed off
+        self.assertTrue(self.ctx.discovery.wake("backed off"))
+        self.assertLessEqual(self.timers.next_delay(), 5)
+        self.assertEqual(self.ctx.discovery._backoff, 0)
+
+        self.key(self.peers[0])
+        self.key(self.peers[1])
+        self.tick()     # full coverage: quiet
+        self.assertIsNone(self.ctx.discovery.interval)
+        self.assertIsNone(self.timers.next_delay())
+
+        broadcasts = self.broadcasts
+        self.assertTrue(self.ctx.discovery.wake("quiet"))
+        self.ctx.device.remove_pairwise_key(self.peers[1])
+        self.tick()
+        self.assertEqual(self.broadcasts, broadcasts + 1)
+        self.assertEqual(self.ctx.scheduler.pending(), 1)
+
+    def test_failing_interval_rearms_at_cap(self):
+        self.start()
+
+        def broken():
+            raise RuntimeError("boom")
+
+        self.ctx.discovery.coverage = broken
+        self.tick()
+        self.assertEqual(self.ctx.discovery.interval, DISCOVERY_BACKOFF_MAX)
+        self.assertEqual(self.ctx.scheduler.pending(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
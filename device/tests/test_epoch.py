@@ -0,0 +1,103 @@
+# Epoch switches: vector rotation, key migration, and derivations that straddle a switch
+
+import threading
+import unittest
+
+from support import Mesh, message_type
+from lib.evkms_core import kdf_admission
+
+
+class TestEpoch(unittest.TestCase):
+    def setUp(self):
+        self.mesh = Mesh(3, next_epoch=True)
+
+    def advance_all(self, epoch=1):
+        for ctx in self.mesh.devices:
+            self.assertIsNone(ctx.device.advance_epoch(epoch))
+
+    def block_kdf_pool(self):
+        """Occupy every pool slot until the returned event is set"""
+        gate = threading.Event()
+        self.addCleanup(gate.set)
+        for _ in range(kdf_admission.max_inflight):
+            kdf_admission.submit(0, gate.wait)
+        return gate
+
+    def test_switch_rotates_vectors(self):
+        device = self.mesh[0].device
+        following = ["f0", "f1", "f2"]
+        self.assertIsNone(device.advance_epoch(1, next_vector=following))
+        state = device.evkms_state
+        self.assertEqual(state["epoch"], 1)
+        self.assertEqual(state["vector_Vp"], self.mesh.secrets)
+        self.assertEqual(state["vector_Vc"], self.mesh.next_secrets)
+        self.assertEqual(state["vector_Vn"], following)
+        self.assertEqual(state["secret_i"], self.mesh.next_secrets[0])
+
+    def test_switch_refused(self):
+        device = self.mesh[0].device
+        self.assertEqual(device.advance_epoch(0), "stale")
+        self.assertEqual(device.advance_epoch(2), "gap")
+        self.assertIsNone(device.advance_epoch(1))
+        self.assertEqual(device.advance_epoch(2), "unprepared")
+        self.assertEqual(device.evkms_state["epoch"], 1)
+
+    def test_keys_migrate_in_step(self):
+        mesh = self.mesh
+        mesh.broadcast(0)
+        mesh.deliver(drop=lambda sender, message: sender is mesh[2])
+        self.assertIsNone(mesh.key(1, 2))
+        before = mesh.key(0, 1).key_hex
+
+        self.advance_all()
+        self.assertNotEqual(mesh.key(0, 1).key_hex, before)
+        self.assertEqual(mesh.key(0, 1).key_hex, mesh.key(1, 0).key_hex)
+        self.assertTrue(mesh.key(0, 1).confirmed and mesh.key(1, 0).confirmed)
+
+        # Handshakes after the switch use the new Vc
+        mesh.broadcast(2)
+        mesh.deliver()
+        for peer in (0, 1):
+            self.assertEqual(mesh.key(2, peer).key_hex, mesh.key(peer, 2).key_hex)
+            self.assertTrue(mesh.key(2, peer).confirmed and mesh.key(peer, 2).confirmed)
+
+    def test_derivation_queued_across_switch_matches_migrated_key(self):
+        mesh = self.mesh
+        initiator, responder = mesh[0].device, mesh[1].device
+        nonce = "NONCE_straddle"
+        key = responder.compute_pairwise_key(initiator.device_guid, mesh.secrets[0], nonce)
+        responder.store_pairwise_key(initiator.device_guid, key, nonce)
+
+        gate = self.block_kdf_pool()
+        derived = []
+        done = threading.Event()
+        initiator.compute_pairwise_key_async(responder.device_guid, mesh.secrets[1], nonce,
+                                             lambda k: (derived.append(k), done.set()))
+        self.advance_all()
+        gate.set()
+        self.assertTrue(done.wait(5))
+        self.assertEqual(derived, [mesh.key(1, 0).key_hex])
+
+    def test_handshake_straddling_switch_recovers(self):
+        mesh = self.mesh
+        gate = self.block_kdf_pool()
+        mesh.broadcast(0)
+        for message in mesh[0].client.take():
+            mesh[1].router.dispatch(mesh[1].client, message)
+        self.advance_all()
+        gate.set()
+
+        # Device 0 answers the response with post-switch secrets, so it can't verify it;
+        # device 1's key stays unconfirmed and its own discovery completes the handshake
+        mesh.deliver()
+        self.assertIsNone(mesh.key(0, 1))
+        self.assertEqual(mesh[1].discovery.coverage(), (0, 2))
+        mesh.broadcast(1)
+        delivered = mesh.deliver(drop=lambda sender, message: sender is mesh[2])
+        self.assertIn("key_confirm", [message_type(m) for _, m in delivered])
+        self.assertEqual(mesh.key(0, 1).key_hex, mesh.key(1, 0).key_hex)
+        self.assertTrue(mesh.key(0, 1).confirmed and mesh.key(1, 0).confirmed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+# Key confirmation: lost responses and crossed tentative keys still end in one confirmed key
+
+import json
+import unittest
+
+from support import LoopbackMessage, Mesh, message_type
+from lib.config import DISCOVERY_BACKOFF_MAX, DISCOVERY_TOPIC
+
+
+def drop_type(kind):
+    return lambda sender, message: message_type(message) == kind
+
+
+class TestHandshake(unittest.TestCase):
+    def setUp(self):
+        self.mesh = Mesh(2)
+
+    def assert_agreed(self):
+        ours, theirs = self.mesh.key(0, 1), self.mesh.key(1, 0)
+        self.assertIsNotNone(ours)
+        self.assertIsNotNone(theirs)
+        self.assertEqual(ours.key_hex, theirs.key_hex)
+        self.assertTrue(ours.confirmed and theirs.confirmed)
+
+    def test_response_then_confirmation(self):
+        self.mesh.broadcast(0)
+        delivered = self.mesh.deliver()
+        self.assertEqual([message_type(m) for _, m in delivered], ["discovery", "key_response", "key_confirm"])
+        self.assert_agreed()
+        self.assertEqual(self.mesh[1].discovery.coverage(), (1, 1))
+
+    def test_lost_response_keeps_responder_discovering(self):
+        mesh = self.mesh
+        mesh.start(1, first_delay=10)
+        mesh.broadcast(0)
+        mesh.deliver(drop=drop_type("key_response"))
+
+        # The responder's key is tentative: device 0 never got it
+        self.assertIsNone(mesh.key(0, 1))
+        self.assertFalse(mesh.key(1, 0).confirmed)
+        self.assertEqual(mesh[1].discovery.coverage(), (0, 1))
+
+        # So its own discovery still goes out, and device 0 answers it
+        mesh.timers.advance(10)
+        self.assertIsNotNone(mesh[1].discovery.interval)
+        mesh.deliver()
+        self.assert_agreed()
+
+        # Then the responder goes quiet
+        mesh.timers.advance(DISCOVERY_BACKOFF_MAX)
+        self.assertIsNone(mesh[1].discovery.interval)
+        self.assertEqual(mesh[1].scheduler.pending(), 0)
+        self.assertEqual(mesh[1].client.take(), [])
+
+    def test_lost_confirmation_resent_to_discovering_responder(self):
+        mesh = self.mesh
+        mesh.broadcast(0)
+        mesh.deliver(drop=drop_type("key_confirm"))
+        self.assertTrue(mesh.key(0, 1).confirmed)
+        self.assertFalse(mesh.key(1, 0).confirmed)
+
+        # Device 0 is covered and quiet; the responder's discovery gets a confirmation back,
+        # not a second key
+        mesh.broadcast(1)
+        delivered = mesh.deliver()
+        self.assertEqual([message_type(m) for _, m in delivered], ["discovery", "key_confirm"])
+        self.assert_agreed()
+
+    def test_crossed_tentative_keys_resolved_by_lower_guid(self):
+        mesh = self.mesh
+        mesh.broadcast(0)
+        mesh.broadcast(1)
+        mesh.deliver(drop=drop_type("key_response"))
+        self.assertFalse(mesh.key(0, 1).confirmed or mesh.key(1, 0).confirmed)
+        self.assertNotEqual(mesh.key(0, 1).key_hex, mesh.key(1, 0).key_hex)
+
+        # Device 1 confirms its key in answer to device 0's discovery; device 0 (the lower
+        # GUID) sees it doesn't match its own and drops it
+        mesh.broadcast(0)
+        mesh.deliver()
+        self.assertIsNone(mesh.key(0, 1))
+
+        mesh.broadcast(1)
+        mesh.deliver()
+        self.assert_agreed()
+
+    def test_forged_discovery_does_not_record_wire_version(self):
+        ctx = self.mesh[1]
+        forged = {"guid": self.mesh[0].device_guid, "subset": Mesh.SUBSET, "nonce": "n" * 32,
+                  "digest": "00" * 32, "kdf": ctx.device.kdf.id, "wire": 3}
+        topic = DISCOVERY_TOPIC.format(subset_guid=Mesh.SUBSET)
+        ctx.router.dispatch(ctx.client, LoopbackMessage(topic, json.dumps(forged).encode()))
+        self.assertEqual(ctx.peer_wire_versions, {})
+        self.assertEqual(ctx.client.take(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
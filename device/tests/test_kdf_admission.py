@@ -0,0 +1,125 @@
+# KDFAdmission: release order, shedding under a full queue, stale guards and the rate budget
+
+import unittest
+from concurrent.futures import Future
+
+from support import FakeClock, FakeTimers
+from lib.kdf_admission import KDFAdmission, PRIORITY_KEY_RESPONSE, PRIORITY_DISCOVERY, PRIORITY_SPECULATIVE
+
+
+class ManualExecutor:
+    """Holds submitted work until the test finishes it"""
+
+    def __init__(self):
+        self.running = []
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.running.append((future, fn, args))
+        return future
+
+    def finish_next(self):
+        future, fn, args = self.running.pop(0)
+        future.set_result(fn(*args))
+        return future.result()
+
+
+def job(name):
+    return lambda: name
+
+
+class TestKDFAdmission(unittest.TestCase):
+    def setUp(self):
+        self.executor = ManualExecutor()
+
+    def admission(self, **kwargs):
+        kwargs.setdefault("max_inflight", 1)
+        kwargs.setdefault("max_queue", 3)
+        return KDFAdmission(self.executor, **kwargs)
+
+    def test_releases_most_urgent_first(self):
+        admission = self.admission(max_queue=10)
+        admission.submit(PRIORITY_DISCOVERY, job("blocker"))
+        futures = {
+            "speculative": admission.submit(PRIORITY_SPECULATIVE, job("speculative")),
+            "discovery": admission.submit(PRIORITY_DISCOVERY, job("discovery")),
+            "response": admission.submit(PRIORITY_KEY_RESPONSE, job("response")),
+        }
+        order = [self.executor.finish_next() for _ in range(4)]
+        self.assertEqual(order, ["blocker", "response", "discovery", "speculative"])
+        self.assertTrue(all(f.result() == name for name, f in futures.items()))
+        self.assertEqual(admission.stats()["completed"], 4)
+
+    def test_full_queue_sheds_newest_least_urgent(self):
+        admission = self.admission()
+        admission.submit(PRIORITY_KEY_RESPONSE, job("blocker"))
+        older = admission.submit(PRIORITY_DISCOVERY, job("older"))
+        newer = admission.submit(PRIORITY_DISCOVERY, job("newer"))
+        speculative = admission.submit(PRIORITY_SPECULATIVE, job("speculative"))
+
+        response = admission.submit(PRIORITY_KEY_RESPONSE, job("response"))
+        self.assertTrue(speculative.cancelled())
+        self.assertFalse(response.cancelled())
+
+        # Same priority as the worst queued job: the newcomer loses the tie
+        tie = admission.submit(PRIORITY_DISCOVERY, job("tie"))
+        self.assertTrue(tie.cancelled())
+        self.assertFalse(older.cancelled() or newer.cancelled())
+
+        # More urgent than the worst: the newest of the least urgent class goes
+        admission.submit(PRIORITY_KEY_RESPONSE, job("response2"))
+        self.assertTrue(newer.cancelled())
+        self.assertFalse(older.cancelled())
+
+        stats = admission.stats()
+        self.assertEqual((stats["shed"], stats["queued"]), (3, 3))
+        order = [self.executor.finish_next() for _ in range(4)]
+        self.assertEqual(order, ["blocker", "response", "response2", "older"])
+
+    def test_stale_guard_dropped_at_release(self):
+        admission = self.admission()
+        admission.submit(PRIORITY_KEY_RESPONSE, job("blocker"))
+        still_wanted = {"value": True}
+        stale = admission.submit(PRIORITY_DISCOVERY, job("stale"), guard=lambda: still_wanted["value"])
+        fresh = admission.submit(PRIORITY_DISCOVERY, job("fresh"), guard=lambda: True)
+
+        still_wanted["value"] = False
+        self.executor.finish_next()
+        self.assertTrue(stale.cancelled())
+        self.assertEqual(self.executor.finish_next(), "fresh")
+        self.assertEqual(fresh.result(), "fresh")
+        self.assertEqual(admission.stats()["stale"], 1)
+
+    def test_rate_budget_refills_on_timer(self):
+        clock = FakeClock()
+        timers = FakeTimers(clock)
+        admission = self.admission(max_inflight=10, max_queue=10, rate=2, burst=2, timers=timers, clock=clock)
+        futures = [admission.submit(PRIORITY_DISCOVERY, job(i)) for i in range(4)]
+
+        # The burst goes straight out, the rest waits for tokens
+        self.assertEqual(len(self.executor.running), 2)
+        self.assertEqual(admission.queued(), 2)
+        self.assertAlmostEqual(timers.next_delay(), 0.5)
+
+        timers.advance(0.5)
+        self.assertEqual(len(self.executor.running), 3)
+        timers.advance(0.5)
+        self.assertEqual(len(self.executor.running), 4)
+        self.assertIsNone(timers.next_delay())
+        while self.executor.running:
+            self.executor.finish_next()
+        self.assertEqual([f.result() for f in futures], [0, 1, 2, 3])
+
+    def test_close_cancels_queued_and_refuses_new(self):
+        admission = self.admission()
+        running = admission.submit(PRIORITY_DISCOVERY, job("running"))
+        queued = admission.submit(PRIORITY_DISCOVERY, job("queued"))
+        admission.close()
+        self.assertTrue(queued.cancelled())
+        self.assertTrue(admission.submit(PRIORITY_KEY_RESPONSE, job("late")).cancelled())
+        self.executor.finish_next()
+        self.assertEqual(running.result(), "running")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+# OutboundPublisher: inflight window, eviction, coalescing, reconnect drain and ack expiry
+
+import unittest
+
+from support import FakeClock, FakeTimers, RecordingClient
+from lib.loopback_broker import LoopbackPublishInfo
+from lib.outbound import OutboundPublisher
+from lib.scheduler import Scheduler
+
+
+class NoConnClient(RecordingClient):
+    """paho after the socket dropped: QoS 0 publishes are refused"""
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        return LoopbackPublishInfo(None, rc=4)
+
+
+class TestOutboundPublisher(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.client = RecordingClient()
+
+    def publisher(self, **kwargs):
+        kwargs.setdefault("max_queue", 10)
+        kwargs.setdefault("max_inflight", 2)
+        kwargs.setdefault("ack_timeout", 10)
+        return OutboundPublisher(clock=self.clock, **kwargs)
+
+    def offline(self, **kwargs):
+        """A publisher that only queues until on_connect"""
+        publisher = self.publisher(**kwargs)
+        publisher.on_disconnect()
+        return publisher
+
+    def topics(self):
+        return [message.topic for message in self.client.take()]
+
+    def test_window_limits_unacked_publishes(self):
+        publisher = self.publisher()
+        for n in range(4):
+            publisher.publish(self.client, f"t/{n}", "x", kind="status")
+        self.assertEqual(self.topics(), ["t/0", "t/1"])
+        self.assertEqual((len(publisher), publisher.inflight()), (2, 2))
+
+        publisher.on_publish(1)
+        self.assertEqual(self.topics(), ["t/2"])
+        publisher.on_publish(2)
+        publisher.on_publish(3)
+        self.assertEqual(self.topics(), ["t/3"])
+        self.assertEqual(publisher.stats()["acked"], 3)
+
+    def test_ack_before_publish_returns(self):
+        publisher = self.publisher(max_inflight=1)
+
+        class AckingClient(RecordingClient):
+            def publish(inner, topic, payload, qos=0, retain=False):
+                info = RecordingClient.publish(inner, topic, payload, qos, retain)
+                publisher.on_publish(info.mid)
+                return info
+
+        client = AckingClient()
+        publisher.publish(client, "t/0", "x")
+        publisher.publish(client, "t/1", "x")
+        self.assertEqual(len(client.published), 2)
+        self.assertEqual(publisher.inflight(), 0)
+
+    def test_full_queue_evicts_oldest_least_urgent(self):
+        publisher = self.offline(max_queue=3)
+        publisher.publish(self.client, "metrics/old", "x", kind="metrics")
+        publisher.publish(self.client, "discovery", "x", kind="discovery")
+        publisher.publish(self.client, "metrics/new", "x", kind="metrics")
+
+        publisher.publish(self.client, "status", "x", kind="status")
+        publisher.on_connect(self.client)
+        self.assertEqual(self.topics(), ["status", "discovery"])
+        publisher.on_publish(1)
+        self.assertEqual(self.topics(), ["metrics/new"])
+        self.assertEqual(publisher.stats()["dropped"], 1)
+
+    def test_newcomer_less_urgent_than_everything_is_dropped(self):
+        publisher = self.offline(max_queue=2)
+        publisher.publish(self.client, "key/1", "x", kind="key_response")
+        publisher.publish(self.client, "key/2", "x", kind="key_response")
+        publisher.publish(self.client, "metrics", "x", kind="metrics", coalesce_key="metrics")
+        self.assertEqual(len(publisher), 2)
+
+        # The dropped newcomer left no coalesce entry behind to be updated later
+        publisher.publish(self.client, "metrics", "y", kind="metrics", coalesce_key="metrics")
+        self.assertEqual(publisher.stats()["coalesced"], 0)
+        self.assertEqual(publisher.stats()["dropped"], 2)
+
+    def test_coalesce_replaces_queued_message(self):
+        publisher = self.offline()
+        publisher.publish(self.client, "discovery", "first", kind="discovery", coalesce_key="discovery")
+        publisher.publish(self.client, "status", "s", kind="status")
+        publisher.publish(self.client, "discovery", "second", kind="discovery", coalesce_key="discovery")
+        self.assertEqual(len(publisher), 2)
+
+        publisher.on_connect(self.client)
+        sent = self.client.take()
+        self.assertEqual([(m.topic, m.payload) for m in sent], [("status", b"s"), ("discovery", b"second")])
+
+        # Once handed to the client the key is free again
+        publisher.publish(self.client, "discovery", "third", kind="discovery", coalesce_key="discovery")
+        self.assertEqual(publisher.stats()["coalesced"], 1)
+        self.assertEqual(len(publisher), 1)
+
+    def test_reconnect_drains_most_urgent_first(self):
+        publisher = self.offline(max_inflight=10)
+        for kind in ("metrics", "discovery", "status", "key_response"):
+            publisher.publish(self.client, kind, "x", kind=kind)
+        self.assertEqual(self.client.published, [])
+        publisher.on_connect(self.client)
+        self.assertEqual(self.topics(), ["key_response", "status", "discovery", "metrics"])
+
+    def test_refused_qos0_publish_is_kept_for_reconnect(self):
+        publisher = self.publisher()
+        publisher.publish(NoConnClient(), "status", "x")
+        self.assertFalse(publisher.connected)
+        self.assertEqual((len(publisher), publisher.inflight()), (1, 0))
+        publisher.on_connect(self.client)
+        self.assertEqual(self.topics(), ["status"])
+
+    def test_disconnect_releases_qos0_but_keeps_qos1_inflight(self):
+        publisher = self.publisher()
+        publisher.publish(self.client, "qos0", "x", qos=0)
+        publisher.publish(self.client, "qos1", "x", qos=1)
+        publisher.on_disconnect()
+        self.assertEqual(publisher.inflight(), 1)
+
+    def test_lost_acks_expire_on_the_scheduler(self):
+        timers = FakeTimers(self.clock)
+        publisher = self.publisher(max_inflight=1, ack_timeout=4)
+        publisher.start_expiry(Scheduler(timers))
+        publisher.publish(self.client, "t/0", "x")
+        publisher.publish(self.client, "t/1", "x")
+        self.assertEqual(self.topics(), ["t/0"])
+
+        timers.advance(4)       # checks at 2 s and 4 s: not older than ack_timeout yet
+        self.assertEqual(self.client.published, [])
+        timers.advance(2)       # check at 6 s: the slot is given back
+        self.assertEqual(self.topics(), ["t/1"])
+        self.assertEqual(publisher.stats()["ack_timeouts"], 1)
+
+        # A late PUBACK for the expired message changes nothing
+        publisher.on_publish(1)
+        self.assertEqual(publisher.inflight(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
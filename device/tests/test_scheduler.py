@@ -0,0 +1,71 @@
+# Scheduler: keyed replacement, periodic jobs, and the asyncio loop backend from other threads
+
+import asyncio
+import threading
+import unittest
+
+from support import FakeTimers
+from lib.scheduler import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.timers = FakeTimers()
+        self.scheduler = Scheduler(self.timers)
+        self.ran = []
+
+    def test_same_key_replaces_pending_job(self):
+        self.scheduler.call_later(5, lambda: self.ran.append("first"), key="discovery")
+        self.scheduler.call_later(2, lambda: self.ran.append("second"), key="discovery")
+        self.assertEqual(self.scheduler.pending(), 1)
+        self.timers.advance(10)
+        self.assertEqual(self.ran, ["second"])
+        self.assertEqual(self.scheduler.pending(), 0)
+
+    def test_periodic_runs_until_cancelled(self):
+        self.scheduler.call_periodic(1, lambda: self.ran.append(self.timers.clock()), key="tick")
+        self.timers.advance(3.5)
+        self.assertEqual(self.ran, [1, 2, 3])
+        self.scheduler.cancel("tick")
+        self.timers.advance(5)
+        self.assertEqual(len(self.ran), 3)
+        self.assertIsNone(self.timers.next_delay())
+
+    def test_periodic_rearms_when_callback_fails(self):
+        def tick():
+            self.ran.append(self.timers.clock())
+            raise RuntimeError("boom")
+
+        self.scheduler.call_periodic(1, tick, key="tick")
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                self.timers.advance(1)
+        self.assertEqual(self.ran, [1, 2])
+        self.assertEqual(self.scheduler.pending(), 1)
+
+
+class TestLoopBackend(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.loop.close()
+
+    def test_schedule_and_cancel_off_the_loop_thread(self):
+        scheduler = Scheduler(self.loop)
+        done = threading.Event()
+        ran = []
+        scheduler.call_later(0.01, lambda: ran.append("cancelled"), key="a")
+        scheduler.cancel("a")
+        scheduler.call_later(0.02, lambda: (ran.append("kept"), done.set()), key="b")
+        self.assertTrue(done.wait(5))
+        self.assertEqual(ran, ["kept"])
+        self.assertEqual(scheduler.pending(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,7 +3,10 @@ import express from 'express';
 import cors from "cors";
 import mqtt from "mqtt";
 import axios from "axios";
+import fs from "fs";
+import path from "path";
 import cryptoService from "./services/crypto.service.js"
+import provisioningService from "./services/provisioning.service.js"
 
 import {
     GATEWAY_PRIVATE_KEY,
@@ -13,7 +16,10 @@ import {
     SERVER_BASE_URL,
     KEY_ENCRYPTION_PASS,
     TOPICS,
-    TYPE_TASK
+    TYPE_TASK,
+    PROVISIONING_CHUNK_SIZE,
+    PROVISIONING_DELTA_MAX_RATIO,
+    REVOCATION_STATE_PATH
 } from "./config/config.js"
 
 import { logAuth, logError, logInfo, logMqtt, logTask, logWarning } from "./config/log_handler.js";
@@ -33,6 +39,12 @@ export default class Gateway {
         this.server = null;
         this.deviceSubscriptions = new Map();
         this.revokedDeviceGuids = new Set();
+        // Versioned revocation list per subset: subsetId -> { version, guids: [] }, persisted
+        this.revocationLists = this.loadRevocationLists();
+        // Last provisioning sent per device: deviceGuid -> { version, payload }
+        this.provisioningState = new Map();
+        // Current vector epoch per subset: subsetId -> epoch
+        this.subsetEpochs = new Map();
 
         this.handleMqttMessage = this.handleMqttMessage.bind(this);
     }
@@ -176,7 +188,16 @@ export default class Gateway {
 
             // Route message based on topic
             if (topic.endsWith('/status')) {
-                this.handleDeviceStatusMessage(payload, actualDeviceGuid);
+                if (payload.status_type === 'status_batch') {
+                    // Devices may coalesce several status events into one message
+                    const events = Array.isArray(payload.events) ? payload.events : [];
+                    logMqtt(`📦 Status batch from ${actualDeviceGuid}: ${events.length} event(s)`);
+                    for (const event of events) {
+                        this.handleDeviceStatusMessage(event, event.deviceGuid || actualDeviceGuid);
+                    }
+                } else {
+                    this.handleDeviceStatusMessage(payload, actualDeviceGuid);
+                }
             }
 
         } catch (error) {
@@ -192,6 +213,13 @@ export default class Gateway {
 
             this.updateServerDeviceStatus(deviceGuid, 'active');
 
+            // A device that came back on an older retained config needs what it missed
+            const state = this.provisioningState.get(deviceGuid);
+            if (state && payload.provisioningVersion !== undefined && payload.provisioningVersion < state.version) {
+                logInfo(`🔁 Device ${deviceGuid} is on provisioning v${payload.provisioningVersion}, resending v${state.version}`);
+                this.publishFullProvisioning(deviceGuid, state.payload);
+            }
+
         } else if (payload.status_type === 'pairwise_key_established') {
 
             logInfo(`🔐 Pairwise key established: ${deviceGuid} ↔ ${payload.peerDeviceGuid}`);
@@ -222,6 +250,34 @@ export default class Gateway {
             // 3. Update key versions in server
             // this.reportKeyRefreshCompletion(payload);
 
+        } else if (payload.status_type === 'revocation_resync' && payload.subsetGuid) {
+
+            logInfo(`🔁 Device ${deviceGuid} missed a revocation update (has v${payload.currentVersion}), resending list`);
+            // A device ahead of us means our list was lost: carry on from its version so new
+            // revocations aren't ignored as stale (devices merge snapshots, so nothing is unrevoked)
+            const list = this.revocationLists.get(payload.subsetGuid) || { version: 0, guids: [] };
+            if (Number.isInteger(payload.currentVersion) && payload.currentVersion > list.version) {
+                logWarning(`Revocation list for subset ${payload.subsetGuid} is behind a device (v${list.version} < v${payload.currentVersion}), continuing from v${payload.currentVersion}`);
+                list.version = payload.currentVersion;
+                this.revocationLists.set(payload.subsetGuid, list);
+                this.saveRevocationLists();
+            }
+            this.publishRevocationList(payload.subsetGuid, 'snapshot');
+
+        } else if (payload.status_type === 'epoch_advanced') {
+
+            logInfo(`🔁 Device ${deviceGuid} switched to epoch ${payload.epoch}, migrated ${payload.keysMigrated} keys in ${payload.switchDurationMs} ms`);
+
+        } else if (payload.status_type === 'provisioning_resync') {
+
+            const state = this.provisioningState.get(deviceGuid);
+            if (state) {
+                logInfo(`🔁 Device ${deviceGuid} needs a provisioning resync (${payload.reason}, has v${payload.currentVersion}), resending v${state.version}`);
+                this.publishFullProvisioning(deviceGuid, state.payload);
+            } else {
+                logWarning(`Device ${deviceGuid} asked for a provisioning resync, but nothing was provisioned through this gateway`);
+            }
+
         }
 
         else {
@@ -405,6 +461,11 @@ export default class Gateway {
             await this.broadcastKeyRefresh(payload);
             await this.updateServerTaskStatusInternal(task.taskId, 'gateway_acknowledged');
 
+        } else if (task.taskType === TYPE_TASK.EPOCH) {
+
+            logTask(`🔁 Advancing vector epoch for subset ${payload.targetSubsetIdentifier} (Task: ${task.taskId})`);
+            this.broadcastEpochAdvance(payload);
+
         } else {
             logWarning(`Unknown task type: ${task.taskType}`);
         }
@@ -446,23 +507,159 @@ export default class Gateway {
 
     }
 
-    
+    // Subset-wide epoch switch: Vc -> Vp, Vn -> Vc, payload.nextVector -> Vn. Devices migrate
+    // their pairwise keys in place, so this replaces re-provisioning plus rediscovery. Our
+    // copy of each device's provisioning is rotated the same way, so later deltas and
+    // resyncs start from what the devices now hold.
+    //
+    // The broadcast only names the epoch: the subset topic reaches every subscriber,
+    // revoked devices included, so the next vector goes to each device on its own config
+    // topic as an EVKMS_DELTA on top of the switched (Vn-empty) state.
+    broadcastEpochAdvance(payload) {
+        const subsetId = payload.targetSubsetIdentifier;
+        const epoch = payload.epoch ?? (this.subsetEpochs.get(subsetId) || 0) + 1;
+        const nextVector = payload.nextVector || [];
+
+        let version = Date.now();
+        for (const [deviceGuid, state] of this.provisioningState) {
+            if (deviceGuid.startsWith(`${subsetId}_`)) version = Math.max(version, state.version + 1);
+        }
+        const nextVersion = nextVector.length ? version + 1 : version;
+
+        const vectorDeltas = [];
+        for (const [deviceGuid, state] of this.provisioningState) {
+            if (!deviceGuid.startsWith(`${subsetId}_`)) continue;
+            if (this.revokedDeviceGuids.has(deviceGuid)) continue;
+            const previous = state.payload;
+            const slot = parseInt(deviceGuid.split('@').pop(), 10) - 1;
+            const rotated = {
+                ...previous,
+                Vectore_p: previous.Vectore_c,
+                Vectore_c: previous.Vectore_n,
+                Vectore_n: nextVector,
+                secret_i: (previous.Vectore_n || [])[slot] ?? previous.secret_i,
+                epoch,
+                version: nextVersion
+            };
+            rotated.checksum = provisioningService.checksum(rotated);
+            this.provisioningState.set(deviceGuid, { version: nextVersion, payload: rotated });
+
+            if (nextVector.length) {
+                vectorDeltas.push([deviceGuid, {
+                    type: 'EVKMS_DELTA',
+                    baseVersion: version,
+                    version: nextVersion,
+                    checksum: rotated.checksum,
+                    changes: { Vn: Object.fromEntries(nextVector.map((secret, index) => [index, secret])) }
+                }]);
+            }
+        }
+        this.subsetEpochs.set(subsetId, epoch);
+
+        const epochMessage = {
+            type: "ADVANCE_EPOCH",
+            epoch,
+            version,
+            issuer: this.gatewayGuid,
+            taskId: payload.taskId,
+            timestamp: new Date().toISOString()
+        };
+
+        this.mqttClient.publish(
+            `${MQTT_TOPIC_PREFIX}/subsets/${subsetId}/key_refresh`,
+            JSON.stringify(epochMessage),
+            { qos: 1, retain: false },
+            (err) => {
+                if (err) {
+                    logError(`Failed to broadcast epoch ${epoch} to subset ${subsetId}: ${err.message}`);
+                    this.updateServerTaskStatusInternal(payload.taskId, 'failed');
+                    return;
+                }
+                logInfo(`Epoch ${epoch} broadcast to subset ${subsetId}, sending the next vector to ${vectorDeltas.length} devices`);
+                this.updateServerTaskStatusInternal(payload.taskId, 'epoch_broadcast_sent');
+
+                // After the switch went out; a device that still sees its delta first holds it until it switches
+                for (const [deviceGuid, deltaMessage] of vectorDeltas) {
+                    this.mqttClient.publish(this.deviceConfigTopic(deviceGuid), JSON.stringify(deltaMessage), { qos: 1 }, (deltaErr) => {
+                        if (deltaErr) {
+                            logError(`Failed to send epoch ${epoch} vector to ${deviceGuid}: ${deltaErr.message}`);
+                        }
+                    });
+                }
+            }
+        );
+    }
+
     async handleDeviceRevocation(revocationPayload) {
         const { revokedDeviceGuid, revokedDeviceSubsetId, taskId } = revocationPayload;
 
         // Add to internal revocation list
         this.revokedDeviceGuids.add(revokedDeviceGuid);
-        logInfo(`Added ${revokedDeviceGuid} to revocation list`);
 
-        // Broadcast revocation alert
+        // Each revocation bumps the subset's list version; devices get just the delta
+        const list = this.revocationLists.get(revokedDeviceSubsetId) || { version: 0, guids: [] };
+        if (!list.guids.includes(revokedDeviceGuid)) {
+            list.guids.push(revokedDeviceGuid);
+            list.version += 1;
+        }
+        this.revocationLists.set(revokedDeviceSubsetId, list);
+        this.saveRevocationLists();
+        logInfo(`Added ${revokedDeviceGuid} to revocation list (subset ${revokedDeviceSubsetId} v${list.version})`);
+
+        this.publishRevocationList(revokedDeviceSubsetId, 'delta', [revokedDeviceGuid], (err) => {
+            if (err) {
+                this.updateServerTaskStatusInternal(taskId, 'failed');
+            } else {
+                logInfo(`Revocation alert broadcasted for ${revokedDeviceGuid}`);
+                this.updateServerTaskStatusInternal(taskId, 'revocation_alert_sent');
+            }
+        });
+    }
+
+    loadRevocationLists() {
+        try {
+            return new Map(Object.entries(JSON.parse(fs.readFileSync(REVOCATION_STATE_PATH, 'utf8'))));
+        } catch (error) {
+            if (error.code !== 'ENOENT') {
+                logError(`Failed to load revocation lists from ${REVOCATION_STATE_PATH}: ${error.message}`);
+            }
+            return new Map();
+        }
+    }
+
+    saveRevocationLists() {
+        try {
+            fs.mkdirSync(path.dirname(REVOCATION_STATE_PATH), { recursive: true });
+            // Written aside and renamed, so a crash mid-write keeps the previous lists
+            const tmpPath = `${REVOCATION_STATE_PATH}.tmp`;
+            fs.writeFileSync(tmpPath, JSON.stringify(Object.fromEntries(this.revocationLists)));
+            fs.renameSync(tmpPath, REVOCATION_STATE_PATH);
+        } catch (error) {
+            logError(`Failed to save revocation lists to ${REVOCATION_STATE_PATH}: ${error.message}`);
+        }
+    }
+
+    // Broadcast a subset's revocation list: the whole list ('snapshot') or the GUIDs
+    // revoked by the latest version ('delta', applied on top of version - 1).
+    // A single-GUID delta keeps the REVOCATION_ALERT type and revokedGuid, so firmware
+    // that predates versioned lists still acts on it; newer firmware reads the version fields.
+    publishRevocationList(subsetId, mode, deltaGuids = [], callback = () => {}) {
+        const list = this.revocationLists.get(subsetId) || { version: 0, guids: [] };
+        const revoked = mode === 'snapshot' ? list.guids : deltaGuids;
+        const legacyAlert = mode === 'delta' && revoked.length === 1;
+
         const revocationBroadcastMessage = {
-            type: "REVOCATION_ALERT",
-            revokedGuid: revokedDeviceGuid,
+            type: legacyAlert ? "REVOCATION_ALERT" : "REVOCATION_LIST",
+            mode: mode,
+            version: list.version,
+            baseVersion: mode === 'snapshot' ? 0 : list.version - 1,
+            revoked: revoked,
+            revokedGuid: legacyAlert ? revoked[0] : undefined,
             issuer: this.gatewayGuid,
             timestamp: new Date().toISOString()
         };
 
-        const subsetBroadcastTopic = `${MQTT_TOPIC_PREFIX}/subsets/${revokedDeviceSubsetId}/broadcast_alerts`;
+        const subsetBroadcastTopic = `${MQTT_TOPIC_PREFIX}/subsets/${subsetId}/broadcast_alerts`;
 
         this.mqttClient.publish(
             subsetBroadcastTopic,
@@ -470,33 +667,84 @@ export default class Gateway {
             { qos: 1 },
             (err) => {
                 if (err) {
-                    logError(`Failed to broadcast revocation alert: ${err.message}`);
-                    this.updateServerTaskStatusInternal(taskId, 'failed');
-                } else {
-                    logInfo(`Revocation alert broadcasted for ${revokedDeviceGuid}`);
-                    this.updateServerTaskStatusInternal(taskId, 'revocation_alert_sent');
+                    logError(`Failed to broadcast revocation list v${list.version} (${mode}): ${err.message}`);
                 }
+                callback(err);
             }
         );
     }
 
+    // Versions the payload and sends it the cheapest way: a delta against what the device
+    // last got from us when little changed, chunks when it is large, else one retained message
     publishProvisioningToDevice(deviceGuid, payloadWithTaskId) {
-        const topic = `${MQTT_TOPIC_PREFIX}/${this.gatewayGuid}/devices/${deviceGuid}/config`;
+        const previous = this.provisioningState.get(deviceGuid);
+        const version = payloadWithTaskId.version
+            ?? Math.max(Date.now(), previous ? previous.version + 1 : 0);  // survives gateway restarts
+        const payload = { ...payloadWithTaskId, version };
+        payload.checksum = provisioningService.checksum(payload);
+        this.provisioningState.set(deviceGuid, { version, payload });
+
+        const onSent = async (err) => {
+            if (err) {
+                logError(`Failed to publish provisioning to ${deviceGuid}: ${err.message}`);
+                await this.updateServerTaskStatusInternal(payload.taskId, 'failed');
+            } else {
+                logInfo(`Provisioning payload v${version} sent to ${deviceGuid}`);
+                await this.updateServerTaskStatusInternal(payload.taskId, 'in_progress_payload_sent');
+            }
+        };
 
-        this.mqttClient.publish(
-            topic,
-            JSON.stringify(payloadWithTaskId),
-            { qos: 1, retain: true },
-            async (err) => {
+        const delta = previous && provisioningService.diff(previous.payload, payload);
+        const entries = provisioningService.entryCount(payload);
+        if (delta && delta.count <= Math.max(1, entries * PROVISIONING_DELTA_MAX_RATIO)) {
+            const { count, ...changes } = delta;
+            const deltaMessage = {
+                type: 'EVKMS_DELTA',
+                baseVersion: previous.version,
+                version,
+                checksum: payload.checksum,
+                taskId: payload.taskId,
+                ...changes
+            };
+            logInfo(`Provisioning ${deviceGuid}: delta v${previous.version} -> v${version} (${count} of ${entries} entries)`);
+            this.mqttClient.publish(this.deviceConfigTopic(deviceGuid), JSON.stringify(deltaMessage), { qos: 1 }, onSent);
+            return;
+        }
+
+        this.publishFullProvisioning(deviceGuid, payload, onSent);
+    }
+
+    // The whole versioned payload, chunked above PROVISIONING_CHUNK_SIZE entries. Small
+    // payloads stay retained for devices that connect later; chunked transfers aren't
+    // retained, so a device on an older retained config asks for them via its ack
+    publishFullProvisioning(deviceGuid, payload, callback = () => {}) {
+        const topic = this.deviceConfigTopic(deviceGuid);
+
+        if (provisioningService.entryCount(payload) <= PROVISIONING_CHUNK_SIZE) {
+            this.mqttClient.publish(topic, JSON.stringify(payload), { qos: 1, retain: true }, callback);
+            return;
+        }
+
+        const chunks = provisioningService.buildChunks(payload, `${payload.version}-${Date.now().toString(36)}`, PROVISIONING_CHUNK_SIZE);
+        logInfo(`Provisioning ${deviceGuid}: v${payload.version} in ${chunks.length} chunks`);
+        let reported = false;
+        chunks.forEach((chunk, seq) => {
+            const last = seq === chunks.length - 1;
+            this.mqttClient.publish(topic, JSON.stringify(chunk), { qos: 1 }, (err) => {
                 if (err) {
-                    logError(`Failed to publish provisioning to ${deviceGuid}: ${err.message}`);
-                    await this.updateServerTaskStatusInternal(payloadWithTaskId.taskId, 'failed');
-                } else {
-                    logInfo(`Provisioning payload sent to ${deviceGuid}`);
-                    await this.updateServerTaskStatusInternal(payloadWithTaskId.taskId, 'in_progress_payload_sent');
+                    logError(`Failed to publish provisioning chunk ${seq}/${chunks.length} to ${deviceGuid}: ${err.message}`);
                 }
-            }
-        );
+                // The device resyncs on its own if an earlier chunk went missing
+                if (!reported && (last || err)) {
+                    reported = true;
+                    callback(err);
+                }
+            });
+        });
+    }
+
+    deviceConfigTopic(deviceGuid) {
+        return `${MQTT_TOPIC_PREFIX}/${this.gatewayGuid}/devices/${deviceGuid}/config`;
     }
 
 
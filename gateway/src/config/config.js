@@ -36,6 +36,16 @@ export const SERVER_BASE_URL = process.env.SERVER_BASE_URL || 'http://172.17.0.1
 
 export const KEY_ENCRYPTION_PASS = process.env.KEY_ENCRYPTION_PASS || "fall-back"
 
+// Per-subset revocation lists, kept across restarts so list versions never go backwards
+export const REVOCATION_STATE_PATH = process.env.REVOCATION_STATE_PATH
+    || path.join(__dirname, '..', 'firmware', 'secure_storage', 'revocation_lists.json');
+
+// Provisioning payloads with more vector entries than this go out as EVKMS_CHUNK messages
+export const PROVISIONING_CHUNK_SIZE = parseInt(process.env.PROVISIONING_CHUNK_SIZE || '500', 10);
+
+// Re-provisioning that changes at most this fraction of entries goes out as an EVKMS_DELTA
+export const PROVISIONING_DELTA_MAX_RATIO = parseFloat(process.env.PROVISIONING_DELTA_MAX_RATIO || '0.25');
+
 
 
 export const TYPE_TASK = {
@@ -43,4 +53,5 @@ export const TYPE_TASK = {
     REVOCATION:"revocation",
     REFRESH: 'refresh' ,
     SCHEDULED: 'scheduled',
+    EPOCH: 'epoch',
 }
\ No newline at end of file
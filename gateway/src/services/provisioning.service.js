@@ -0,0 +1,97 @@
+import { createHash } from "crypto";
+
+// Vector short names used in chunks/deltas -> key in the full provisioning payload
+const VECTORS = {
+    Vp: 'Vectore_p',
+    Vc: 'Vectore_c',
+    Vn: 'Vectore_n'
+};
+
+const MASK = (1n << 64n) - 1n;
+
+const entryHash = (name, index, value) =>
+    createHash('sha256').update(`${name}:${index}:${value}`).digest().readBigUInt64BE(0);
+
+const provisioningService = {
+
+    // Same checksum the device computes (lib/provisioning.py): a sum mod 2^64 of one
+    // hash per vector entry plus secret_i and alpha, as 16 hex digits
+    checksum: (payload) => {
+        let total = entryHash('i', 0, payload.secret_i) + entryHash('alpha', 0, payload.alpha);
+        for (const [name, key] of Object.entries(VECTORS)) {
+            (payload[key] || []).forEach((secret, index) => {
+                total += entryHash(name, index, secret);
+            });
+        }
+        return (total & MASK).toString(16).padStart(16, '0');
+    },
+
+    entryCount: (payload) =>
+        Object.values(VECTORS).reduce((count, key) => count + (payload[key] || []).length, 0),
+
+    // Entries that changed between two payloads, or null when a delta can't express it
+    // (a vector shrank, or the KDF changed)
+    diff: (previous, next) => {
+        if ((previous.kdf || null) !== (next.kdf || null)) return null;
+
+        const delta = { changes: {}, count: 0 };
+        for (const [name, key] of Object.entries(VECTORS)) {
+            const before = previous[key] || [];
+            const after = next[key] || [];
+            if (after.length < before.length) return null;
+
+            after.forEach((secret, index) => {
+                if (before[index] !== secret) {
+                    (delta.changes[name] = delta.changes[name] || {})[index] = secret;
+                    delta.count++;
+                }
+            });
+        }
+        for (const key of ['secret_i', 'alpha']) {
+            if (previous[key] !== next[key]) {
+                delta[key] = next[key];
+                delta.count++;
+            }
+        }
+        return delta;
+    },
+
+    // Split a full payload into EVKMS_CHUNK messages of at most chunkSize secrets each;
+    // the first carries secret_i/alpha/kdf/checksum and the last the taskId
+    buildChunks: (payload, transfer, chunkSize) => {
+        const lengths = {};
+        const slices = [];
+        for (const [name, key] of Object.entries(VECTORS)) {
+            const vector = payload[key] || [];
+            lengths[name] = vector.length;
+            for (let offset = 0; offset < vector.length; offset += chunkSize) {
+                slices.push({ vector: name, offset, secrets: vector.slice(offset, offset + chunkSize) });
+            }
+        }
+        if (slices.length === 0) slices.push({ vector: 'Vc', offset: 0, secrets: [] });
+
+        return slices.map((slice, seq) => {
+            const chunk = {
+                type: 'EVKMS_CHUNK',
+                transfer,
+                version: payload.version,
+                seq,
+                total: slices.length,
+                lengths,
+                ...slice
+            };
+            if (seq === 0) {
+                Object.assign(chunk, {
+                    secret_i: payload.secret_i,
+                    alpha: payload.alpha,
+                    kdf: payload.kdf,
+                    checksum: payload.checksum
+                });
+            }
+            if (seq === slices.length - 1) chunk.taskId = payload.taskId;
+            return chunk;
+        });
+    }
+};
+
+export default provisioningService;